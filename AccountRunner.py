@@ -0,0 +1,239 @@
+import os
+import threading
+import time
+from RateLimiter import RateLimiter
+
+try:
+    import tomllib
+except ImportError:  # Python < 3.11
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+
+class AccountRunner:
+    """
+    Backs up many accounts in one process, several at a time.
+
+    Starting one process per account pays the interpreter startup, the imports and a full
+    TLS handshake for every account. The runner takes the account definitions of a TOML file
+    (`load()`) and backs them up from a pool of worker threads, in the same process, so the
+    storage backend and the search index are opened once and the TLS sessions of a server are
+    resumed from one account to the next.
+
+    Two limits apply: at most `concurrency` accounts are backed up at once, and at most
+    `per_server` of them on the same server, so a batch of thousands of accounts on one
+    provider does not open thousands of connections to it. An account that would exceed its
+    server limit waits, and an account of another server is started instead.
+
+    A failing account is recorded with its error and the others go on. A disk error stops
+    the accounts not started yet, since they would fail the same way.
+
+    Attributes:
+        _backup (callable): Called with an account dict, returns the number of emails saved.
+        _concurrency (int): Maximum number of accounts backed up at once.
+        _per_server (int): Maximum number of accounts backed up at once on one server.
+        _running (dict): The number of accounts in progress, by (server, port).
+        results (list): One result dict per account, in the order of the accounts.
+
+    Usage:
+        settings = AccountRunner.load("accounts.toml")
+        runner = AccountRunner(backup, concurrency=settings["concurrency"], per_server=settings["per_server"])
+        print(AccountRunner.summary(runner.run(settings["accounts"])))
+    """
+
+    # settings an account (or the [defaults] table) may set
+    account_keys = ("server", "port", "username", "password", "password_env", "workers", "max_connections",
+                    "batch_size", "batch_bytes", "sync_batch", "stream", "full", "no_plan", "all_folders",
+                    "max_rate", "max_commands")
+
+    def __init__(self, backup, **opt):
+        """
+        Initializes an AccountRunner object.
+
+        Args:
+            backup (callable): Called with an account dict, as returned by `load()`; returns
+                the number of emails saved and raises ConnectionError, OSError or ValueError.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            concurrency (int): Accounts backed up at once. Default is 4.
+            per_server (int): Accounts backed up at once on the same server. Default is 2.
+        """
+        self._backup = backup
+        self._concurrency = max(1, opt.get('concurrency', 4))
+        self._per_server = max(1, opt.get('per_server', 2))
+        self._condition = threading.Condition()
+        self._pending = []
+        self._running = {}
+        self._stop = threading.Event()
+        self.results = []
+
+    @staticmethod
+    def load(file_name):
+        """
+        Reads the account definitions of a TOML file.
+
+        The file holds the optional `concurrency` and `per_server` limits, the optional
+        `max_rate` (bytes per second, e.g. "50M") and `max_commands` (per second) shared by all
+        the accounts, an optional `[defaults]` table applied to every account, and one
+        `[[accounts]]` table per account with at least `server`, `username` and `password` (or
+        `password_env`, the name of an environment variable holding the password):
+
+            concurrency = 8
+            per_server = 2
+            max_rate = "50M"
+
+            [defaults]
+            port = 993
+            all_folders = true
+
+            [[accounts]]
+            server = "imap.example.com"
+            username = "alice@example.com"
+            password_env = "ALICE_PASSWORD"
+
+        Args:
+            file_name (str): The TOML file.
+
+        Returns:
+            dict: "concurrency", "per_server", "max_rate", "max_commands" and "accounts", the list
+            of account dicts with the defaults applied, the port set (993 if missing), the
+            password resolved and the rates in bytes per second.
+
+        Raises:
+            OSError: If the file cannot be read.
+            ValueError: If the file is not valid TOML, has an unknown setting, or an account
+                misses its server, username or password.
+        """
+        if tomllib is None:
+            raise ValueError("reading a config file needs Python 3.11 or the tomli package")
+        with open(file_name, "rb") as config_file:
+            try:
+                config = tomllib.load(config_file)
+            except tomllib.TOMLDecodeError as e:
+                raise ValueError(f"{file_name}: {e}")
+        unknown = set(config) - {"concurrency", "per_server", "max_rate", "max_commands", "defaults", "accounts"}
+        if unknown:
+            raise ValueError(f"{file_name}: unknown setting {sorted(unknown)[0]}")
+        defaults = config.get("defaults", {})
+        accounts = []
+        for position, account in enumerate(config.get("accounts", []), 1):
+            account = {"port": 993, **defaults, **account}
+            unknown = set(account) - set(AccountRunner.account_keys)
+            if unknown:
+                raise ValueError(f"{file_name}: account {position}: unknown setting {sorted(unknown)[0]}")
+            if "password_env" in account:
+                account["password"] = os.environ.get(account.pop("password_env"))
+            missing = [key for key in ("server", "username", "password") if not account.get(key)]
+            if missing:
+                raise ValueError(f"{file_name}: account {position}: missing {missing[0]}")
+            if not isinstance(account["port"], int):
+                raise ValueError(f"{file_name}: account {position}: port must be an integer")
+            try:
+                if "max_rate" in account:
+                    account["max_rate"] = RateLimiter.parse_rate(account["max_rate"])
+            except ValueError as e:
+                raise ValueError(f"{file_name}: account {position}: {e}")
+            accounts.append(account)
+        if not accounts:
+            raise ValueError(f"{file_name}: no [[accounts]] defined")
+        try:
+            max_rate = RateLimiter.parse_rate(config.get("max_rate"))
+        except ValueError as e:
+            raise ValueError(f"{file_name}: {e}")
+        return {"concurrency": config.get("concurrency", 4), "per_server": config.get("per_server", 2),
+                "max_rate": max_rate, "max_commands": config.get("max_commands"), "accounts": accounts}
+
+    def run(self, accounts):
+        """
+        Backs up the accounts, several at a time.
+
+        Args:
+            accounts (list): The account dicts, each with at least "server", "port" and
+                "username", in the order to start them.
+
+        Returns:
+            list: The `results`, one dict per account with "username", "server", "emails",
+            "seconds" and "error" (None, or the message of the error that stopped it).
+        """
+        self.results = [{"username": account["username"], "server": account["server"], "emails": 0,
+                         "seconds": 0.0, "error": "not started"} for account in accounts]
+        self._pending = list(enumerate(accounts))
+        threads = [threading.Thread(target=self._worker, daemon=True)
+                   for _ in range(min(self._concurrency, len(accounts)))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.results
+
+    def _next(self):
+        """
+        Takes the first pending account whose server is below its limit, waiting if needed.
+
+        Returns:
+            tuple: (position, account), or None when no account is left.
+        """
+        with self._condition:
+            while self._pending and not self._stop.is_set():
+                for number, (position, account) in enumerate(self._pending):
+                    server = (account["server"].lower(), account["port"])
+                    if self._running.get(server, 0) < self._per_server:
+                        self._running[server] = self._running.get(server, 0) + 1
+                        del self._pending[number]
+                        return position, account
+                self._condition.wait()
+            return None
+
+    def _worker(self):
+        """
+        Worker thread: backs up accounts until none is left.
+        """
+        while True:
+            task = self._next()
+            if task is None:
+                return
+            position, account = task
+            result = self.results[position]
+            start = time.monotonic()
+            try:
+                result["emails"] = self._backup(account)
+                result["error"] = None
+            except (ConnectionError, ValueError) as e:
+                result["error"] = str(e) or type(e).__name__
+            except OSError as e:
+                result["error"] = str(e) or type(e).__name__
+                self._stop.set()
+            except Exception as e:
+                # e.g. an unexpected server response: the account fails, the others go on
+                result["error"] = f"{type(e).__name__}: {e}"
+            finally:
+                result["seconds"] = round(time.monotonic() - start, 3)
+                with self._condition:
+                    self._running[(account["server"].lower(), account["port"])] -= 1
+                    self._condition.notify_all()
+
+    @staticmethod
+    def summary(results):
+        """
+        Formats the results of a run as a table, one line per account and a total.
+
+        Args:
+            results (list): The result dicts, as returned by `run()`.
+
+        Returns:
+            str: The report.
+        """
+        width = max([len("Account")] + [len(result["username"]) for result in results])
+        server_width = max([len("Server")] + [len(result["server"]) for result in results])
+        lines = [f"{'Account':<{width}}  {'Server':<{server_width}}  {'Emails':>8}  {'Time':>8}  Status"]
+        for result in results:
+            status = "ok" if result["error"] is None else "error : " + result["error"]
+            lines.append(f"{result['username']:<{width}}  {result['server']:<{server_width}}  "
+                         f"{result['emails']:>8}  {result['seconds']:>7.1f}s  {status}")
+        failed = sum(1 for result in results if result["error"] is not None)
+        emails = sum(result["emails"] for result in results)
+        lines.append(f"{len(results)} accounts, {len(results) - failed} ok, {failed} failed, {emails} emails")
+        return "\n".join(lines)
@@ -0,0 +1,444 @@
+import asyncio
+import collections
+import re
+import ssl
+from AsyncEmailClient import AsyncEmailClient
+from Email import Email  # my module
+from Imap import Imap
+
+
+class AsyncImap(AsyncEmailClient):
+    """
+    asyncio IMAP email client implementation.
+
+    Inherits from AsyncEmailClient.
+
+    The client talks IMAP directly over an asyncio stream. A single reader task reads the
+    responses; every command gets its own tag and future, so several commands can be in flight
+    on the same socket (pipelining). The server answers pipelined commands in order, so untagged
+    responses are attributed to the oldest command still waiting for its tagged completion.
+
+    The timeout is an inactivity timeout: it applies to each read of the reader task while a
+    command is waiting, not to the whole command, so a large pipelined FETCH that keeps
+    streaming is never cut off, while a server that stops answering fails every waiting
+    command with a ConnectionError.
+
+    Args:
+        server (str): The IMAP server address.
+        port (int): The server port number.
+        username (str): The username for authentication.
+        password (str): The password for authentication.
+        **opt: Additional optional parameters.
+
+    Keyword Args:
+        ssl (bool): Set to True to use SSL/TLS. Default is False.
+        batch_size (int): Maximum number of messages requested by one FETCH command. Default is 100.
+        pipeline (int): Maximum number of FETCH commands in flight. Default is 4.
+
+    Raises:
+        ConnectionError: If there's an error connecting to or talking with the IMAP server.
+
+    Usage:
+        async def backup(account):
+            imap = AsyncImap(server, port, account, password, ssl=True)
+            await imap.connect()
+            async for email_obj in imap.fetch_batch(await imap.fetch_emails()):
+                # Process the email object
+            await imap.close()
+
+        await asyncio.gather(*(backup(account) for account in accounts))
+    """
+
+    _tagged = re.compile(rb'(?P<tag>[A-Z]\d+) (?P<type>[A-Z]+) ?(?P<data>.*)', re.DOTALL)
+    _untagged_status = re.compile(rb'\* (?P<number>\d+) (?P<type>[A-Z-]+)( (?P<data>.*))?', re.DOTALL)
+    _untagged = re.compile(rb'\* (?P<type>[A-Z-]+)( (?P<data>.*))?', re.DOTALL)
+    _response_code = re.compile(rb'\[(?P<type>[A-Z-]+)( (?P<data>[^\]]*))?\]')
+    _literal = re.compile(rb'.*\{(?P<size>\d+)\}$', re.DOTALL)
+
+    def __init__(self, server, port, username, password, **opt):
+        super().__init__(server, port, username, password, **opt)
+
+        if "ssl" in opt:
+            self._is_ssl = opt['ssl']
+        else:
+            self._is_ssl = False
+
+        if "batch_size" in opt:
+            self._batch_size = opt['batch_size']
+        else:
+            # default number of messages per FETCH command
+            self._batch_size = 100
+
+        if "pipeline" in opt:
+            self._pipeline = opt['pipeline']
+        else:
+            # default number of FETCH commands in flight
+            self._pipeline = 4
+
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._tag_number = 0
+        self._sent_at = 0.0
+        self._pending = collections.OrderedDict()
+        self._capabilities = set()
+        self._mailbox = None
+        self._uidvalidity = None
+
+    async def connect(self, path="INBOX"):
+        """
+        Connects to the IMAP server, logs in and selects a mailbox.
+
+        Args:
+            path (str): The mailbox path to connect to. Default is "INBOX".
+
+        Raises:
+            ConnectionError: If there's an error connecting to the IMAP server.
+        """
+        try:
+            context = None
+            if self._is_ssl:
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self._server, self._port, ssl=context), self._timeout)
+
+            greeting = await asyncio.wait_for(self._reader.readline(), self._timeout)
+            if not greeting.startswith(b"* OK") and not greeting.startswith(b"* PREAUTH"):
+                raise ConnectionError(f"Unexpected greeting: {greeting!r}")
+            self._reader_task = asyncio.ensure_future(self._read_loop())
+
+            await self.command("LOGIN", AsyncImap.quote(self._username), AsyncImap.quote(self._password))
+            status, text, untagged = await self.command("CAPABILITY")
+            for data in AsyncImap.untagged(untagged, "CAPABILITY"):
+                self._capabilities.update(data.decode("ascii", errors="ignore").upper().split())
+            await self.select(path)
+        except ConnectionError:
+            await self._abort()
+            raise
+        except Exception as e:
+            await self._abort()
+            raise ConnectionError(str(e))
+
+    async def select(self, path):
+        """
+        Selects a mailbox on the open connection.
+
+        Args:
+            path (str): The mailbox path to select.
+
+        Raises:
+            ConnectionError: If the mailbox cannot be selected.
+        """
+        status, text, untagged = await self.command("SELECT", AsyncImap.quote(path))
+        self._mailbox = path
+        self._uidvalidity = None
+        for data in AsyncImap.untagged(untagged, "UIDVALIDITY"):
+            self._uidvalidity = int(data)
+
+    @property
+    def mailbox(self):
+        """
+        str: The selected mailbox, or None before `connect()`.
+        """
+        return self._mailbox
+
+    @property
+    def uidvalidity(self):
+        """
+        int: The UIDVALIDITY of the selected mailbox, or None if unknown.
+        """
+        return self._uidvalidity
+
+    def is_connected(self):
+        """
+        Checks the connection status to the IMAP server.
+
+        Returns:
+            bool: True if connected, False otherwise.
+        """
+        return self._writer is not None and self._reader_task is not None and not self._reader_task.done()
+
+    async def fetch_emails(self):
+        """
+        Fetches the list of email UIDs.
+
+        Returns:
+            list: A list of email UIDs.
+
+        Raises:
+            ConnectionError: If the connection to the IMAP server is not established.
+        """
+        status, text, untagged = await self.command("UID", "SEARCH", "ALL")
+        email_ids = []
+        for data in AsyncImap.untagged(untagged, "SEARCH"):
+            email_ids.extend(data.split())
+        return email_ids
+
+    async def fetch_email(self, email_id):
+        """
+        Fetches the email message with the specified UID.
+
+        Args:
+            email_id (bytes): The UID of the email message.
+
+        Returns:
+            Email: An Email object representing the fetched email.
+
+        Raises:
+            ConnectionError: If the connection is not established or the message does not exist.
+        """
+        response = await self.command("UID", "FETCH", Imap.sequence_set([email_id]), "(UID RFC822)")
+        emails = AsyncImap._emails(response)
+        if not emails:
+            raise ConnectionError(f"Email {email_id} not found")
+        return emails[0]
+
+    async def fetch_batch(self, email_ids, batch_size=None, pipeline=None):
+        """
+        Fetches many email messages with pipelined UID FETCH commands.
+
+        The UIDs are cut into batches of `batch_size` messages. Up to `pipeline` FETCH commands
+        are sent before the first answer is awaited, so the round trip latency is paid once per
+        window instead of once per command.
+
+        Args:
+            email_ids (iterable): The UIDs of the email messages.
+            batch_size (int): Maximum number of messages per command. Defaults to the client option.
+            pipeline (int): Maximum number of commands in flight. Defaults to the client option.
+
+        Yields:
+            Email: An Email object for each fetched message.
+
+        Raises:
+            ConnectionError: If the connection is not established or a FETCH command fails.
+        """
+        batch_size = batch_size or self._batch_size
+        pipeline = pipeline or self._pipeline
+        email_ids = list(email_ids)
+        in_flight = collections.deque()
+        try:
+            for start in range(0, len(email_ids), batch_size):
+                batch = email_ids[start:start + batch_size]
+                in_flight.append(asyncio.ensure_future(
+                    self.command("UID", "FETCH", Imap.sequence_set(batch), "(UID RFC822)")))
+                if len(in_flight) >= pipeline:
+                    for email_obj in AsyncImap._emails(await in_flight.popleft()):
+                        yield email_obj
+            while in_flight:
+                for email_obj in AsyncImap._emails(await in_flight.popleft()):
+                    yield email_obj
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+    @staticmethod
+    def _emails(response):
+        """
+        Builds Email objects from the response of a UID FETCH command.
+
+        Args:
+            response (tuple): The `(status, text, untagged)` result of `command()`.
+
+        Returns:
+            list: The Email objects, in the order the server sent them.
+        """
+        status, text, untagged = response
+        emails = []
+        for record in Imap.parse_fetch(AsyncImap.untagged(untagged, "FETCH")):
+            if "RFC822" in record:
+                emails.append(Email(record["RFC822"], uid=record.get("UID")))
+        return emails
+
+    async def close(self):
+        """
+        Logs out and closes the connection to the IMAP server.
+
+        Raises:
+            ConnectionError: If the connection to the IMAP server is not established.
+        """
+        if self._writer is None:
+            raise ConnectionError("Connection not established.")
+        try:
+            await self.command("LOGOUT")
+        except ConnectionError:
+            pass  # the server may close the socket right after BYE
+        await self._abort()
+
+    async def command(self, *args):
+        """
+        Sends one tagged command and waits for its completion.
+
+        Other commands may be sent while this one is waiting; that is how the pipelining works.
+
+        Args:
+            *args (str): The command name and its arguments, already quoted where needed.
+
+        Returns:
+            tuple: `(status, text, untagged)` where `untagged` is the list of `(type, data)`
+            untagged responses received for the command, in the format used by imaplib.
+
+        Raises:
+            ConnectionError: If the connection is not established, drops, or the command fails.
+        """
+        if self._writer is None or self._reader_task is None or self._reader_task.done():
+            raise ConnectionError("Connection not established.")
+        self._tag_number += 1
+        tag = f"A{self._tag_number:04d}"
+        future = asyncio.get_running_loop().create_future()
+        self._pending[tag.encode()] = (future, [])
+        line = " ".join([tag] + [str(arg) for arg in args]) + "\r\n"
+        self._writer.write(line.encode("utf-8"))
+        self._sent_at = asyncio.get_running_loop().time()
+        await self._writer.drain()
+
+        # the reader task fails the future if the server stays silent for the timeout
+        status, text, untagged = await future
+        if status != "OK":
+            raise ConnectionError(f"{args[0]} failed: {status} {text}")
+        return status, text, untagged
+
+    async def _read_loop(self):
+        """
+        Reader task: reads every response and hands it to the command it belongs to.
+        """
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(self._reader.readline(), self._timeout)
+                except asyncio.TimeoutError:
+                    idle = asyncio.get_running_loop().time() - self._sent_at
+                    if not self._pending or idle < self._timeout:
+                        continue  # nothing was expected for the whole timeout
+                    raise ConnectionError(f"No response from the server for {self._timeout}s")
+                if not line:
+                    raise ConnectionError("Connection closed by server")
+                line = line.rstrip(b"\r\n")
+                if line.startswith(b"* "):
+                    typ, data = await self._read_untagged(line)
+                    if self._pending:
+                        future, untagged = next(iter(self._pending.values()))
+                        untagged.append((typ, data))
+                elif line.startswith(b"+"):
+                    continue  # continuation requests are not used, every argument is quoted
+                else:
+                    match = AsyncImap._tagged.match(line)
+                    if match is None or match.group("tag") not in self._pending:
+                        raise ConnectionError(f"Unexpected response: {line!r}")
+                    future, untagged = self._pending.pop(match.group("tag"))
+                    if not future.done():
+                        future.set_result((match.group("type").decode(), match.group("data").decode(
+                            "utf-8", errors="replace"), untagged))
+        except Exception as e:
+            error = e if isinstance(e, ConnectionError) else ConnectionError(str(e))
+            for future, untagged in self._pending.values():
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+
+    async def _read_untagged(self, line):
+        """
+        Reads one untagged response, including any literal it carries.
+
+        Args:
+            line (bytes): The first line of the response, without CRLF.
+
+        Returns:
+            tuple: `(type, data)` where `data` is bytes, or a list of `(text, literal)` tuples
+            followed by the closing bytes when the response has literals.
+        """
+        match = AsyncImap._untagged_status.match(line)
+        if match is not None:
+            typ = match.group("type").decode()
+            data = match.group("number") + (b" " + match.group("data") if match.group("data") else b"")
+        else:
+            match = AsyncImap._untagged.match(line)
+            typ = match.group("type").decode() if match else "UNKNOWN"
+            data = (match.group("data") or b"") if match else line
+            code = AsyncImap._response_code.match(data)
+            if typ in ("OK", "NO", "BAD") and code is not None:
+                return code.group("type").decode(), code.group("data") or b""
+
+        parts = []
+        literal = AsyncImap._literal.match(data)
+        while literal is not None:
+            body = await self._read(self._reader.readexactly(int(literal.group("size"))))
+            parts.append((data, body))
+            data = (await self._read(self._reader.readline())).rstrip(b"\r\n")
+            literal = AsyncImap._literal.match(data)
+        if parts:
+            parts.append(data)
+            return typ, parts
+        return typ, data
+
+    async def _read(self, awaitable):
+        """
+        Waits for one read in the middle of a response, at most the timeout.
+
+        Args:
+            awaitable (awaitable): The read.
+
+        Returns:
+            bytes: The data read.
+
+        Raises:
+            ConnectionError: If the server sends nothing for the timeout.
+        """
+        try:
+            return await asyncio.wait_for(awaitable, self._timeout)
+        except asyncio.TimeoutError:
+            raise ConnectionError(f"No response from the server for {self._timeout}s")
+
+    async def _abort(self):
+        """
+        Stops the reader task and closes the socket without logging out.
+        """
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except (asyncio.CancelledError, Exception):
+                pass
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        self._reader_task = None
+        self._writer = None
+
+    @staticmethod
+    def untagged(untagged, typ):
+        """
+        Selects the untagged responses of one type, flattened like imaplib's data list.
+
+        Args:
+            untagged (list): The `(type, data)` pairs returned by `command()`.
+            typ (str): The response type, e.g. "FETCH" or "SEARCH".
+
+        Returns:
+            list: The data items of that type.
+        """
+        items = []
+        for name, data in untagged:
+            if name == typ:
+                if isinstance(data, list):
+                    items.extend(data)
+                else:
+                    items.append(data)
+        return items
+
+    @staticmethod
+    def quote(text):
+        """
+        Quotes a string argument of an IMAP command.
+
+        Args:
+            text (str): The argument.
+
+        Returns:
+            str: The argument as an IMAP quoted string.
+        """
+        return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"') + '"'
@@ -0,0 +1,261 @@
+import concurrent.futures
+import email
+import email.policy
+import hashlib
+import os
+import tempfile
+from CompressedStorage import CompressedStorage
+from Metrics import Metrics
+
+
+class AttachmentStore:
+    """
+    Extracts the attachments of the backup into a content-addressed blob store.
+
+    Parsing MIME is CPU bound: the base64 of every attachment must be decoded, and one Python
+    thread parses a few dozen megabytes per second. The stored emails the search index does
+    not list as extracted yet are therefore parsed over a pool of processes. Each process
+    walks the MIME parts of its emails, writes every attachment (a part with a file name or
+    an "attachment" disposition) under the SHA-256 of its decoded content, in a sharded
+    layout (`attachments/ab/cd/abcd...`), and returns the type, file name, size and hash of
+    each. The same file sent in a hundred emails is stored once.
+
+    The results are recorded in the index `batch_size` emails at a time, so an interrupted
+    extraction resumes with the emails not recorded yet, and a run after each backup only
+    parses the new emails. The blobs are not synced to disk: they can be extracted again from
+    the emails at any time.
+
+    Attributes:
+        _path (str): The root directory of the blob store.
+        _index (MailIndex): The search index of the backup.
+        _jobs (int): Number of parsing processes; 1 parses in the calling process.
+        _batch_size (int): Number of emails recorded in the index at a time.
+        _segments (SegmentStorage): Resolves segment records, or None.
+        _dictionary_dir (str): Where the zstd dictionaries of compressed backups are kept.
+
+    Usage:
+        store = AttachmentStore("mail", MailIndex("mail/index.sqlite"), jobs=8)
+        store.extract()
+        for row in index.attachments(sender="alice@example.com", content_type="pdf"):
+            print(row["filename"], store.blob_path(row["sha256"]))
+    """
+
+    # compressed file readers of a parsing process, by dictionary directory and codec
+    _readers = {}
+
+    def __init__(self, path="mail", index=None, **opt):
+        """
+        Initializes an AttachmentStore object.
+
+        Args:
+            path (str): The root directory; the blobs go to its "attachments" directory. Default is "mail".
+            index (MailIndex): The search index of the backup. Default is None.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            jobs (int): Parsing processes. Default is the number of CPUs.
+            batch_size (int): Emails recorded in the index at a time. Default is 1000.
+            segments (SegmentStorage): The segment archive, to extract from a segment backup. Default is None.
+            dictionary_dir (str): The zstd dictionaries of a compressed backup. Default is "<path>/.dict".
+        """
+        self._path = path
+        self._index = index
+        self._jobs = max(1, opt.get('jobs') or os.cpu_count() or 1)
+        self._batch_size = max(1, opt.get('batch_size', 1000))
+        self._segments = opt.get('segments')
+        self._dictionary_dir = opt.get('dictionary_dir') or os.path.join(path, ".dict")
+
+    def blob_path(self, digest):
+        """
+        Returns the path of the blob with the given hash.
+
+        Args:
+            digest (str): The SHA-256 hex digest of the attachment.
+
+        Returns:
+            str: The path, e.g. "mail/attachments/ab/cd/abcd...".
+        """
+        return AttachmentStore._blob_path(os.path.join(self._path, "attachments"), digest)
+
+    @staticmethod
+    def _blob_path(blob_dir, digest):
+        """
+        Returns the path of a blob in a blob directory.
+
+        Args:
+            blob_dir (str): The blob directory.
+            digest (str): The SHA-256 hex digest.
+
+        Returns:
+            str: The path.
+        """
+        return os.path.join(blob_dir, digest[:2], digest[2:4], digest)
+
+    def extract(self, paths=None):
+        """
+        Extracts the attachments of the stored emails and records them in the index.
+
+        Args:
+            paths (list): The stored paths to extract. Default is every path of the index not
+                extracted yet.
+
+        Returns:
+            dict: "emails" (parsed), "attachments" (found), "stored" (new blobs written),
+            "bytes" (of the attachments found) and "failed" (emails that could not be read).
+
+        Raises:
+            OSError: If a blob cannot be written.
+            ValueError: If a segment path is found without `segments`, or a .zst file
+                without the zstandard package.
+        """
+        if paths is None:
+            paths = self._index.unextracted()
+        blob_dir = os.path.join(self._path, "attachments")
+        spool_dir = os.path.join(self._path, ".tmp")
+        os.makedirs(spool_dir, exist_ok=True)
+        totals = {"emails": 0, "attachments": 0, "stored": 0, "bytes": 0, "failed": 0}
+        written = set()  # two processes may both write the same new blob
+        executor = None
+        if self._jobs > 1 and len(paths) > 1:
+            executor = concurrent.futures.ProcessPoolExecutor(self._jobs)
+        try:
+            for start in range(0, len(paths), self._batch_size):
+                batch = paths[start:start + self._batch_size]
+                tasks = [(self._task(path), blob_dir, spool_dir) for path in batch]
+                if executor is not None:
+                    chunk = max(1, len(tasks) // (self._jobs * 4))
+                    found = list(executor.map(AttachmentStore._extract, tasks, chunksize=chunk))
+                else:
+                    found = [AttachmentStore._extract(task) for task in tasks]
+                results = []
+                for path, parts in zip(batch, found):
+                    if parts is None:
+                        totals["failed"] += 1
+                        continue
+                    results.append((path, [part[:5] for part in parts]))
+                    totals["emails"] += 1
+                    totals["attachments"] += len(parts)
+                    written.update(part[4] for part in parts if part[5])
+                    totals["bytes"] += sum(part[3] for part in parts)
+                if self._index is not None:
+                    self._index.add_parts(results)
+        finally:
+            if executor is not None:
+                executor.shutdown()
+        totals["stored"] = len(written)
+        Metrics.shared().inc("emailsafe_attachments_total", totals["attachments"])
+        Metrics.shared().inc("emailsafe_attachment_blobs_total", totals["stored"])
+        return totals
+
+    def _task(self, path):
+        """
+        Describes how to read a stored email, for a parsing process.
+
+        Args:
+            path (str): The stored path, a file or "<segment>#<key>".
+
+        Returns:
+            tuple: (file name, offset, length or None, dictionary directory).
+
+        Raises:
+            ValueError: If the path is a segment record and no segment archive was given.
+        """
+        if "#" in path:
+            if self._segments is None:
+                raise ValueError("extracting from a segment backup needs the segment archive")
+            location = self._segments.location(path.rsplit("#", 1)[1])
+            if location is None:
+                return path, 0, None, None  # unknown record, reported failed
+            return location + (None,)
+        return path, 0, None, self._dictionary_dir
+
+    @staticmethod
+    def _read(task):
+        """
+        Reads a stored email. Runs in a parsing process.
+
+        Args:
+            task (tuple): (file name, offset, length or None for the whole file, dictionary
+                directory), as built by `_task()`.
+
+        Returns:
+            bytes: The raw email.
+
+        Raises:
+            OSError: If the file cannot be read.
+        """
+        file_name, offset, length, dictionary_dir = task
+        if file_name.endswith((".gz", ".zst")):
+            codec = "gzip" if file_name.endswith(".gz") else "zstd"
+            key = (dictionary_dir, codec)
+            if key not in AttachmentStore._readers:
+                AttachmentStore._readers[key] = CompressedStorage(os.path.dirname(file_name), codec=codec,
+                                                                  dictionary_dir=dictionary_dir)
+            return AttachmentStore._readers[key].read(file_name)
+        with open(file_name, "rb") as stored_file:
+            stored_file.seek(offset)
+            return stored_file.read() if length is None else stored_file.read(length)
+
+    @staticmethod
+    def _extract(task):
+        """
+        Parses a stored email and writes its attachments to the blob store. Runs in a
+        parsing process.
+
+        Args:
+            task (tuple): (read task, blob directory, spool directory).
+
+        Returns:
+            list: One (part number, content type, filename, size, SHA-256, new blob) tuple per
+            attachment, or None if the email cannot be read or parsed.
+
+        Raises:
+            OSError: If a blob cannot be written.
+        """
+        read_task, blob_dir, spool_dir = task
+        try:
+            message = email.message_from_bytes(AttachmentStore._read(read_task), policy=email.policy.default)
+        except OSError:
+            return None
+        parts = []
+        try:
+            for number, part in enumerate(message.walk()):
+                if part.is_multipart():
+                    continue
+                filename = part.get_filename()
+                if filename is None and part.get_content_disposition() != "attachment":
+                    continue
+                payload = part.get_payload(decode=True) or b""
+                digest = hashlib.sha256(payload).hexdigest()
+                stored = AttachmentStore._write_blob(blob_dir, spool_dir, digest, payload)
+                parts.append((number, part.get_content_type(), filename, len(payload), digest, stored))
+        except (ValueError, LookupError):
+            return None  # malformed headers or an unknown charset
+        return parts
+
+    @staticmethod
+    def _write_blob(blob_dir, spool_dir, digest, payload):
+        """
+        Writes a blob unless it is already stored.
+
+        The blob is written to a temporary file and renamed into place, so two processes
+        storing the same attachment, or an interrupted write, never leave a partial blob.
+
+        Args:
+            blob_dir (str): The blob directory.
+            spool_dir (str): The directory of the temporary files.
+            digest (str): The SHA-256 hex digest of the payload.
+            payload (bytes): The decoded attachment.
+
+        Returns:
+            bool: True if the blob was written, False if it was already stored.
+        """
+        blob_path = AttachmentStore._blob_path(blob_dir, digest)
+        if os.path.isfile(blob_path):
+            return False
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        fd, temp_name = tempfile.mkstemp(dir=spool_dir, suffix=".part")
+        with os.fdopen(fd, "wb") as blob_file:
+            blob_file.write(payload)
+        os.replace(temp_name, blob_path)
+        return True
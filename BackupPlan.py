@@ -0,0 +1,79 @@
+from EmlStorage import EmlStorage
+from UidSet import UidSet
+
+
+class BackupPlan:
+    """
+    Decides which emails of a mailbox have to be downloaded, before any body is fetched.
+
+    The plan runs a header-only prefetch (`fetch_headers()`) over the candidate UIDs and asks
+    the storage backend whether each email is already stored. Only the missing emails are
+    kept, and their server-reported sizes are added up, so the total number of bytes to
+    transfer is known up front and progress and ETA can be reported accurately. With a
+    SearchFilter, the emails whose headers do not match it are left out too, before their
+    bodies are downloaded.
+
+    The missing UIDs are kept as ranges in a UidSet and only the total size is kept, so the
+    plan of a first backup of millions of emails stays a few bytes per gap in the mailbox.
+
+    Attributes:
+        missing (UidSet): The UIDs to download, in ascending order.
+        total_bytes (int): The total size of the missing emails.
+        stored (int): The number of candidate emails already stored.
+        filtered (int): The number of candidate emails left out by the search filter.
+
+    Usage:
+        plan = BackupPlan.build(imap, imap.fetch_emails(), EmlStorage())
+        print(f"{len(plan.missing)} emails to download, {plan.total_bytes} bytes")
+        for email_obj in imap.fetch_batch(plan.missing):
+            ...
+    """
+
+    def __init__(self):
+        """
+        Initializes an empty BackupPlan object.
+        """
+        self.missing = UidSet()
+        self.total_bytes = 0
+        self.stored = 0
+        self.filtered = 0
+
+    @classmethod
+    def build(cls, client, email_ids, storage=None, search_filter=None):
+        """
+        Builds the plan for a list of candidate UIDs.
+
+        Args:
+            client (EmailClient): A connected client providing `fetch_headers()`.
+            email_ids (iterable): The candidate UIDs.
+            storage (EmailStorage): The storage backend to check. Default is a new EmlStorage.
+            search_filter (SearchFilter): Checks the sender and size of each email. Default is None.
+
+        Returns:
+            BackupPlan: The plan.
+
+        Raises:
+            ConnectionError: If the header prefetch fails.
+        """
+        if storage is None:
+            storage = EmlStorage()
+        plan = cls()
+        for email_obj in client.fetch_headers(email_ids):
+            if search_filter is not None and not search_filter.matches(email_obj):
+                plan.filtered += 1
+            elif storage.contains(email_obj):
+                plan.stored += 1
+            else:
+                plan.add(email_obj.uid, email_obj.size or 0)
+        return plan
+
+    def add(self, uid, size):
+        """
+        Adds an email to download.
+
+        Args:
+            uid (int): The UID of the email.
+            size (int): The size of the email in bytes.
+        """
+        self.missing.add(uid)
+        self.total_bytes += size
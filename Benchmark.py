@@ -0,0 +1,273 @@
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from CompressedStorage import CompressedStorage
+from EmlStorage import EmlStorage
+from FakeImapServer import FakeImapServer
+from HashStorage import HashStorage
+from Imap import Imap
+from MailIndex import MailIndex
+from RateLimiter import RateLimiter
+from SegmentStorage import SegmentStorage
+from SyncState import SyncState
+
+try:
+    import resource
+except ImportError:  # not available on Windows, peak RSS is then not reported
+    resource = None
+
+
+class _TimedStorage:
+    """
+    Wraps a storage backend to record when each email becomes durable (after its flush).
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._pending = []
+        self.saved = {}
+
+    def __getattr__(self, name):
+        return getattr(self._storage, name)
+
+    def save_email(self, email):
+        self._storage.save_email(email)
+        self._pending.append(int(email.uid))
+
+    def flush(self):
+        self._storage.flush()
+        now = time.perf_counter()
+        for uid in self._pending:
+            self.saved[uid] = now
+        self._pending = []
+
+
+class Benchmark:
+    """
+    Measures a full backup run against a local FakeImapServer.
+
+    `run()` starts a fake server with a synthetic mailbox, backs it up into a temporary
+    directory with the given backup function (normally `fetch_inbox`) and the chosen storage
+    backend, exactly as the command line does, and measures:
+
+    - messages/s and MB/s over the whole run, planning pass included;
+    - the per-message latency, from the moment the server sends a message to the moment it
+      is flushed to disk, as p50 and p99;
+    - the peak resident memory of the process.
+
+    The result is a flat dict that serializes to JSON, so runs can be recorded and compared
+    from one release to the next. Peak RSS is a process-wide high-water mark: run one
+    benchmark per process to compare it.
+
+    Attributes:
+        messages (int): Number of messages in the mailbox.
+        options (dict): The benchmark settings, copied into each result.
+
+    Usage:
+        result = Benchmark(messages=10000, latency=0.005).run(fetch_inbox)
+        print(json.dumps(result))
+    """
+
+    storages = ("eml", "hash", "segment")
+
+    def __init__(self, messages=1000, **opt):
+        """
+        Initializes a Benchmark object.
+
+        Args:
+            messages (int): Number of messages in the mailbox. Default is 1000.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            distribution (str): Message size distribution, "fixed", "uniform" or "lognormal".
+                Default is "lognormal".
+            mean_size (int): Mean message size in bytes. Default is 20 KB.
+            latency (float): Simulated round trip per command, in seconds. Default is 0.
+            workers (int): Parallel IMAP sessions. Default is 1.
+            batch_size (int): Messages per FETCH command. Default is 100.
+            batch_bytes (int): Byte budget per FETCH command. Default is 20 MB.
+            sync_batch (int): Emails written between two flushes. Default is 100.
+            storage (str): "eml", "hash" or "segment". Default is "eml".
+            compress (str): "gzip" or "zstd" to compress .eml files. Default is None.
+            plan (bool): Run the header-only planning pass first. Default is True.
+            index (bool): Record the emails in the search index. Default is True.
+            quota (int): Bandwidth quota of the fake server in bytes per second, refused with
+                NO [THROTTLED] beyond. Default is None.
+            max_rate (float): Client rate limit in bytes per second. Default is None.
+            path (str): Where to write the backup; kept after the run. Default is a
+                temporary directory, removed after the run.
+            seed (int): Seed of the message sizes. Default is 0.
+
+        Raises:
+            ValueError: If the storage or the size distribution is unknown.
+        """
+        self.messages = messages
+        self.options = {
+            "distribution": opt.get('distribution', 'lognormal'),
+            "mean_size": opt.get('mean_size', 20 * 1024),
+            "latency": opt.get('latency', 0.0),
+            "workers": opt.get('workers', 1),
+            "batch_size": opt.get('batch_size', 100),
+            "batch_bytes": opt.get('batch_bytes', 20 * 1024 * 1024),
+            "sync_batch": opt.get('sync_batch', 100),
+            "storage": opt.get('storage', 'eml'),
+            "compress": opt.get('compress'),
+            "plan": opt.get('plan', True),
+            "index": opt.get('index', True),
+            "quota": opt.get('quota'),
+            "max_rate": opt.get('max_rate'),
+        }
+        if self.options["storage"] not in Benchmark.storages:
+            raise ValueError(f"unknown storage {self.options['storage']}")
+        if self.options["distribution"] not in FakeImapServer.distributions:
+            raise ValueError(f"unknown size distribution {self.options['distribution']}")
+        self._path = opt.get('path')
+        self._seed = opt.get('seed', 0)
+
+    def run(self, fetch):
+        """
+        Runs one backup of the synthetic mailbox and measures it.
+
+        Args:
+            fetch (callable): The backup function, called like `fetch_inbox(imap, state,
+                workers=..., factory=..., max_connections=..., plan=..., storage=...,
+                verbose=False, sync_batch=...)`; returns the number of emails saved.
+
+        Returns:
+            dict: "messages", "bytes", "seconds", "messages_per_sec", "mb_per_sec",
+            "latency_p50_ms", "latency_p99_ms", "peak_rss_mb", "commands" (IMAP commands
+            sent) and "throttled" (commands refused by the quota), followed by the benchmark
+            settings and the Python version.
+
+        Raises:
+            ConnectionError: If the client fails to talk to the fake server.
+            OSError: If the backup cannot be written.
+        """
+        options = self.options
+        root = self._path or tempfile.mkdtemp(prefix="imap-benchmark-")
+        server = FakeImapServer({"INBOX": self.messages}, distribution=options["distribution"],
+                                mean_size=options["mean_size"], latency=options["latency"], seed=self._seed,
+                                quota=options["quota"])
+        index = None
+        storage = None
+        try:
+            host, port = server.start()
+            client_options = {"batch_size": options["batch_size"], "max_bytes": options["batch_bytes"],
+                              "rate_limiter": RateLimiter(options["max_rate"])}
+
+            def factory():
+                session = Imap(host, port, "benchmark", "benchmark", **client_options)
+                session.connect("INBOX")
+                return session
+
+            imap = factory()
+            if options["index"]:
+                index = MailIndex(os.path.join(root, "index.sqlite"))
+            storage = _TimedStorage(self._storage(root, imap, index))
+            state = SyncState("benchmark", imap.mailbox, storage.path_backup)
+
+            start = time.perf_counter()
+            count = fetch(imap, state, workers=options["workers"], factory=factory,
+                          max_connections=options["workers"] + 1, plan=options["plan"], storage=storage,
+                          verbose=False, sync_batch=options["sync_batch"])
+            seconds = time.perf_counter() - start
+            imap.close()
+        finally:
+            if storage is not None and hasattr(storage, "close"):
+                storage.close()
+            if index is not None:
+                index.close()
+            server.stop()
+            if self._path is None:
+                shutil.rmtree(root, ignore_errors=True)
+
+        latencies = [saved - server.sent[("INBOX", uid)] for uid, saved in storage.saved.items()
+                     if ("INBOX", uid) in server.sent]
+        total_bytes = sum(server.size("INBOX", uid) for uid in storage.saved)
+        peak_rss = Benchmark.peak_rss()
+        return {
+            "messages": count,
+            "bytes": total_bytes,
+            "seconds": round(seconds, 4),
+            "messages_per_sec": round(count / seconds, 1) if seconds else 0.0,
+            "mb_per_sec": round(total_bytes / seconds / (1024 * 1024), 2) if seconds else 0.0,
+            "latency_p50_ms": Benchmark._milliseconds(Benchmark.percentile(latencies, 50)),
+            "latency_p99_ms": Benchmark._milliseconds(Benchmark.percentile(latencies, 99)),
+            "peak_rss_mb": round(peak_rss / (1024 * 1024), 1) if peak_rss is not None else None,
+            "commands": server.commands,
+            "throttled": server.throttled,
+            "mailbox_messages": self.messages,
+            **options,
+            "python": platform.python_version(),
+        }
+
+    def _storage(self, root, imap, index):
+        """
+        Creates the storage backend under test, as the command line does.
+
+        Args:
+            root (str): The benchmark directory.
+            imap (Imap): The connected client.
+            index (MailIndex): The search index, or None.
+
+        Returns:
+            EmailStorage: The storage backend.
+        """
+        kind = self.options["storage"]
+        if kind == "hash":
+            return HashStorage(os.path.join(root, "store"), imap.mailbox, imap.uidvalidity, index=index)
+        if kind == "segment":
+            return SegmentStorage(os.path.join(root, "segments"), imap.mailbox, index=index,
+                                  uidvalidity=imap.uidvalidity)
+        if self.options["compress"]:
+            return CompressedStorage(os.path.join(root, "mail"), imap.mailbox, index, codec=self.options["compress"],
+                                     uidvalidity=imap.uidvalidity)
+        return EmlStorage(os.path.join(root, "mail"), imap.mailbox, index, uidvalidity=imap.uidvalidity)
+
+    @staticmethod
+    def percentile(values, pct):
+        """
+        Returns a percentile of a list of values, by the nearest-rank method.
+
+        Args:
+            values (list): The values.
+            pct (float): The percentile, between 0 and 100.
+
+        Returns:
+            float: The value at that percentile, or None if there are no values.
+        """
+        if not values:
+            return None
+        ordered = sorted(values)
+        return ordered[max(1, math.ceil(pct / 100 * len(ordered))) - 1]
+
+    @staticmethod
+    def peak_rss():
+        """
+        Returns the peak resident memory of the process.
+
+        Returns:
+            int: The peak RSS in bytes, or None if the platform does not report it.
+        """
+        if resource is None:
+            return None
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # kilobytes on Linux, bytes on macOS
+        return peak if sys.platform == "darwin" else peak * 1024
+
+    @staticmethod
+    def _milliseconds(seconds):
+        """
+        Converts a duration to rounded milliseconds.
+
+        Args:
+            seconds (float): The duration, or None.
+
+        Returns:
+            float: The duration in milliseconds, or None.
+        """
+        return round(seconds * 1000, 3) if seconds is not None else None
@@ -0,0 +1,318 @@
+from EmlStorage import EmlStorage
+from Email import Email
+import gzip
+import os
+import shutil
+import tempfile
+import time
+
+try:
+    import zstandard
+except ImportError:  # zstd is optional, gzip is always available
+    zstandard = None
+
+
+class CompressedStorage(EmlStorage):
+    """
+    Implementation of EmailStorage that saves emails as compressed .eml.gz or .eml.zst files.
+
+    Files are named like those of EmlStorage, with the codec extension added. MIME text and
+    base64 compress well, so the backup typically takes 3 to 5 times less disk, and copies to
+    cold storage move less data.
+
+    With zstd (needs the `zstandard` package), a dictionary is trained on the first small
+    emails of the run and used for the small emails after it, which compress poorly on their
+    own. Dictionaries are kept in `dictionary_dir` under their zstd dictionary ID, which is
+    recorded in each compressed frame, so `read()` always finds the right one.
+
+    The CPU time spent compressing and the bytes before and after compression are counted
+    in `stats()`.
+
+    Attributes:
+        codec (str): "gzip" or "zstd".
+        level (int): The compression level.
+        _dictionary (ZstdCompressionDict): The dictionary used for small emails, or None.
+        _samples (list): Small emails collected to train the dictionary.
+        _stats (dict): The counters returned by `stats()`.
+
+    Usage:
+        storage = CompressedStorage("mail", codec="zstd", level=9)
+        storage.save_email(email_obj)
+        raw = storage.read(storage.file_name)
+        print(storage.stats())
+    """
+
+    extensions = {"gzip": ".gz", "zstd": ".zst"}
+
+    def __init__(self, path_backup="mail", mailbox="INBOX", index=None, codec="gzip", level=None, **opt):
+        """
+        Initializes a CompressedStorage object.
+
+        Args:
+            path_backup (str): The directory the files are written to. Default is "mail".
+            mailbox (str): The mailbox the saved emails come from. Default is "INBOX".
+            index (MailIndex): The metadata index to update for each saved email. Default is None.
+            codec (str): "gzip" or "zstd". Default is "gzip".
+            level (int): The compression level. Default is 6 for gzip and 3 for zstd.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            dictionary_dir (str): Where zstd dictionaries are kept. Default is `path_backup`/.dict.
+            uidvalidity (int): The UIDVALIDITY of the mailbox, recorded in the index. Default is None.
+            small_size (int): Emails up to this size use the dictionary. Default is 16 KB.
+            train_samples (int): Number of small emails to train the dictionary on. Default is 1000.
+            dictionary_size (int): Maximum dictionary size in bytes. Default is 110 KB.
+
+        Raises:
+            ValueError: If the codec is unknown, or zstd is requested without the zstandard package.
+        """
+        super().__init__(path_backup, mailbox, index, opt.get('uidvalidity'))
+        if codec not in CompressedStorage.extensions:
+            raise ValueError(f"unknown compression {codec}")
+        if codec == "zstd" and zstandard is None:
+            raise ValueError("zstd compression needs the zstandard package")
+        self.codec = codec
+        self.level = level if level is not None else (3 if codec == "zstd" else 6)
+        self._dictionary_dir = opt.get('dictionary_dir') or os.path.join(path_backup, ".dict")
+        self._small_size = opt.get('small_size', 16 * 1024)
+        self._train_samples = opt.get('train_samples', 1000)
+        self._dictionary_size = opt.get('dictionary_size', 110 * 1024)
+        self._dictionary = None
+        self._dictionaries = {}
+        self._samples = []
+        self._stats = {"emails": 0, "raw_bytes": 0, "stored_bytes": 0, "cpu_seconds": 0.0}
+        if codec == "zstd":
+            self._load_dictionary()
+
+    def compressed_name(self, email):
+        """
+        Generate the file name of the compressed email.
+
+        Args:
+            email (Email): The email object.
+
+        Returns:
+            str: The file name, e.g. "{cleaned_sender}_{cleaned_subject}.eml.zst".
+        """
+        return EmlStorage.filename(self.path_backup, email) + CompressedStorage.extensions[self.codec]
+
+    def _name(self, email):
+        """
+        Generate the file name of the email in this backup.
+
+        Args:
+            email (Email): The email object.
+
+        Returns:
+            str: The compressed file name.
+        """
+        return self.compressed_name(email)
+
+    def save_email(self, email):
+        """
+        Compress the email and save it.
+
+        The compressed data is written to a temporary file which is renamed into place, so a
+        partial write never looks like a stored email. An email streamed to disk (its `path`
+        is set) is compressed from its file, which is then removed.
+
+        Args:
+            email (Email): The email object to be saved.
+
+        Raises:
+            OSError: If there's an error during the directory creation or file writing process.
+        """
+        try:
+            os.makedirs(self.path_backup, exist_ok=True)
+            self.file_name = self._prepared_name(email)
+            if not self.file_exists():
+                self._write(email)
+            if self.index is not None:
+                self.index.add(email, self.file_name, self.mailbox, self.uidvalidity)
+            if email.path is not None:
+                os.remove(email.path)
+                email.path = None
+        except OSError as e:
+            raise OSError()
+
+    def _write(self, email):
+        """
+        Writes the compressed email to `file_name`, counting the CPU time spent.
+
+        Args:
+            email (Email): The email object to be saved.
+        """
+        start = time.thread_time()
+        size = email.size or 0
+        fd, temp_name = tempfile.mkstemp(dir=self.spool_dir(), suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as out_file:
+                if email.path is not None and (self.codec == "gzip" or size > self._small_size):
+                    with open(email.path, "rb") as eml_file:
+                        self._compress_stream(eml_file, out_file)
+                else:
+                    out_file.write(self._compress(email.raw_bytes))
+            os.replace(temp_name, self.file_name)
+            self._unsynced.add(self.file_name)
+        except BaseException:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+            raise
+        self._stats["emails"] += 1
+        self._stats["raw_bytes"] += size
+        self._stats["stored_bytes"] += os.path.getsize(self.file_name)
+        self._stats["cpu_seconds"] += time.thread_time() - start
+
+    def _compress(self, data):
+        """
+        Compresses an email held in memory; small emails use the zstd dictionary.
+
+        Args:
+            data (bytes): The raw email.
+
+        Returns:
+            bytes: The compressed data.
+        """
+        if self.codec == "gzip":
+            return gzip.compress(data, compresslevel=self.level, mtime=0)
+        if len(data) <= self._small_size:
+            if self._dictionary is None:
+                self._samples.append(data)
+                if len(self._samples) >= self._train_samples:
+                    self.train_dictionary(self._samples)
+                    self._samples = []
+            if self._dictionary is not None:
+                return zstandard.ZstdCompressor(level=self.level, dict_data=self._dictionary).compress(data)
+        return zstandard.ZstdCompressor(level=self.level).compress(data)
+
+    def _compress_stream(self, eml_file, out_file):
+        """
+        Compresses an email file in chunks, without loading it in memory.
+
+        Args:
+            eml_file (file): The raw email, opened in binary mode.
+            out_file (file): The destination, opened in binary mode.
+        """
+        if self.codec == "gzip":
+            with gzip.GzipFile(fileobj=out_file, mode="wb", compresslevel=self.level, mtime=0) as gzip_file:
+                shutil.copyfileobj(eml_file, gzip_file, 1024 * 1024)
+        else:
+            zstandard.ZstdCompressor(level=self.level).copy_stream(eml_file, out_file)
+
+    def train_dictionary(self, samples):
+        """
+        Trains a zstd dictionary on sample emails and uses it for the next small emails.
+
+        The dictionary is saved as `<dictionary_dir>/<dictionary ID>.zdict`.
+
+        Args:
+            samples (list): Raw emails (bytes) to train on.
+
+        Returns:
+            int: The dictionary ID, or None if zstd could not train a dictionary from the samples.
+        """
+        try:
+            dictionary = zstandard.train_dictionary(self._dictionary_size, samples)
+        except zstandard.ZstdError:
+            return None
+        os.makedirs(self._dictionary_dir, exist_ok=True)
+        file_name = os.path.join(self._dictionary_dir, f"{dictionary.dict_id()}.zdict")
+        temp_name = file_name + ".tmp"
+        with open(temp_name, "wb") as dictionary_file:
+            dictionary_file.write(dictionary.as_bytes())
+        os.replace(temp_name, file_name)
+        self._dictionary = dictionary
+        self._dictionaries[dictionary.dict_id()] = dictionary
+        return dictionary.dict_id()
+
+    def _load_dictionary(self):
+        """
+        Loads the most recent dictionary of a previous run, if any.
+        """
+        try:
+            names = [name for name in os.listdir(self._dictionary_dir) if name.endswith(".zdict")]
+        except OSError:
+            return
+        if names:
+            newest = max(names, key=lambda name: os.path.getmtime(os.path.join(self._dictionary_dir, name)))
+            self._dictionary = self._dictionary_for(int(newest[:-len(".zdict")]))
+
+    def _dictionary_for(self, dict_id):
+        """
+        Returns the dictionary with the given ID, loading it from `dictionary_dir` if needed.
+
+        Args:
+            dict_id (int): The zstd dictionary ID.
+
+        Returns:
+            ZstdCompressionDict: The dictionary.
+
+        Raises:
+            OSError: If the dictionary file is missing.
+        """
+        if dict_id not in self._dictionaries:
+            with open(os.path.join(self._dictionary_dir, f"{dict_id}.zdict"), "rb") as dictionary_file:
+                self._dictionaries[dict_id] = zstandard.ZstdCompressionDict(dictionary_file.read())
+        return self._dictionaries[dict_id]
+
+    def read(self, file_name):
+        """
+        Reads a saved email back, decompressing it if needed.
+
+        Plain .eml files are returned as they are, so the same call works on any backup.
+
+        Args:
+            file_name (str): The .eml, .eml.gz or .eml.zst file.
+
+        Returns:
+            bytes: The raw email.
+
+        Raises:
+            OSError: If the file (or its zstd dictionary) cannot be read.
+            ValueError: If the file is a .zst file and the zstandard package is missing.
+        """
+        with open(file_name, "rb") as eml_file:
+            data = eml_file.read()
+        if file_name.endswith(".gz"):
+            return gzip.decompress(data)
+        if file_name.endswith(".zst"):
+            if zstandard is None:
+                raise ValueError("reading .zst files needs the zstandard package")
+            dict_id = zstandard.get_frame_parameters(data).dict_id
+            dictionary = self._dictionary_for(dict_id) if dict_id else None
+            return zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj().decompress(data)
+        return data
+
+    def read_email(self, file_name):
+        """
+        Reads a saved email back as an Email object.
+
+        Args:
+            file_name (str): The .eml, .eml.gz or .eml.zst file.
+
+        Returns:
+            Email: The email object.
+        """
+        return Email(self.read(file_name))
+
+    def contains(self, email):
+        """
+        Checks whether the email is already stored, compressed or as a plain .eml file.
+
+        Args:
+            email (Email): The email object.
+
+        Returns:
+            bool: True if the email is already stored, False otherwise.
+        """
+        return os.path.isfile(self.compressed_name(email)) or super().contains(email)
+
+    def stats(self):
+        """
+        Reports the compression work of the run.
+
+        Returns:
+            dict: "emails" compressed, "raw_bytes" and "stored_bytes" before and after
+            compression, and "cpu_seconds" spent compressing.
+        """
+        return dict(self._stats)
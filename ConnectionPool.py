@@ -0,0 +1,270 @@
+import contextlib
+import random
+import threading
+import time
+from Metrics import Metrics
+
+
+class ConnectionPool:
+    """
+    Pool of authenticated IMAP sessions, reused across mailboxes.
+
+    Opening a session costs a TCP connection, a TLS handshake and a LOGIN, often more than a
+    second on a remote server. The pool keeps the sessions its callers release and hands them
+    out again, selecting the requested mailbox with a simple SELECT, so a backup opens each
+    session once for all its folders and retries.
+
+    - A session idle for longer than `idle_timeout` is checked with NOOP before it is reused;
+      a dead one is dropped and replaced.
+    - New sessions are opened with up to `retries` retries, waiting a random time between 0
+      and an exponentially growing delay (full jitter), so sessions dropped at the same time
+      do not reconnect in lockstep.
+    - At most `max_size` sessions are open at once, which keeps the account under the server
+      connection limit; `acquire()` waits for a free session beyond that.
+
+    Attributes:
+        _factory (callable): Returns a new, connected EmailClient.
+        _max_size (int): Maximum number of open sessions, idle or in use.
+        _idle (list): The idle sessions with the time they were released, most recent last.
+        _in_use (set): The sessions handed out and not released yet.
+        created (int): Number of sessions opened.
+        reused (int): Number of times an idle session was handed out again.
+
+    Usage:
+        pool = ConnectionPool(factory, max_size=4)
+        with pool.session("Sent") as imap:
+            email_ids = imap.fetch_emails()
+        pool.close()
+    """
+
+    def __init__(self, factory, **opt):
+        """
+        Initializes a ConnectionPool object.
+
+        Args:
+            factory (callable): Called with no argument, returns a connected EmailClient.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            max_size (int): Maximum number of open sessions. Default is 10.
+            idle_timeout (float): Seconds after which an idle session is checked with NOOP
+                before reuse. Default is 30.
+            retries (int): Retries when opening a session fails. Default is 3.
+            backoff (float): First retry delay bound in seconds, doubled at each retry. Default is 1.
+            max_backoff (float): Maximum retry delay bound in seconds. Default is 30.
+        """
+        self._factory = factory
+        self._max_size = max(1, opt.get('max_size', 10))
+        self._idle_timeout = opt.get('idle_timeout', 30)
+        self._retries = opt.get('retries', 3)
+        self._backoff = opt.get('backoff', 1)
+        self._max_backoff = opt.get('max_backoff', 30)
+        self._idle = []
+        self._in_use = set()
+        self._size = 0
+        self._condition = threading.Condition()
+        self.created = 0
+        self.reused = 0
+
+    @property
+    def max_size(self):
+        """
+        int: The maximum number of open sessions.
+        """
+        return self._max_size
+
+    def acquire(self, mailbox=None, timeout=30):
+        """
+        Hands out a session, reusing an idle one when possible.
+
+        Args:
+            mailbox (str): The mailbox to select, or None to keep the current one. Default is None.
+            timeout (float): Seconds to wait for a session when `max_size` are in use, or
+                None to wait forever. Default is 30.
+
+        Returns:
+            EmailClient: A connected session, with `mailbox` selected.
+
+        Raises:
+            ConnectionError: If no session is free in time, a new session cannot be opened,
+                or the mailbox cannot be selected.
+        """
+        while True:
+            client, idle_since = self._take(timeout)
+            if client is None:
+                try:
+                    client = self._create()
+                except ConnectionError:
+                    self._forget()
+                    raise
+                reused = False
+            elif time.monotonic() - idle_since > self._idle_timeout and not client.noop():
+                self._close(client)  # dropped by the server while idle
+                continue
+            else:
+                reused = True
+                with self._condition:
+                    self.reused += 1
+            with self._condition:
+                self._in_use.add(client)
+            try:
+                if mailbox is not None and client.mailbox != mailbox:
+                    client.select(mailbox)
+            except ConnectionError:
+                self.discard(client)
+                if reused:
+                    continue  # the session may have been dead, try a fresh one
+                raise
+            return client
+
+    def _take(self, timeout):
+        """
+        Takes the most recently released idle session, or a slot for a new one.
+
+        Args:
+            timeout (float): Seconds to wait, or None to wait forever.
+
+        Returns:
+            tuple: (client, idle since) for an idle session, (None, None) for a new slot.
+
+        Raises:
+            ConnectionError: If no session is free in time.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self._max_size:
+                    self._size += 1
+                    return None, None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise ConnectionError(f"all {self._max_size} sessions are in use")
+                self._condition.wait(remaining)
+
+    def _create(self):
+        """
+        Opens a new session, retrying with jittered exponential backoff.
+
+        Returns:
+            EmailClient: The connected client.
+
+        Raises:
+            ConnectionError: If every attempt failed.
+        """
+        for attempt in range(self._retries + 1):
+            try:
+                client = self._factory()
+            except ConnectionError:
+                if attempt == self._retries:
+                    raise
+                time.sleep(ConnectionPool.backoff(attempt, self._backoff, self._max_backoff))
+                continue
+            with self._condition:
+                self.created += 1
+            Metrics.shared().inc("emailsafe_sessions_opened_total")
+            return client
+
+    def release(self, client, broken=False):
+        """
+        Gives a session back to the pool.
+
+        Args:
+            client (EmailClient): The session, as returned by `acquire()`.
+            broken (bool): True if the session failed; it is closed instead of reused. Default is False.
+        """
+        with self._condition:
+            if client not in self._in_use:
+                return  # already released or discarded
+            if not broken and client.is_connected():
+                self._in_use.discard(client)
+                self._idle.append((client, time.monotonic()))
+                self._condition.notify()
+                return
+        self.discard(client)
+
+    def discard(self, client):
+        """
+        Closes a session taken from the pool and frees its slot. Discarding a session twice
+        does nothing.
+
+        Args:
+            client (EmailClient): The session.
+        """
+        with self._condition:
+            if client not in self._in_use:
+                return
+            self._in_use.discard(client)
+        self._close(client)
+
+    def _close(self, client):
+        """
+        Logs out of a session that left the pool and frees its slot.
+
+        Args:
+            client (EmailClient): The session.
+        """
+        try:
+            if client.is_connected():
+                client.close()
+        except Exception:
+            pass  # the session is dead already
+        self._forget()
+
+    def _forget(self):
+        """
+        Frees the slot of a session that is gone.
+        """
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    @contextlib.contextmanager
+    def session(self, mailbox=None):
+        """
+        Borrows a session for a block; it is released at the end, or discarded on ConnectionError.
+
+        Args:
+            mailbox (str): The mailbox to select. Default is None.
+
+        Yields:
+            EmailClient: The session.
+        """
+        client = self.acquire(mailbox)
+        try:
+            yield client
+        except ConnectionError:
+            self.release(client, broken=True)
+            raise
+        except BaseException:
+            self.release(client)
+            raise
+        else:
+            self.release(client)
+
+    def close(self):
+        """
+        Logs out of the idle sessions. Sessions still in use are closed by `release()` or
+        `discard()` as usual.
+        """
+        with self._condition:
+            idle = [client for client, _ in self._idle]
+            self._idle = []
+        for client in idle:
+            self._close(client)
+
+    @staticmethod
+    def backoff(attempt, base=1, cap=30):
+        """
+        Returns the delay before a retry, with full jitter.
+
+        Args:
+            attempt (int): The number of failed attempts before this one, from 0.
+            base (float): The delay bound of the first retry in seconds. Default is 1.
+            cap (float): The maximum delay bound in seconds. Default is 30.
+
+        Returns:
+            float: A random delay between 0 and min(cap, base * 2 ** attempt).
+        """
+        return random.uniform(0, min(cap, base * 2 ** attempt))
@@ -0,0 +1,354 @@
+import itertools
+import queue
+import threading
+import time
+from ConnectionPool import ConnectionPool
+from EmlStorage import EmlStorage
+
+
+class Downloader:
+    """
+    Parallel download engine that fetches emails over several IMAP sessions.
+
+    The UIDs are cut into chunks which are handed out, in order, to a pool of worker threads.
+    The chunks are cut as the workers ask for them, so a compact list of UIDs such as a
+    `UidSet` is never expanded as a whole.
+    Each worker owns one client session and downloads its chunks with `fetch_batch()`.
+    Fetched emails go through a bounded queue to a single writer thread which saves them to
+    the storage backend. The writer saves the chunks in their original order, so the files
+    written are the same as with the sequential path, even when two emails get the same name.
+    The storage is flushed every `sync_batch` emails, and emails are reported to `on_saved`
+    once their batch is flushed.
+
+    A worker that loses its connection reconnects and resumes its chunk with the emails not
+    yet delivered. If the server refuses extra sessions (connection limit), the worker quits
+    and leaves the remaining chunks to the sessions that did connect.
+
+    Attributes:
+        _factory (callable): Returns a new, connected EmailClient for the mailbox.
+        _storage (EmailStorage): The storage backend emails are saved to.
+        _workers (int): Number of sessions, capped by the connection limit.
+        _chunk_size (int): Number of UIDs per chunk.
+        _retries (int): Reconnect attempts per chunk before giving up.
+
+    Usage:
+        downloader = Downloader(factory, workers=8)
+        count = downloader.run(email_ids, on_saved=lambda email_obj: state.commit(email_obj.uid))
+    """
+
+    def __init__(self, factory, storage=None, **opt):
+        """
+        Initializes a Downloader object.
+
+        Args:
+            factory (callable): Called with no argument, returns a connected EmailClient.
+            storage (EmailStorage): The storage backend. Default is a new EmlStorage.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            workers (int): Number of parallel sessions. Default is 4.
+            max_connections (int): Server connection limit, caps `workers`. Default is 10.
+            chunk_size (int): Number of UIDs per chunk. Default is 100.
+            queue_size (int): Maximum number of emails waiting for the writer. Default is 200.
+            retries (int): Reconnect attempts per chunk. Default is 3.
+            spool_dir (str): Stream the emails to this directory with `fetch_batch_to_files()`
+                instead of holding them in memory. Default is None.
+            sizes (dict): Known RFC822.SIZE per integer UID, passed on to the clients. Default is None.
+            sync_batch (int): Number of emails saved between two flushes of the storage. Default is 100.
+            release (callable): Called with a session and whether it failed, to hand it back
+                instead of logging out, e.g. `ConnectionPool.release`. Default is None.
+        """
+        self._factory = factory
+        self._storage = storage if storage is not None else EmlStorage()
+        self._workers = max(1, min(opt.get('workers', 4), opt.get('max_connections', 10)))
+        self._chunk_size = opt.get('chunk_size', 100)
+        self._queue_size = opt.get('queue_size', 200)
+        self._retries = opt.get('retries', 3)
+        self._spool_dir = opt.get('spool_dir')
+        self._sizes = opt.get('sizes')
+        self._sync_batch = max(1, opt.get('sync_batch', 100))
+        self._release_session = opt.get('release')
+        self._unsynced = []
+
+        self._chunks = None
+        self._results = None
+        self._stop = threading.Event()
+        self._errors = []
+        self._lock = threading.Lock()
+        self._connected = 0
+        self._alive = 0
+
+    @property
+    def workers(self):
+        """
+        int: The number of sessions used, after applying the connection limit.
+        """
+        return self._workers
+
+    def run(self, email_ids, on_saved=None):
+        """
+        Downloads and saves the given emails.
+
+        Args:
+            email_ids (iterable): The UIDs to download.
+            on_saved (callable): Called with each Email after it has been saved and flushed. Default is None.
+
+        Returns:
+            int: The number of emails saved.
+
+        Raises:
+            ConnectionError: If no session could connect, or a chunk failed after all retries.
+            OSError: If the storage backend fails to save an email.
+        """
+        if not hasattr(email_ids, "__len__"):
+            email_ids = list(email_ids)
+        if not email_ids:
+            return 0
+        chunk_count = -(-len(email_ids) // self._chunk_size)
+        self._chunks = enumerate(Downloader._chunked(email_ids, self._chunk_size))
+        self._results = queue.Queue(maxsize=self._queue_size)
+        self._alive = self._workers
+
+        threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(self._workers)]
+        for thread in threads:
+            thread.start()
+        try:
+            saved = self._writer(chunk_count, on_saved)
+        except KeyboardInterrupt:
+            # the emails already saved still count, so an interrupted run resumes after them
+            self._sync(on_saved)
+            raise
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return saved
+
+    def _connect(self):
+        """
+        Opens a session, retrying with jittered exponential backoff.
+
+        Returns:
+            EmailClient: The connected client.
+
+        Raises:
+            ConnectionError: If every attempt failed.
+        """
+        for attempt in range(self._retries + 1):
+            try:
+                return self._factory()
+            except ConnectionError:
+                if attempt == self._retries or self._stop.is_set():
+                    raise
+                time.sleep(ConnectionPool.backoff(attempt))
+
+    def _release(self, client, broken=False):
+        """
+        Hands a session back through the `release` callable, or logs out of it.
+
+        Args:
+            client (EmailClient): The session.
+            broken (bool): True if the session failed. Default is False.
+        """
+        if self._release_session is not None:
+            self._release_session(client, broken)
+        elif client.is_connected():
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _worker(self):
+        """
+        Worker thread: takes chunks from the chunk queue and downloads them on its own session.
+        """
+        client = None
+        broken = False
+        try:
+            try:
+                client = self._connect()
+            except ConnectionError as e:
+                with self._lock:
+                    # a refused extra session is fine as long as another worker connected
+                    self._alive -= 1
+                    give_up = self._alive == 0 and self._connected == 0
+                if give_up:
+                    self._fail(e)
+                return
+            with self._lock:
+                self._connected += 1
+
+            while not self._stop.is_set():
+                with self._lock:
+                    item = next(self._chunks, None)
+                if item is None:
+                    break
+                index, chunk = item
+                client = self._fetch_chunk(client, index, chunk)
+                self._put((index, None))  # end of chunk marker
+        except Exception as e:
+            broken = True
+            self._fail(e)
+        finally:
+            if client is not None:
+                self._release(client, broken)
+
+    @staticmethod
+    def _chunked(email_ids, size):
+        """
+        Cuts the UIDs into lists of `size` UIDs, one at a time.
+
+        Args:
+            email_ids (iterable): The UIDs.
+            size (int): The number of UIDs per chunk.
+
+        Yields:
+            list: The UIDs of each chunk.
+        """
+        iterator = iter(email_ids)
+        while True:
+            chunk = list(itertools.islice(iterator, size))
+            if not chunk:
+                return
+            yield chunk
+
+    def _fetch_chunk(self, client, index, chunk):
+        """
+        Downloads one chunk, reconnecting and resuming if the session drops.
+
+        Args:
+            client (EmailClient): The worker session.
+            index (int): The chunk index.
+            chunk (list): The UIDs of the chunk.
+
+        Returns:
+            EmailClient: The session to use for the next chunk (a new one after a reconnect).
+
+        Raises:
+            ConnectionError: If the chunk still fails after all retries.
+        """
+        delivered = set()
+        for attempt in range(self._retries + 1):
+            remaining = [email_id for email_id in chunk if int(email_id) not in delivered]
+            try:
+                if self._spool_dir is not None:
+                    emails = client.fetch_batch_to_files(remaining, self._spool_dir, sizes=self._sizes)
+                else:
+                    emails = client.fetch_batch(remaining, sizes=self._sizes)
+                for email_obj in emails:
+                    self._put((index, email_obj))
+                    delivered.add(email_obj.uid)
+                return client
+            except ConnectionError:
+                if attempt == self._retries or self._stop.is_set():
+                    raise
+                self._release(client, broken=True)
+                client = self._connect()
+        return client
+
+    def _put(self, item):
+        """
+        Puts an item on the bounded result queue, giving up if the run is stopping.
+
+        Args:
+            item (tuple): A `(chunk index, Email or None)` pair.
+        """
+        while not self._stop.is_set():
+            try:
+                self._results.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _fail(self, error):
+        """
+        Records an error and stops the run.
+
+        Args:
+            error (Exception): The error to re-raise from `run()`.
+        """
+        with self._lock:
+            self._errors.append(error)
+        self._stop.set()
+        try:
+            self._results.put_nowait(None)
+        except queue.Full:
+            pass
+
+    def _writer(self, chunk_count, on_saved):
+        """
+        Writer stage: drains the result queue and saves the emails in chunk order.
+
+        Emails of the chunk being written are saved as soon as they arrive; emails of later
+        chunks are held until every earlier chunk is complete.
+
+        Args:
+            chunk_count (int): The number of chunks to expect.
+            on_saved (callable): Called with each Email after it has been saved.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        saved = 0
+        current = 0
+        pending = {}
+        finished = set()
+        while current < chunk_count:
+            if self._stop.is_set() and self._results.empty():
+                break
+            try:
+                item = self._results.get(timeout=0.5)
+            except queue.Empty:
+                continue
+            if item is None:
+                break
+            index, email_obj = item
+            if email_obj is None:
+                finished.add(index)
+            elif index == current:
+                saved += self._save(email_obj, on_saved)
+            else:
+                pending.setdefault(index, []).append(email_obj)
+
+            while current in finished:
+                finished.discard(current)
+                current += 1
+                for email_obj in pending.pop(current, []):
+                    saved += self._save(email_obj, on_saved)
+        self._sync(on_saved)
+        return saved
+
+    def _save(self, email_obj, on_saved):
+        """
+        Saves one email, and flushes the storage when a batch is complete.
+
+        Args:
+            email_obj (Email): The email to save.
+            on_saved (callable): Called with the Email after its batch has been flushed.
+
+        Returns:
+            int: 1, the number of emails saved.
+        """
+        self._storage.save_email(email_obj)
+        self._unsynced.append(email_obj)
+        if len(self._unsynced) >= self._sync_batch:
+            self._sync(on_saved)
+        return 1
+
+    def _sync(self, on_saved):
+        """
+        Flushes the storage once for the emails saved since the last flush, then reports them.
+
+        Args:
+            on_saved (callable): Called with each Email of the batch.
+        """
+        if not self._unsynced:
+            return
+        self._storage.flush()
+        if on_saved is not None:
+            for email_obj in self._unsynced:
+                on_saved(email_obj)
+        self._unsynced = []
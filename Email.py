@@ -1,3 +1,10 @@
+import os
+import time
+from email.message import Message
+from email.parser import BytesHeaderParser
+from Metrics import Metrics
+
+
 class Email:
     """
     Represents an email message.
@@ -6,31 +13,169 @@ class Email:
         sender (str): The sender of the email.
         subject (str): The subject of the email.
         raw_email (str): The raw email content.
+        raw_bytes (bytes): The raw email content, as received from the server.
+        uid (int): The IMAP UID of the email, or None if unknown.
+        size (int): The size of the raw email in bytes.
+        path (str): The file holding the raw email, for emails streamed to disk, or None.
+        flags (str): The IMAP flags of the message on the server, e.g. "\\Seen \\Flagged", or None.
+        internal_date (str): The IMAP INTERNALDATE of the message, e.g. "01-Jan-2024 12:00:00 +0000",
+            or None.
 
     Note:
         The `sender` and `subject` properties are used to get and set the corresponding attributes.
         The `raw_email` property is used to get and set the raw email content as a string.
 
+        An Email keeps the raw bytes it was built from and nothing else. The header block is
+        parsed on first access to `sender`, `subject` or `header()`, and the body is never
+        parsed; `raw_email` decodes the bytes into a new string each time it is read. Listing
+        or deduplicating many emails therefore only costs their raw size plus a small header
+        object. `__slots__` keeps the per-object overhead small as well.
+
     Usage:
-        email = Email(msg)
+        email = Email(raw_bytes, uid=12)
         email.sender = "john@example.com"
         email.subject = "Hello, World!"
         email.raw_email = "..."
     """
 
-    def __init__(self, msg):
+    __slots__ = ("_raw", "_headers", "_sender", "_subject", "_uid", "_path", "_size", "flags", "internal_date")
+
+    # marks sender/subject that were not set explicitly and come from the headers
+    _unset = object()
+
+    def __init__(self, msg, uid=None):
         """
         Initializes an Email object.
 
         Args:
-            msg (Message): The email message object.
+            msg (bytes | Message): The raw RFC822 message, or an email message object.
+            uid (bytes | str | int): The IMAP UID of the email. Default is None.
 
         Note:
-            The `msg` parameter should be an instance of the `Message` class from the `email` module.
+            A `Message` from the `email` module is accepted for compatibility and is
+            serialized once; fetching code passes the raw bytes directly.
+        """
+        if isinstance(msg, Message):
+            msg = msg.as_bytes()
+        self._raw = msg
+        self._headers = None
+        self._sender = Email._unset
+        self._subject = Email._unset
+        self.uid = uid
+        self._path = None
+        self._size = None
+        self.flags = None
+        self.internal_date = None
+
+    @classmethod
+    def from_file(cls, path, uid=None):
+        """
+        Creates an Email backed by a raw message file, parsing only its header block.
+
+        The body is not read; `raw_email` and `raw_bytes` load it from the file on access.
+        This is used by the streaming fetch, where the message is written straight to disk.
+
+        Args:
+            path (str): The file holding the raw RFC822 message.
+            uid (bytes | str | int): The IMAP UID of the email. Default is None.
+
+        Returns:
+            Email: The email object.
+
+        Raises:
+            OSError: If the file cannot be read.
+        """
+        with open(path, "rb") as eml_file:
+            header_block = Email.read_header_block(eml_file)
+        email_obj = cls(None, uid=uid)
+        email_obj._headers = BytesHeaderParser().parsebytes(header_block)
+        email_obj._path = path
+        return email_obj
+
+    @classmethod
+    def from_headers(cls, header_block, uid=None, size=None):
+        """
+        Creates a header-only Email, as returned by a header prefetch.
+
+        Such an email has no content (`raw_bytes` is None); it only carries the headers,
+        the UID and the server-reported size, which is enough to name or deduplicate it.
+
+        Args:
+            header_block (bytes): The raw header lines.
+            uid (bytes | str | int): The IMAP UID of the email. Default is None.
+            size (str | int): The RFC822.SIZE reported by the server. Default is None.
+
+        Returns:
+            Email: The email object.
+        """
+        email_obj = cls(None, uid=uid)
+        email_obj._headers = BytesHeaderParser().parsebytes(header_block)
+        email_obj._size = int(size) if size is not None else None
+        return email_obj
+
+    @staticmethod
+    def read_header_block(eml_file):
+        """
+        Reads the header block of a raw message, up to and including the empty line.
+
+        Args:
+            eml_file (file): A binary file positioned at the start of the message.
+
+        Returns:
+            bytes: The header block.
+        """
+        lines = []
+        for line in eml_file:
+            lines.append(line)
+            if line in (b"\r\n", b"\n"):
+                break
+        return b"".join(lines)
+
+    @staticmethod
+    def split_header_block(raw):
+        """
+        Returns the header block of a raw message held in memory.
+
+        Args:
+            raw (bytes): The raw RFC822 message.
+
+        Returns:
+            bytes: The header block, or the whole message if it has no body.
+        """
+        end = raw.find(b"\r\n\r\n")
+        limit = end if end != -1 else len(raw)
+        bare_end = raw.find(b"\n\n", 0, limit + 1)
+        if bare_end != -1:
+            return raw[:bare_end + 2]
+        if end != -1:
+            return raw[:end + 4]
+        return raw
+
+    def _parsed_headers(self):
+        """
+        Parses the header block on first use.
+
+        Returns:
+            Message: A message object holding the headers only.
+        """
+        if self._headers is None:
+            start = time.perf_counter()
+            raw = self.raw_bytes or b""
+            self._headers = BytesHeaderParser().parsebytes(Email.split_header_block(raw))
+            Metrics.shared().observe("emailsafe_parse_seconds", time.perf_counter() - start)
+        return self._headers
+
+    def header(self, name):
+        """
+        Returns the value of a header, parsing the header block if needed.
+
+        Args:
+            name (str): The header name, e.g. "Message-ID".
+
+        Returns:
+            str: The raw header value, or None if the header is missing.
         """
-        self.sender = msg['from']
-        self.subject = msg['subject']
-        self.raw_email = msg.as_string()
+        return self._parsed_headers()[name]
 
     @property
     def sender(self):
@@ -38,8 +183,11 @@ class Email:
         str: The sender of the email.
 
         Note:
-            This property provides access to the `_sender` attribute.
+            This property provides access to the `_sender` attribute, read from the
+            From header unless it was set explicitly.
         """
+        if self._sender is Email._unset:
+            return self.header('from')
         return self._sender
 
     @sender.setter
@@ -62,8 +210,11 @@ class Email:
         str: The subject of the email.
 
         Note:
-            This property provides access to the `_subject` attribute.
+            This property provides access to the `_subject` attribute, read from the
+            Subject header unless it was set explicitly.
         """
+        if self._subject is Email._unset:
+            return self.header('subject')
         return self._subject
 
     @subject.setter
@@ -85,9 +236,15 @@ class Email:
         str: The raw email content.
 
         Note:
-            This property provides access to the `_raw_email` attribute.
+            The string is decoded from `raw_bytes` on each access and not kept, so only
+            callers that need the text pay for it. Bytes that are not UTF-8 (8-bit bodies in
+            other charsets) become lone surrogates, and the setter encodes them back, so
+            `email.raw_email = email.raw_email` keeps the content byte for byte.
         """
-        return self._raw_email
+        raw = self.raw_bytes
+        if raw is None:
+            return None
+        return raw.decode("utf-8", errors="surrogateescape")
 
     @raw_email.setter
     def raw_email(self, raw_email):
@@ -95,9 +252,87 @@ class Email:
         Setter for the raw_email property.
 
         Args:
-            raw_email (str): The raw email content.
+            raw_email (str | bytes): The raw email content, as returned by the getter.
+
+        Note:
+            This method stores the content as bytes and drops the parsed headers and the
+            size reported by the server, which described the previous content.
+        """
+        if isinstance(raw_email, str):
+            raw_email = raw_email.encode("utf-8", errors="surrogateescape")
+        self._raw = raw_email
+        self._headers = None
+        self._size = None
+
+    @property
+    def raw_bytes(self):
+        """
+        bytes: The raw email content, as received from the server.
+
+        Note:
+            For an email streamed to disk, the content is read from `path`.
+        """
+        if self._raw is None and self._path is not None:
+            with open(self._path, "rb") as eml_file:
+                return eml_file.read()
+        return self._raw
+
+    @property
+    def size(self):
+        """
+        int: The size of the raw email in bytes, or None if unknown.
 
         Note:
-            This method sets the `_raw_email` attribute.
+            The size reported by the server is used when known, otherwise the size of the
+            content in memory or on disk.
+        """
+        if self._size is not None:
+            return self._size
+        if self._raw is not None:
+            return len(self._raw)
+        if self._path is not None:
+            return os.path.getsize(self._path)
+        return None
+
+    @property
+    def uid(self):
+        """
+        int: The IMAP UID of the email, or None if unknown.
+
+        Note:
+            This property provides access to the `_uid` attribute.
+        """
+        return self._uid
+
+    @uid.setter
+    def uid(self, uid):
+        """
+        Setter for the uid property.
+
+        Args:
+            uid (bytes | str | int): The IMAP UID of the email.
+
+        Note:
+            This method stores the UID as an int, or None if no UID is given.
+        """
+        self._uid = int(uid) if uid is not None else None
+
+    @property
+    def path(self):
+        """
+        str: The file holding the raw email, or None if the email is held in memory.
+
+        Note:
+            Storage backends move this file into place instead of writing `raw_email`.
+        """
+        return self._path
+
+    @path.setter
+    def path(self, path):
+        """
+        Setter for the path property.
+
+        Args:
+            path (str): The new location of the raw email file.
         """
-        self._raw_email = raw_email
+        self._path = path
@@ -1,4 +1,6 @@
 from abc import ABC, abstractmethod
+from Metrics import Metrics
+import os
 
 
 class EmailStorage(ABC):
@@ -10,11 +12,10 @@ class EmailStorage(ABC):
     in the desired format/location.
     """
 
-    @classmethod
     @abstractmethod
-    def save_email(cls, email):
+    def save_email(self, email):
         """
-        Abstract class method to save an email.
+        Abstract method to save an email.
 
         This method should be implemented by subclasses to save the provided email object
         to a desired format/location.
@@ -30,3 +31,95 @@ class EmailStorage(ABC):
         """
 
         raise NotImplementedError("Method should implement in subclasses")
+
+    def prepare(self, email):
+        """
+        Method for the CPU work of saving an email that does not touch the disk, e.g. naming or hashing.
+
+        The write pipeline calls it on its parse stage, ahead of `save_email()` on the write
+        stage, so this work overlaps with the writes of the previous emails. Backends keep the
+        result for `save_email()`; calling `save_email()` without `prepare()` works as well.
+        Backends with nothing to prepare do nothing.
+
+        Args:
+            email (Email): The email object about to be saved.
+        """
+        pass
+
+    def contains(self, email):
+        """
+        Method to check whether an email is already stored.
+
+        The check must only use what a header prefetch provides (the headers, UID and size),
+        so that a backup plan can skip stored emails before downloading them. Backends that
+        cannot tell return False, and every email is downloaded.
+
+        Args:
+            email (Email): The email object, possibly header-only.
+
+        Returns:
+            bool: True if the email is already stored, False otherwise.
+        """
+        return False
+
+    def flush(self):
+        """
+        Method to make pending writes durable, e.g. buffered index rows.
+
+        Called after each batch of writes and at the end of a run, including an interrupted
+        one. Backends that write everything immediately have nothing to do.
+        """
+        pass
+
+    @staticmethod
+    def sync_files(paths):
+        """
+        Makes files and their directory entries durable, syncing each directory only once.
+
+        Args:
+            paths (iterable): The files written since the last sync. Files that no longer
+                exist (e.g. moved) are skipped.
+
+        Raises:
+            OSError: If a file cannot be synced.
+        """
+        with Metrics.shared().time("emailsafe_sync_seconds"):
+            EmailStorage._sync_files(paths)
+
+    @staticmethod
+    def _sync_files(paths):
+        """
+        Syncs the files, then their directories; see `sync_files()`.
+
+        Args:
+            paths (iterable): The files written since the last sync.
+        """
+        directories = set()
+        for path in paths:
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            directories.add(os.path.dirname(path) or ".")
+        for directory in directories:
+            try:
+                fd = os.open(directory, os.O_RDONLY)
+            except OSError:
+                continue  # directories cannot be opened on every platform
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    def stats(self):
+        """
+        Method to report what the backend did during the run, e.g. bytes written.
+
+        Returns:
+            dict: The counters of the backend; empty for backends without any.
+        """
+        return {}
@@ -1,6 +1,10 @@
+from Email import Email  # my module
 from EmailStorage import EmailStorage
+from FileNamer import FileNamer
+from Metrics import Metrics
 import os
-from email.header import decode_header
+import tempfile
+import time
 
 
 class EmlStorage(EmailStorage):
@@ -8,10 +12,14 @@ class EmlStorage(EmailStorage):
     Concrete implementation of EmailStorage for saving emails as .eml files.
 
     Attributes:
-        None
+        path_backup (str): The directory the .eml files are written to. Default is "mail".
+        mailbox (str): The mailbox the saved emails come from. Default is "INBOX".
+        index (MailIndex): The metadata index updated for each saved email, or None.
+        file_name (str): The file name of the last saved email.
+        namer (FileNamer): The naming engine shared by all EmlStorage objects.
 
     Methods:
-        save_email(cls, email):
+        save_email(email):
             Save the email as a .eml file.
 
         decode_str(encoded_string):
@@ -19,16 +27,87 @@ class EmlStorage(EmailStorage):
 
         filename(path_backup, email):
             Generate the filename for the email.
+
+        prepare(email):
+            Name the email ahead of `save_email()`, on the pipeline parse stage.
+
+        spool_dir():
+            Directory for emails streamed to disk before they are moved into place.
+
+        folder_path(path_backup, folder, delimiter):
+            Generate the backup directory of a mailbox folder.
     """
 
-    @classmethod
-    def save_email(cls, email):
+    namer = FileNamer()
+
+    def __init__(self, path_backup="mail", mailbox="INBOX", index=None, uidvalidity=None):
+        """
+        Initializes an EmlStorage object.
+
+        Args:
+            path_backup (str): The directory the .eml files are written to. Default is "mail".
+            mailbox (str): The mailbox the saved emails come from. Default is "INBOX".
+            index (MailIndex): The metadata index to update for each saved email. Default is None.
+            uidvalidity (int): The UIDVALIDITY of the mailbox, recorded in the index. Default is None.
+        """
+        self.path_backup = path_backup
+        self.mailbox = mailbox
+        self.index = index
+        self.uidvalidity = uidvalidity
+        self.file_name = None
+        self._prepared = {}
+        self._unsynced = set()
+
+    def prepare(self, email):
+        """
+        Name the email ahead of `save_email()`.
+
+        Args:
+            email (Email): The email object about to be saved.
+        """
+        self._prepared[id(email)] = (email, self._name(email))
+
+    def _prepared_name(self, email):
+        """
+        Returns the name computed by `prepare()`, or names the email now.
+
+        Args:
+            email (Email): The email object being saved.
+
+        Returns:
+            str: The file name for the email.
+        """
+        prepared, file_name = self._prepared.pop(id(email), (None, None))
+        if prepared is not email:
+            file_name = self._name(email)
+        return file_name
+
+    def _name(self, email):
+        """
+        Generate the file name of the email in this backup.
+
+        Args:
+            email (Email): The email object.
+
+        Returns:
+            str: The file name.
+        """
+        return EmlStorage.filename(self.path_backup, email)
+
+    def save_email(self, email):
         """
         Save the email as a .eml file.
 
         The method creates a directory named 'mail' if it does not exist, then writes the raw
         email content to a file with a unique name based on the email sender and subject.
 
+        The content is written to a temporary file which is renamed into place, so an
+        interrupted write never leaves a truncated .eml that looks complete. An email that was
+        streamed to disk (its `path` is set) is not written again: its file is renamed into
+        place, or removed if the email is already stored.
+
+        When an index is attached, the email metadata is recorded in it after the file is written.
+
         Args:
             email (Email): The email object to be saved.
 
@@ -36,25 +115,108 @@ class EmlStorage(EmailStorage):
             OSError: If there's an error during the directory creation or file writing process.
         """
 
-        path_backup = "mail"
+        path_backup = self.path_backup
+        start = time.perf_counter()
         try:
             os.makedirs(path_backup, exist_ok=True)
-            cls.file_name = EmlStorage.filename(path_backup, email)
-            if not EmlStorage.file_exists():
-                with open(cls.file_name, 'w') as eml_file:
-                    eml_file.write(email.raw_email)
+            self.file_name = self._prepared_name(email)
+            if email.path is not None:
+                if self.file_exists():
+                    os.remove(email.path)
+                else:
+                    os.replace(email.path, self.file_name)
+                    self._unsynced.add(self.file_name)
+                email.path = self.file_name
+            elif not self.file_exists():
+                fd, temp_name = tempfile.mkstemp(dir=path_backup, prefix=".", suffix=".part")
+                with os.fdopen(fd, 'wb') as eml_file:
+                    eml_file.write(email.raw_bytes)
+                os.replace(temp_name, self.file_name)
+                self._unsynced.add(self.file_name)
+            if self.index is not None:
+                self.index.add(email, self.file_name, self.mailbox, self.uidvalidity)
         except OSError as e:
             raise OSError()
+        metrics = Metrics.shared()
+        metrics.observe("emailsafe_write_seconds", time.perf_counter() - start)
+        metrics.inc("emailsafe_write_bytes_total", email.size or 0)
+
+    def flush(self):
+        """
+        Syncs the files written since the last flush, then commits the buffered index rows.
+        """
+        EmailStorage.sync_files(self._unsynced)
+        self._unsynced = set()
+        if self.index is not None:
+            self.index.flush()
+
+    def spool_dir(self):
+        """
+        Directory for emails streamed to disk before they are moved into place.
+
+        The directory is inside the backup directory, so the final rename stays on the same
+        filesystem and is atomic.
+
+        Returns:
+            str: The spool directory, created if needed.
+        """
+        path = os.path.join(self.path_backup, ".tmp")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def contains(self, email):
+        """
+        Checks whether a file for the email already exists.
+
+        Only the headers are needed, so a header-only email is enough. The name of the
+        versions without tag (`FileNamer.legacy_name()`) is also checked, so an older backup
+        is not downloaded again; since several emails shared that name, the file only counts
+        if it holds the same email (see `_is_legacy_copy()`).
+
+        Args:
+            email (Email): The email object.
+
+        Returns:
+            bool: True if the email is already stored, False otherwise.
+        """
+        return (os.path.isfile(EmlStorage.filename(self.path_backup, email))
+                or self._is_legacy_copy(email, os.path.join(self.path_backup, FileNamer.legacy_name(email))))
+
+    @staticmethod
+    def _is_legacy_copy(email, file_name):
+        """
+        Checks whether a file named without tag holds the given email.
+
+        The Message-IDs are compared when both emails have one, otherwise the sizes.
 
-    @classmethod
-    def file_exists(cls):
+        Args:
+            email (Email): The email object, with its size if it has no Message-ID.
+            file_name (str): The file named by `FileNamer.legacy_name()`.
+
+        Returns:
+            bool: True if the file holds the email; False if it is missing, holds another
+            email, or the emails cannot be compared.
+        """
+        try:
+            if not os.path.isfile(file_name):
+                return False
+            stored = Email.from_file(file_name)
+            message_id = email.header("message-id")
+            stored_id = stored.header("message-id")
+            if message_id and stored_id:
+                return str(message_id).strip() == str(stored_id).strip()
+            return email.size is not None and email.size == os.path.getsize(file_name)
+        except OSError:
+            return False
+
+    def file_exists(self):
         """
         Checks if the specified file exists.
 
         Returns:
            bool: True if the file exists, False otherwise.
         """
-        return os.path.isfile(cls.file_name)
+        return os.path.isfile(self.file_name)
 
     @staticmethod
     def decode_str(encoded_string):
@@ -71,15 +233,7 @@ class EmlStorage(EmailStorage):
             str: The decoded and cleaned string.
         """
 
-        parts = decode_header(encoded_string)
-        cleaned_text = ''
-        for part in parts:
-            if isinstance(part[0], bytes):
-                decoded_text = part[0].decode(part[1] or 'utf-8', errors='ignore')
-            else:
-                decoded_text = part[0]
-            cleaned_text += decoded_text
-        return cleaned_text
+        return FileNamer.decode(encoded_string)
 
     @staticmethod
     def filename(path_backup, email):
@@ -87,20 +241,42 @@ class EmlStorage(EmailStorage):
         Generate the filename for the email.
 
         The method decodes and cleans the sender and subject from the email, then uses these
-        to generate a unique filename for the email.
+        to generate a unique filename for the email (see `FileNamer`).
 
         Args:
             path_backup (str): The backup path directory.
             email (Email): The email object.
 
         Returns:
-            str: The filename for the email, in the format "{cleaned_sender}_{cleaned_subject}.eml".
+            str: The filename for the email, in the format "{cleaned_sender}_{cleaned_subject}_{tag}.eml",
+            where tag is derived from the Message-ID or UID.
         """
 
-        cleaned_sender = EmlStorage.decode_str(email.sender)
-        cleaned_sender = cleaned_sender.replace("\"", "")
-        cleaned_subject = EmlStorage.decode_str(email.subject)
-        cleaned_subject = cleaned_subject.replace('\r\n', '')
-        cleaned_subject = cleaned_subject.replace("/", "")
-        file_name = f"{path_backup}/{cleaned_sender}_{cleaned_subject}.eml"
-        return file_name
+        return os.path.join(path_backup, EmlStorage.namer.name(email))
+
+    @staticmethod
+    def folder_path(path_backup, folder, delimiter="/"):
+        """
+        Generate the backup directory of a mailbox folder, keeping the folder hierarchy.
+
+        Each level of the folder name becomes one directory level, e.g. "Archive/2023" is
+        saved in "{path_backup}/Archive/2023". Path separators and leading dots are replaced
+        in each level, so a folder name never escapes the backup directory, and levels named
+        after a Windows device (e.g. "CON") get a leading "_".
+
+        Args:
+            path_backup (str): The backup path directory.
+            folder (str): The readable folder name.
+            delimiter (str): The hierarchy delimiter of the server, or None. Default is "/".
+
+        Returns:
+            str: The directory for the emails of the folder.
+        """
+
+        levels = folder.split(delimiter) if delimiter else [folder]
+        cleaned_levels = []
+        for level in levels:
+            cleaned_level = level.replace("/", "_").replace("\\", "_").replace("\0", "")
+            cleaned_level = FileNamer.safe(cleaned_level.lstrip(".") or "_")
+            cleaned_levels.append(cleaned_level)
+        return os.path.join(path_backup, *cleaned_levels)
@@ -0,0 +1,624 @@
+import datetime
+import random
+import re
+import socketserver
+import threading
+import time
+from UidSet import UidSet
+
+
+class FakeImapServer:
+    """
+    In-process IMAP server serving synthetic mailboxes, for benchmarks and tests.
+
+    It speaks the subset of IMAP4rev1 the clients of this project use: LOGIN, CAPABILITY,
+    LIST, STATUS, SELECT/EXAMINE, CREATE, APPEND (with LITERAL+ and MULTIAPPEND), UID SEARCH
+    (ALL, UID, SINCE, BEFORE, ON, LARGER, SMALLER, FROM, SEEN, UNSEEN, NOT, OR, lists, and the
+    ESEARCH return options ALL, COUNT, MIN and MAX),
+    UID FETCH (UID, FLAGS, INTERNALDATE, RFC822.SIZE, RFC822, BODY.PEEK[] and
+    BODY.PEEK[HEADER.FIELDS (...)]), NOOP and LOGOUT, on localhost, over plain TCP or over
+    TLS when given a server SSL context. Any login is accepted.
+
+    Message UIDs run from 1 to the mailbox size. Messages are generated on demand from their
+    mailbox and UID, so the same server always serves the same bytes, and large mailboxes
+    cost no memory. The messages with an even UID are \\Seen, and message n arrived n - 1
+    hours after `first_arrival`, which gives SINCE and BEFORE something to select. Appended messages are kept in
+    memory, in `appended`, and get the next UIDs of their mailbox. The generated messages
+    have sizes that follow a distribution:
+
+    - "fixed": every message is `mean_size` bytes;
+    - "uniform": between 1 KB and twice `mean_size`;
+    - "lognormal": mostly small messages with a long tail of large ones, like a real
+      mailbox, with a mean of about `mean_size`.
+
+    `latency` seconds are waited before answering each command, to simulate the round trip
+    to a remote server. The time each message is sent is recorded in `sent`, which gives
+    the per-message latency of a client in the same process. With a `quota`, the server acts
+    like a provider enforcing a bandwidth limit: once `quota` message bytes were sent in the
+    current second, message downloads are refused with `NO [THROTTLED]`.
+
+    Attributes:
+        mailboxes (dict): The number of messages of each mailbox, by name.
+        latency (float): The simulated round trip, in seconds.
+        sent (dict): `time.perf_counter()` when each message was sent, by (mailbox, UID).
+        commands (int): The number of commands received.
+        throttled (int): The number of commands refused because of the quota.
+        appended (dict): (flags, internal date, bytes) of each appended message, by (mailbox, UID).
+
+    Usage:
+        with FakeImapServer({"INBOX": 1000}, mean_size=20 * 1024, latency=0.01) as server:
+            imap = Imap(*server.address, "user", "password")
+            imap.connect()
+    """
+
+    uidvalidity = 1
+    capabilities = "IMAP4rev1 LITERAL+ MULTIAPPEND UIDPLUS ESEARCH"
+    internal_date = "01-Jan-2024 12:00:00 +0000"
+    first_arrival = datetime.datetime(2024, 1, 1, 12, 0, 0)
+    distributions = ("fixed", "uniform", "lognormal")
+
+    # a tagged command, e.g. b'A001 UID FETCH 1:10 (UID RFC822)'
+    _command = re.compile(r'(?P<tag>\S+) (?P<name>(?:UID )?\S+)\s*(?P<args>.*)$', re.IGNORECASE)
+    # the message item of a FETCH, RFC822 or BODY[] (BODY.PEEK[] is answered as BODY[])
+    _body_item = re.compile(r'\b(RFC822|BODY(?:\.PEEK)?\[\])(?=[\s)])')
+    # the fields of BODY.PEEK[HEADER.FIELDS (FROM SUBJECT)]
+    _header_fields = re.compile(r'HEADER\.FIELDS \(([^)]*)\)', re.IGNORECASE)
+    # a mailbox name at the start of the APPEND arguments, and the rest
+    _append_mailbox = re.compile(r'("(?:[^"\\]|\\.)*"|\S+)(.*)$')
+    # one message of an APPEND: optional flags and date, then the literal, e.g. '(\Seen) "..." {120+}'
+    _append_message = re.compile(r'\s*(?:\((?P<flags>[^)]*)\))?\s*(?:"(?P<date>[^"]*)")?\s*'
+                                 r'\{(?P<size>\d+)(?P<plus>\+?)\}$')
+    # a token of SEARCH criteria: a parenthesis, a quoted string or an atom
+    _search_token = re.compile(r'\(|\)|"(?:[^"\\]|\\.)*"|[^\s()]+')
+    # ESEARCH return options at the start of the SEARCH arguments, e.g. "RETURN (MIN COUNT) "
+    _search_return = re.compile(r'RETURN \(([^)]*)\)\s*', re.IGNORECASE)
+    # month names of IMAP dates
+    _months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+    # filler for the message bodies: 1024 lines of 76 base64 characters, like an attachment
+    _filler = b"".join(bytes(random.Random(line).choices(b"ABCDEFGHIJKLMNOPQRSTUVWXYZ"
+                                                         b"abcdefghijklmnopqrstuvwxyz0123456789+/", k=76)) + b"\r\n"
+                       for line in range(1024))
+
+    def __init__(self, mailboxes=None, **opt):
+        """
+        Initializes a FakeImapServer object.
+
+        Args:
+            mailboxes (dict): The number of messages of each mailbox. Default is 100 in INBOX.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            distribution (str): "fixed", "uniform" or "lognormal". Default is "lognormal".
+            mean_size (int): The mean message size in bytes. Default is 20 KB.
+            latency (float): Seconds waited before each answer. Default is 0.
+            seed (int): Seed of the message sizes. Default is 0.
+            ssl_context (SSLContext): Server-side context to serve over TLS. Default is None.
+            quota (int): Message bytes per second served to all sessions together, or None
+                for no limit. Default is None.
+            capabilities (str): The capabilities announced. Default is `FakeImapServer.capabilities`.
+
+        Raises:
+            ValueError: If the distribution is unknown.
+        """
+        self.mailboxes = dict(mailboxes) if mailboxes is not None else {"INBOX": 100}
+        self._distribution = opt.get('distribution', 'lognormal')
+        if self._distribution not in FakeImapServer.distributions:
+            raise ValueError(f"unknown size distribution {self._distribution}")
+        self._mean_size = opt.get('mean_size', 20 * 1024)
+        self.latency = opt.get('latency', 0.0)
+        self._seed = opt.get('seed', 0)
+        self._ssl_context = opt.get('ssl_context')
+        self.quota = opt.get('quota')
+        self._capabilities = opt.get('capabilities', FakeImapServer.capabilities)
+        self.appended = {}
+        self._quota_window = {"start": time.monotonic(), "bytes": 0}
+        self._sizes = {}
+        self._server = None
+        self._lock = threading.Lock()
+        self.sent = {}
+        self.commands = 0
+        self.throttled = 0
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def address(self):
+        """
+        tuple: The (host, port) the server listens on, once started.
+        """
+        return self._server.server_address
+
+    def start(self):
+        """
+        Starts serving on a free localhost port, in a background thread.
+
+        Returns:
+            tuple: The (host, port) to connect to.
+        """
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            wbufsize = 256 * 1024
+
+            def setup(self):
+                if server._ssl_context is not None:
+                    self.request = server._ssl_context.wrap_socket(self.request, server_side=True)
+                super().setup()
+
+            def handle(self):
+                server._session(self.rfile, self.wfile)
+
+        self._server = socketserver.ThreadingTCPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self.address
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def size(self, mailbox, uid):
+        """
+        Returns the size of a message, drawn from the size distribution.
+
+        Args:
+            mailbox (str): The mailbox name.
+            uid (int): The message UID.
+
+        Returns:
+            int: The message size in bytes, at least 512.
+        """
+        key = (mailbox, uid)
+        if key in self.appended:
+            return len(self.appended[key][2])
+        if key not in self._sizes:
+            draw = random.Random(f"{self._seed}:{mailbox}:{uid}")
+            if self._distribution == "fixed":
+                size = self._mean_size
+            elif self._distribution == "uniform":
+                size = draw.randint(1024, 2 * self._mean_size)
+            else:
+                # mean of a lognormal distribution is exp(mu + sigma^2 / 2)
+                sigma = 1.0
+                size = int(draw.lognormvariate(0, sigma) * self._mean_size / 1.6487)
+            self._sizes[key] = max(512, min(size, 50 * 1024 * 1024))
+        return self._sizes[key]
+
+    def message(self, mailbox, uid):
+        """
+        Generates a message.
+
+        Args:
+            mailbox (str): The mailbox name.
+            uid (int): The message UID.
+
+        Returns:
+            bytes: The raw message, of exactly `size(mailbox, uid)` bytes.
+        """
+        if (mailbox, uid) in self.appended:
+            return self.appended[(mailbox, uid)][2]
+        header = self._header(mailbox, uid)
+        body_size = max(0, self.size(mailbox, uid) - len(header))
+        filler = FakeImapServer._filler
+        body = filler * (body_size // len(filler)) + filler[:body_size % len(filler)]
+        return header + body
+
+    def _header(self, mailbox, uid):
+        """
+        Returns the header of a message, with the blank line ending it.
+
+        Args:
+            mailbox (str): The mailbox name.
+            uid (int): The message UID.
+
+        Returns:
+            bytes: The raw header.
+        """
+        if (mailbox, uid) in self.appended:
+            head, separator, _ = self.appended[(mailbox, uid)][2].partition(b"\r\n\r\n")
+            return head + separator
+        return (f"From: Sender {uid % 97} <sender{uid % 97}@example.com>\r\n"
+                f"To: user@example.com\r\n"
+                f"Subject: {mailbox} message {uid}\r\n"
+                f"Date: Mon, 01 Jan 2024 12:00:00 +0000\r\n"
+                f"Message-ID: <{uid}.{mailbox}@example.com>\r\n"
+                f"Content-Type: text/plain\r\n\r\n").encode("utf-8")
+
+    def _session(self, rfile, wfile):
+        """
+        Serves one client connection.
+
+        Args:
+            rfile (file): The socket input.
+            wfile (file): The socket output, buffered; flushed after each answer.
+        """
+        wfile.write(f"* OK [CAPABILITY {self._capabilities}] fake IMAP server ready\r\n".encode())
+        wfile.flush()
+        selected = None
+        for line in rfile:
+            match = FakeImapServer._command.match(line.decode("utf-8", errors="replace").rstrip("\r\n"))
+            if match is None:
+                wfile.write(b"* BAD invalid command\r\n")
+                wfile.flush()
+                continue
+            tag, name, args = match.group("tag"), match.group("name").upper(), match.group("args")
+            with self._lock:
+                self.commands += 1
+            if self.latency:
+                time.sleep(self.latency)
+
+            if name == "LOGOUT":
+                wfile.write(f"* BYE logging out\r\n{tag} OK LOGOUT completed\r\n".encode())
+                wfile.flush()
+                return
+            if name in ("SELECT", "EXAMINE"):
+                mailbox = self._mailbox_name(args)
+                if mailbox not in self.mailboxes:
+                    self._answer(wfile, tag, "NO", "no such mailbox")
+                    continue
+                selected = mailbox
+                count = self.mailboxes[mailbox]
+                wfile.write(f"* {count} EXISTS\r\n* 0 RECENT\r\n"
+                            f"* OK [UIDVALIDITY {FakeImapServer.uidvalidity}] UIDs valid\r\n"
+                            f"* OK [UIDNEXT {count + 1}] predicted next UID\r\n".encode())
+                self._answer(wfile, tag, "OK", f"[READ-WRITE] {name} completed")
+            elif name == "UID FETCH" and selected is not None:
+                if FakeImapServer._body_item.search(args.upper()) and self._over_quota():
+                    self._answer(wfile, tag, "NO", "[THROTTLED] bandwidth quota exceeded, slow down")
+                    continue
+                self._fetch(wfile, selected, args)
+                self._answer(wfile, tag, "OK", "FETCH completed")
+            elif name == "UID SEARCH" and selected is not None:
+                options = FakeImapServer._search_return.match(args)
+                if options is not None and "ESEARCH" not in self._capabilities.split():
+                    self._answer(wfile, tag, "BAD", "ESEARCH not supported")
+                    continue
+                try:
+                    uids = self._search(selected, args[options.end():] if options else args)
+                except (ValueError, IndexError):
+                    self._answer(wfile, tag, "BAD", "invalid search criteria")
+                    continue
+                if options is not None:
+                    wfile.write(self._esearch(tag, options.group(1), uids))
+                else:
+                    wfile.write(("* SEARCH " + " ".join(map(str, uids))).rstrip().encode() + b"\r\n")
+                self._answer(wfile, tag, "OK", "SEARCH completed")
+            elif name == "LIST":
+                for mailbox in list(self.mailboxes):
+                    wfile.write(f'* LIST (\\HasNoChildren) "/" "{mailbox}"\r\n'.encode())
+                self._answer(wfile, tag, "OK", "LIST completed")
+            elif name == "STATUS":
+                mailbox = self._mailbox_name(args)
+                if mailbox not in self.mailboxes:
+                    self._answer(wfile, tag, "NO", "no such mailbox")
+                    continue
+                count = self.mailboxes[mailbox]
+                wfile.write(f'* STATUS "{mailbox}" (MESSAGES {count} UIDNEXT {count + 1} '
+                            f'UIDVALIDITY {FakeImapServer.uidvalidity})\r\n'.encode())
+                self._answer(wfile, tag, "OK", "STATUS completed")
+            elif name == "APPEND":
+                self._append(rfile, wfile, tag, args)
+            elif name == "CREATE":
+                mailbox = self._mailbox_name(args)
+                with self._lock:
+                    exists = mailbox in self.mailboxes
+                    self.mailboxes.setdefault(mailbox, 0)
+                if exists:
+                    self._answer(wfile, tag, "NO", "[ALREADYEXISTS] mailbox exists")
+                else:
+                    self._answer(wfile, tag, "OK", "CREATE completed")
+            elif name == "CAPABILITY":
+                wfile.write(f"* CAPABILITY {self._capabilities}\r\n".encode())
+                self._answer(wfile, tag, "OK", "CAPABILITY completed")
+            elif name in ("LOGIN", "NOOP", "ENABLE", "CLOSE"):
+                self._answer(wfile, tag, "OK", f"{name} completed")
+            else:
+                self._answer(wfile, tag, "BAD", f"{name} not supported")
+
+    def _fetch(self, wfile, mailbox, args):
+        """
+        Answers a UID FETCH command.
+
+        Args:
+            wfile (file): The socket output.
+            mailbox (str): The selected mailbox.
+            args (str): The command arguments, e.g. "1:10 (UID RFC822)".
+        """
+        uid_set, _, items = args.partition(" ")
+        items = items.upper()
+        fields = FakeImapServer._header_fields.search(items)
+        body = FakeImapServer._body_item.search(items)
+        for uid in FakeImapServer.parse_set(uid_set, self.mailboxes[mailbox]):
+            parts = [f"UID {uid}".encode()]
+            flags, date = self._state(mailbox, uid)
+            if re.search(r'\bFLAGS\b', items):
+                parts.append(f"FLAGS ({flags})".encode())
+            if "INTERNALDATE" in items:
+                parts.append(f'INTERNALDATE "{date}"'.encode())
+            if "RFC822.SIZE" in items:
+                parts.append(f"RFC822.SIZE {self.size(mailbox, uid)}".encode())
+            if fields:
+                names = {field.lower().encode() for field in fields.group(1).split()}
+                header = self._header(mailbox, uid).split(b"\r\n\r\n", 1)[0]
+                block = b"".join(line + b"\r\n" for line in header.split(b"\r\n")
+                                 if line.split(b":", 1)[0].lower() in names) + b"\r\n"
+                parts.append(f"BODY[HEADER.FIELDS ({fields.group(1)})] {{{len(block)}}}\r\n".encode() + block)
+            elif body:
+                data = self.message(mailbox, uid)
+                name = body.group(1).replace(".PEEK", "")
+                parts.append(f"{name} {{{len(data)}}}\r\n".encode() + data)
+                self.sent[(mailbox, uid)] = time.perf_counter()
+                with self._lock:
+                    self._quota_window["bytes"] += len(data)
+            wfile.write(f"* {uid} FETCH (".encode() + b" ".join(parts) + b")\r\n")
+
+    def _state(self, mailbox, uid):
+        """
+        Returns the flags and internal date of a message.
+
+        Args:
+            mailbox (str): The mailbox name.
+            uid (int): The message UID.
+
+        Returns:
+            tuple: (flags, internal date), e.g. ("\\Seen", "01-Jan-2024 12:00:00 +0000").
+        """
+        if (mailbox, uid) in self.appended:
+            return self.appended[(mailbox, uid)][:2]
+        arrival = FakeImapServer.first_arrival + datetime.timedelta(hours=uid - 1)
+        date = (f"{arrival.day:02d}-{FakeImapServer._months[arrival.month - 1]}-{arrival.year} "
+                f"{arrival:%H:%M:%S} +0000")
+        return "\\Seen" if uid % 2 == 0 else "", date
+
+    def _search(self, mailbox, args):
+        """
+        Answers the criteria of a UID SEARCH; the search keys are combined with AND.
+
+        Args:
+            mailbox (str): The selected mailbox.
+            args (str): The criteria, e.g. 'SINCE 1-Feb-2024 OR FROM "alice" FROM "bob"',
+                optionally after CHARSET <name>.
+
+        Returns:
+            list: The matching UIDs, in ascending order.
+
+        Raises:
+            ValueError: If a search key is unknown or malformed.
+        """
+        tokens = FakeImapServer._search_token.findall(args)
+        if tokens and tokens[0].upper() == "CHARSET":
+            tokens = tokens[2:]
+        count = self.mailboxes[mailbox]
+        candidates = range(1, count + 1)
+        if len(tokens) > 1 and tokens[0].upper() == "UID":
+            # a leading UID window only narrows the candidates, as a server index would
+            candidates = FakeImapServer.parse_set(tokens[1], count)
+            tokens = tokens[2:]
+        keys = []
+        while tokens:
+            keys.append(self._search_key(mailbox, tokens))
+        return [uid for uid in candidates if all(key(uid) for key in keys)]
+
+    @staticmethod
+    def _esearch(tag, options, uids):
+        """
+        Formats the ESEARCH answer of a UID SEARCH RETURN (...).
+
+        Args:
+            tag (str): The command tag.
+            options (str): The return options, e.g. "MIN COUNT"; empty means ALL.
+            uids (list): The matching UIDs, in ascending order.
+
+        Returns:
+            bytes: The untagged ESEARCH response.
+        """
+        items = []
+        for option in (options.upper().split() or ["ALL"]):
+            if option == "COUNT":
+                items.append(f"COUNT {len(uids)}")
+            elif option == "MIN" and uids:
+                items.append(f"MIN {uids[0]}")
+            elif option == "MAX" and uids:
+                items.append(f"MAX {uids[-1]}")
+            elif option == "ALL" and uids:
+                items.append(f"ALL {UidSet(uids).sequence_set()}")
+        return " ".join([f'* ESEARCH (TAG "{tag}") UID'] + items).encode() + b"\r\n"
+
+    def _search_key(self, mailbox, tokens):
+        """
+        Reads one search key from the criteria tokens.
+
+        Args:
+            mailbox (str): The selected mailbox.
+            tokens (list): The remaining tokens; the key is removed from it.
+
+        Returns:
+            callable: Called with a UID, returns True if the message matches the key.
+
+        Raises:
+            ValueError: If the key is unknown or malformed.
+        """
+        token = tokens.pop(0).upper()
+        if token == "(":
+            keys = []
+            while tokens[0] != ")":
+                keys.append(self._search_key(mailbox, tokens))
+            tokens.pop(0)
+            return lambda uid: all(key(uid) for key in keys)
+        if token == "NOT":
+            key = self._search_key(mailbox, tokens)
+            return lambda uid: not key(uid)
+        if token == "OR":
+            first, second = self._search_key(mailbox, tokens), self._search_key(mailbox, tokens)
+            return lambda uid: first(uid) or second(uid)
+        if token == "ALL":
+            return lambda uid: True
+        if token in ("SEEN", "UNSEEN"):
+            seen = token == "SEEN"
+            return lambda uid: ("\\Seen" in self._state(mailbox, uid)[0]) == seen
+        value = tokens.pop(0)
+        if value.startswith('"'):
+            value = re.sub(r'\\(.)', r'\1', value[1:-1])
+        if token == "UID":
+            uids = set(FakeImapServer.parse_set(value, self.mailboxes[mailbox]))
+            return lambda uid: uid in uids
+        if token in ("LARGER", "SMALLER"):
+            limit = int(value)
+            if token == "LARGER":
+                return lambda uid: self.size(mailbox, uid) > limit
+            return lambda uid: self.size(mailbox, uid) < limit
+        if token == "FROM":
+            needle = value.lower().encode("utf-8")
+            return lambda uid: any(line.lower().startswith(b"from:") and needle in line.lower()
+                                   for line in self._header(mailbox, uid).split(b"\r\n"))
+        if token in ("SINCE", "BEFORE", "ON"):
+            day = FakeImapServer._day(value)
+            compare = {"SINCE": lambda arrived: arrived >= day, "BEFORE": lambda arrived: arrived < day,
+                       "ON": lambda arrived: arrived == day}[token]
+            return lambda uid: compare(FakeImapServer._day(self._state(mailbox, uid)[1]))
+        raise ValueError(f"unsupported search key {token}")
+
+    @staticmethod
+    def _day(value):
+        """
+        Reads the day of an IMAP date or date-time, e.g. "1-Feb-2024" or "01-Feb-2024 12:00:00 +0000".
+
+        Args:
+            value (str): The date.
+
+        Returns:
+            date: The day.
+
+        Raises:
+            ValueError: If the value is not an IMAP date.
+        """
+        day, month, year = value.split()[0].split("-")
+        return datetime.date(int(year), FakeImapServer._months.index(month.title()) + 1, int(day))
+
+    def _append(self, rfile, wfile, tag, args):
+        """
+        Answers an APPEND command, reading the literal of each message it carries.
+
+        A synchronizing literal ({n}) is asked for with a "+" continuation, a
+        non-synchronizing one ({n+}) follows the command line right away. The messages of a
+        MULTIAPPEND are all stored, or none if the mailbox does not exist.
+
+        Args:
+            rfile (file): The socket input, positioned after the command line.
+            wfile (file): The socket output.
+            tag (str): The command tag.
+            args (str): The command arguments, up to the first literal.
+        """
+        match = FakeImapServer._append_mailbox.match(args)
+        mailbox = self._mailbox_name(match.group(1))
+        rest = match.group(2)
+        messages = []
+        while rest.strip():
+            message = FakeImapServer._append_message.match(rest)
+            if message is None:
+                self._answer(wfile, tag, "BAD", "invalid APPEND arguments")
+                return
+            if not message.group("plus"):
+                wfile.write(b"+ Ready for literal data\r\n")
+                wfile.flush()
+            data = rfile.read(int(message.group("size")))
+            messages.append(((message.group("flags") or "").strip(), message.group("date") or
+                             FakeImapServer.internal_date, data))
+            rest = rfile.readline().decode("utf-8", errors="replace").rstrip("\r\n")
+        with self._lock:
+            if mailbox not in self.mailboxes:
+                exists = False
+            else:
+                exists = True
+                first = self.mailboxes[mailbox] + 1
+                for message in messages:
+                    self.mailboxes[mailbox] += 1
+                    self.appended[(mailbox, self.mailboxes[mailbox])] = message
+                last = self.mailboxes[mailbox]
+        if not exists:
+            self._answer(wfile, tag, "NO", "[TRYCREATE] no such mailbox")
+            return
+        self._answer(wfile, tag, "OK", f"[APPENDUID {FakeImapServer.uidvalidity} {first}:{last}] APPEND completed")
+
+    def _over_quota(self):
+        """
+        Tells whether the quota of the current second is used up; counts the refusal if so.
+
+        Returns:
+            bool: True if the command must be refused.
+        """
+        if not self.quota:
+            return False
+        with self._lock:
+            now = time.monotonic()
+            if now - self._quota_window["start"] >= 1:
+                self._quota_window = {"start": now, "bytes": 0}
+            if self._quota_window["bytes"] < self.quota:
+                return False
+            self.throttled += 1
+            return True
+
+    def _answer(self, wfile, tag, status, text):
+        """
+        Sends the tagged completion of a command.
+
+        Args:
+            wfile (file): The socket output.
+            tag (str): The command tag.
+            status (str): "OK", "NO" or "BAD".
+            text (str): The human readable text.
+        """
+        wfile.write(f"{tag} {status} {text}\r\n".encode())
+        wfile.flush()
+
+    @staticmethod
+    def _mailbox_name(args):
+        """
+        Reads the mailbox name, quoted or not, at the start of the command arguments.
+
+        Args:
+            args (str): The command arguments.
+
+        Returns:
+            str: The mailbox name.
+        """
+        if args.startswith('"'):
+            return re.sub(r'\\(.)', r'\1', re.match(r'"((?:[^"\\]|\\.)*)"', args).group(1))
+        return args.split(" ", 1)[0]
+
+    @staticmethod
+    def parse_set(uid_set, count):
+        """
+        Expands an IMAP UID set, e.g. "1:3,7,9:*".
+
+        As in IMAP, "n:*" always includes the last message, even when n is larger.
+
+        Args:
+            uid_set (str): The UID set.
+            count (int): The number of messages, which is also the largest UID.
+
+        Returns:
+            list: The matching UIDs, in ascending order.
+        """
+        uids = set()
+        if count == 0:
+            return []
+        for part in uid_set.split(","):
+            first, _, last = part.partition(":")
+            first = count if first == "*" else int(first)
+            last = first if not last else (count if last == "*" else int(last))
+            low, high = sorted((first, last))
+            uids.update(range(max(1, low), min(high, count) + 1))
+            if "*" in part:
+                uids.add(count)
+        return sorted(uids)
@@ -0,0 +1,277 @@
+import queue
+import threading
+import time
+from ConnectionPool import ConnectionPool
+
+
+class FolderScheduler:
+    """
+    Backs up every folder of an account, several folders at a time.
+
+    `plan()` lists the folders with LIST and reads their STATUS (MESSAGES, UIDNEXT,
+    UIDVALIDITY) without selecting them. A folder whose UIDVALIDITY and UIDNEXT match its
+    sync state has no new message and is skipped, and the folders the `exclude` callable
+    rejects (e.g. `SearchFilter.excludes`) are not even asked for their STATUS. The other
+    folders are ordered by the number of messages to back up, largest first.
+
+    `run()` hands the folders out, in that order, to a pool of worker threads. Each worker
+    owns one client session, selects a folder and backs it up with the given callable, then
+    takes the next folder. Starting with the largest folders keeps the sessions busy until
+    the end, so the whole account takes about as long as its largest folder.
+
+    A worker that loses its connection reconnects and retries the folder. A folder that
+    still fails is recorded in `errors` and the other folders go on, as is a folder whose
+    backup raised any other error; only a write error (OSError) stops the other folders.
+
+    Attributes:
+        _factory (callable): Returns a new, connected EmailClient.
+        _workers (int): Number of sessions, capped by the connection limit.
+        _retries (int): Reconnect attempts per folder before giving up.
+        skipped (list): The folders found unchanged by `plan()`.
+        excluded (list): The folders left out by `exclude` in `plan()`.
+        results (dict): The value returned by the backup callable, by folder name.
+        errors (dict): The error of each folder that failed, by folder name.
+
+    Usage:
+        scheduler = FolderScheduler(factory, workers=4)
+        jobs = scheduler.plan(imap, lambda name, delimiter: SyncState(username, name))
+        scheduler.run(jobs, lambda client, job: fetch_inbox(client, ...))
+    """
+
+    # folders that cannot hold messages
+    _not_selectable = {"\\NOSELECT", "\\NONEXISTENT"}
+
+    def __init__(self, factory, **opt):
+        """
+        Initializes a FolderScheduler object.
+
+        Args:
+            factory (callable): Called with no argument, returns a connected EmailClient.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            workers (int): Number of parallel sessions. Default is 4.
+            max_connections (int): Server connection limit, caps `workers`. Default is 10.
+            retries (int): Reconnect attempts per folder. Default is 3.
+            release (callable): Called with a session and whether it failed, to hand it back
+                instead of logging out, e.g. `ConnectionPool.release`. Default is None.
+            exclude (callable): Called with a folder name, returns True to leave the folder out.
+                Default is None.
+        """
+        self._factory = factory
+        self._workers = max(1, min(opt.get('workers', 4), opt.get('max_connections', 10)))
+        self._retries = opt.get('retries', 3)
+        self._release_session = opt.get('release')
+        self._exclude = opt.get('exclude')
+        self._jobs = None
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._connected = 0
+        self._alive = 0
+        self.skipped = []
+        self.excluded = []
+        self.results = {}
+        self.errors = {}
+
+    @property
+    def workers(self):
+        """
+        int: The maximum number of sessions, after applying the connection limit.
+        """
+        return self._workers
+
+    def plan(self, client, state_for):
+        """
+        Lists the folders and keeps those with messages to back up, largest first.
+
+        Args:
+            client (EmailClient): A connected client providing `list_folders()` and `status()`.
+            state_for (callable): Called with a folder name and its hierarchy delimiter,
+                returns the SyncState of the folder.
+
+        Returns:
+            list: One dict per folder to back up, with the keys "name", "delimiter",
+            "status" (the STATUS items) and "pending" (the estimated number of new messages).
+
+        Raises:
+            ConnectionError: If the LIST or a STATUS command fails.
+        """
+        jobs = []
+        for name, delimiter, flags in client.list_folders():
+            if flags & FolderScheduler._not_selectable:
+                continue
+            if self._exclude is not None and self._exclude(name):
+                self.excluded.append(name)
+                continue
+            status = client.status(name)
+            state = state_for(name, delimiter)
+            pending = state.pending(status)
+            if state.is_unchanged(status) or not pending:
+                self.skipped.append(name)
+                continue
+            jobs.append({"name": name, "delimiter": delimiter, "status": status, "pending": pending})
+        jobs.sort(key=lambda job: (job["pending"], job["status"].get("MESSAGES", 0)), reverse=True)
+        return jobs
+
+    def run(self, jobs, backup):
+        """
+        Backs up the planned folders over several sessions.
+
+        Args:
+            jobs (list): The folders, as returned by `plan()`, in the order to start them.
+            backup (callable): Called with a client that has the folder selected and the job
+                dict; its return value is recorded in `results`.
+
+        Returns:
+            dict: The `results` of the folders backed up.
+
+        Raises:
+            ConnectionError: If no session could connect at all.
+            OSError: If the backup callable fails to write; the other folders are stopped.
+        """
+        if not jobs:
+            return self.results
+        self._jobs = queue.Queue()
+        for job in jobs:
+            self._jobs.put(job)
+        workers = min(self._workers, len(jobs))
+        self._alive = workers
+
+        threads = [threading.Thread(target=self._worker, args=(backup,), daemon=True) for _ in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for error in self.errors.values():
+            if isinstance(error, OSError):
+                raise error
+        if self._connected == 0 and self.errors:
+            raise next(iter(self.errors.values()))
+        return self.results
+
+    def _connect(self):
+        """
+        Opens a session, retrying with jittered exponential backoff.
+
+        Returns:
+            EmailClient: The connected client.
+
+        Raises:
+            ConnectionError: If every attempt failed.
+        """
+        for attempt in range(self._retries + 1):
+            try:
+                return self._factory()
+            except ConnectionError:
+                if attempt == self._retries or self._stop.is_set():
+                    raise
+                time.sleep(ConnectionPool.backoff(attempt))
+
+    def _release(self, client, broken=False):
+        """
+        Hands a session back through the `release` callable, or logs out of it.
+
+        Args:
+            client (EmailClient): The session.
+            broken (bool): True if the session failed. Default is False.
+        """
+        if self._release_session is not None:
+            self._release_session(client, broken)
+        elif client.is_connected():
+            try:
+                client.close()
+            except Exception:
+                pass
+
+    def _worker(self, backup):
+        """
+        Worker thread: takes folders from the job queue and backs them up on its own session.
+
+        Args:
+            backup (callable): The backup callable given to `run()`.
+        """
+        client = None
+        try:
+            client = self._connect()
+        except ConnectionError as e:
+            with self._lock:
+                # a refused extra session is fine as long as another worker connected
+                self._alive -= 1
+                give_up = self._alive == 0 and self._connected == 0
+            if give_up:
+                self._drain(e)
+            return
+        with self._lock:
+            self._connected += 1
+
+        try:
+            while not self._stop.is_set():
+                try:
+                    job = self._jobs.get_nowait()
+                except queue.Empty:
+                    break
+                client = self._backup_folder(client, job, backup)
+        finally:
+            if client is not None:
+                self._release(client)
+
+    def _backup_folder(self, client, job, backup):
+        """
+        Backs up one folder, reconnecting and retrying if the session drops.
+
+        Args:
+            client (EmailClient): The worker session, or None if it could not reconnect.
+            job (dict): The folder to back up.
+            backup (callable): The backup callable given to `run()`.
+
+        Returns:
+            EmailClient: The session to use for the next folder, or None.
+        """
+        name = job["name"]
+        for attempt in range(self._retries + 1):
+            try:
+                if client is None:
+                    client = self._connect()
+                client.select(name)
+                result = backup(client, job)
+                with self._lock:
+                    self.results[name] = result
+                return client
+            except ConnectionError as e:
+                if client is not None:
+                    self._release(client, broken=True)
+                    client = None
+                if attempt == self._retries or self._stop.is_set():
+                    with self._lock:
+                        self.errors[name] = e
+                    return client
+            except OSError as e:
+                with self._lock:
+                    self.errors[name] = e
+                self._stop.set()
+                return client
+            except Exception as e:
+                # e.g. a response the client could not parse: the folder fails, the others go
+                # on, on a new session since this one may be in the middle of a response
+                with self._lock:
+                    self.errors[name] = e
+                if client is not None:
+                    self._release(client, broken=True)
+                return None
+        return client
+
+    def _drain(self, error):
+        """
+        Records an error for every folder not started, when no session is left.
+
+        Args:
+            error (Exception): The connection error.
+        """
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            with self._lock:
+                self.errors[job["name"]] = error
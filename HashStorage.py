@@ -0,0 +1,231 @@
+from EmailStorage import EmailStorage
+import hashlib
+import os
+import tempfile
+from urllib.parse import quote
+
+
+class HashStorage(EmailStorage):
+    """
+    Content-addressed implementation of EmailStorage.
+
+    Each email is stored once, under the SHA-256 of its raw bytes, in a sharded directory
+    layout (`objects/ab/cd/abcd....eml`) that keeps directories small. A message that appears
+    in several mailboxes (INBOX, All Mail, labels) is therefore written only once, and two
+    different messages never collide, whatever their sender and subject.
+
+    Each mailbox has an index file mapping UIDs to hashes (`index/<mailbox>.<uidvalidity>.tsv`,
+    or `index/<account>/...` when several accounts share the store), appended to as emails are saved. The index also lets `contains()` skip emails that are
+    already stored before their body is downloaded.
+
+    Attributes:
+        _path_backup (str): The root directory of the store.
+        _index_name (str): The index file of the mailbox.
+        _index (dict): The UID to hash mapping of the mailbox.
+        index (MailIndex): The metadata index updated for each saved email, or None.
+
+    Usage:
+        storage = HashStorage("store", "INBOX", uidvalidity=imap.uidvalidity)
+        storage.save_email(email_obj)
+        with open(storage.object_path(storage.hash_of(email_obj.uid)), "rb") as eml_file:
+            ...
+    """
+
+    def __init__(self, path_backup="store", mailbox="INBOX", uidvalidity=None, index=None, account=None):
+        """
+        Initializes a HashStorage object and loads the mailbox index.
+
+        Args:
+            path_backup (str): The root directory of the store. Default is "store".
+            mailbox (str): The mailbox the saved emails belong to. Default is "INBOX".
+            uidvalidity (int): The UIDVALIDITY of the mailbox, part of the index name. Default is None.
+            index (MailIndex): The metadata index to update for each saved email. Default is None.
+            account (str): The account the mailbox belongs to, when several accounts share the
+                store; their mailbox indexes are kept apart. Default is None.
+        """
+        self._path_backup = path_backup
+        self._mailbox = mailbox
+        self._uidvalidity = uidvalidity
+        self.index = index
+        index_dir = os.path.join(path_backup, "index")
+        if account is not None:
+            index_dir = os.path.join(index_dir, quote(account, safe="@."))
+        self._index_name = os.path.join(index_dir, f"{quote(mailbox, safe='')}.{uidvalidity or 0}.tsv")
+        self._index = {}
+        self.file_name = None
+        self._prepared = {}
+        self._unsynced = set()
+        self._load_index()
+
+    @property
+    def path_backup(self):
+        """
+        str: The root directory of the store.
+        """
+        return self._path_backup
+
+    def _load_index(self):
+        """
+        Loads the UID to hash mapping of the mailbox, if the index file exists.
+        """
+        try:
+            with open(self._index_name) as index_file:
+                for line in index_file:
+                    fields = line.split()
+                    if len(fields) == 2:
+                        self._index[int(fields[0])] = fields[1]
+        except OSError:
+            pass
+
+    def prepare(self, email):
+        """
+        Hashes the email ahead of `save_email()`.
+
+        Args:
+            email (Email): The email object about to be saved.
+        """
+        self._prepared[id(email)] = (email, HashStorage.hash_email(email))
+
+    def save_email(self, email):
+        """
+        Save the email under the hash of its content, and record its UID in the index.
+
+        The object is written to a temporary file and renamed into place, so a partial write
+        never looks like a stored object. If an object with the same hash exists, nothing is
+        written. An email streamed to disk (its `path` is set) is hashed from its file and
+        the file is renamed into place.
+
+        Args:
+            email (Email): The email object to be saved.
+
+        Raises:
+            OSError: If there's an error during the directory creation or file writing process.
+        """
+        prepared, digest = self._prepared.pop(id(email), (None, None))
+        if prepared is not email:
+            digest = HashStorage.hash_email(email)
+        self.file_name = self.object_path(digest)
+
+        os.makedirs(os.path.dirname(self.file_name), exist_ok=True)
+        if os.path.isfile(self.file_name):
+            if email.path is not None:
+                os.remove(email.path)
+        elif email.path is not None:
+            os.replace(email.path, self.file_name)
+            self._unsynced.add(self.file_name)
+        else:
+            fd, temp_name = tempfile.mkstemp(dir=self.spool_dir(), suffix=".part")
+            with os.fdopen(fd, "wb") as eml_file:
+                eml_file.write(email.raw_bytes)
+            os.replace(temp_name, self.file_name)
+            self._unsynced.add(self.file_name)
+        if email.path is not None:
+            email.path = self.file_name
+
+        if email.uid is not None and self._index.get(email.uid) != digest:
+            os.makedirs(os.path.dirname(self._index_name), exist_ok=True)
+            with open(self._index_name, "a") as index_file:
+                index_file.write(f"{email.uid}\t{digest}\n")
+            self._index[email.uid] = digest
+            self._unsynced.add(self._index_name)
+
+        if self.index is not None:
+            self.index.add(email, self.file_name, self._mailbox, self._uidvalidity)
+
+    def flush(self):
+        """
+        Syncs the objects and index lines written since the last flush, then commits the
+        metadata index rows still buffered, if an index is attached.
+        """
+        EmailStorage.sync_files(self._unsynced)
+        self._unsynced = set()
+        if self.index is not None:
+            self.index.flush()
+
+    def contains(self, email):
+        """
+        Checks whether the email's UID is already in the mailbox index.
+
+        Args:
+            email (Email): The email object, possibly header-only.
+
+        Returns:
+            bool: True if the email is already stored, False otherwise.
+        """
+        return email.uid is not None and email.uid in self._index
+
+    def file_exists(self):
+        """
+        Checks if the object of the last saved email exists.
+
+        Returns:
+           bool: True if the file exists, False otherwise.
+        """
+        return self.file_name is not None and os.path.isfile(self.file_name)
+
+    def hash_of(self, uid):
+        """
+        Returns the content hash recorded for a UID of the mailbox.
+
+        Args:
+            uid (int): The UID of the email.
+
+        Returns:
+            str: The SHA-256 hex digest, or None if the UID is not in the index.
+        """
+        return self._index.get(int(uid))
+
+    def object_path(self, digest):
+        """
+        Returns the path of the object with the given hash.
+
+        Args:
+            digest (str): The SHA-256 hex digest.
+
+        Returns:
+            str: The path, e.g. "store/objects/ab/cd/abcd....eml".
+        """
+        return os.path.join(self._path_backup, "objects", digest[:2], digest[2:4], digest + ".eml")
+
+    def spool_dir(self):
+        """
+        Directory for emails streamed to disk before they are moved into place.
+
+        Returns:
+            str: The spool directory, created if needed.
+        """
+        path = os.path.join(self._path_backup, ".tmp")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    @staticmethod
+    def hash_email(email):
+        """
+        Computes the SHA-256 of an email, from its file if it was streamed to disk.
+
+        Args:
+            email (Email): The email object.
+
+        Returns:
+            str: The hex digest.
+        """
+        if email.path is not None:
+            return HashStorage.hash_file(email.path)
+        return hashlib.sha256(email.raw_bytes).hexdigest()
+
+    @staticmethod
+    def hash_file(path):
+        """
+        Computes the SHA-256 of a file, reading it in chunks.
+
+        Args:
+            path (str): The file to hash.
+
+        Returns:
+            str: The hex digest.
+        """
+        digest = hashlib.sha256()
+        with open(path, "rb") as eml_file:
+            for chunk in iter(lambda: eml_file.read(1024 * 1024), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
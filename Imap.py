@@ -1,8 +1,64 @@
+import base64
+import collections
 import imaplib
+import os
 import ssl
-import email  # python email module
+import re
+import socket
+import tempfile
+import threading
+import time
 from EmailClient import EmailClient
 from Email import Email  # my module
+from Metrics import Metrics
+from RateLimiter import RateLimiter
+from UidSet import UidSet
+
+
+class _LiteralSpool:
+    """
+    imaplib mixin that can write response literals straight to disk.
+
+    imaplib reads every literal (e.g. a message body) with `read(size)` and keeps it in memory.
+    While `spool_dir` is set, `read()` copies the literal to a temporary file in chunks instead,
+    and returns the file name in place of the literal bytes.
+    """
+
+    spool_dir = None
+    spool_chunk = 64 * 1024
+
+    def read(self, size):
+        if self.spool_dir is None:
+            return super().read(size)
+        fd, temp_name = tempfile.mkstemp(dir=self.spool_dir, suffix=".part")
+        self.spooled.append(temp_name)
+        with os.fdopen(fd, "wb") as temp_file:
+            remaining = size
+            while remaining > 0:
+                chunk = super().read(min(remaining, self.spool_chunk))
+                if not chunk:
+                    raise self.abort("socket closed while reading a literal")
+                temp_file.write(chunk)
+                remaining -= len(chunk)
+        return temp_name
+
+
+class _StreamingIMAP4(_LiteralSpool, imaplib.IMAP4):
+    pass
+
+
+class _StreamingIMAP4_SSL(_LiteralSpool, imaplib.IMAP4_SSL):
+    """
+    IMAP4_SSL that offers a previous TLS session to the server, to resume it.
+    """
+
+    def __init__(self, *args, tls_session=None, **kwargs):
+        self.tls_session = tls_session
+        super().__init__(*args, **kwargs)
+
+    def _create_socket(self, timeout):
+        sock = imaplib.IMAP4._create_socket(self, timeout)
+        return self.ssl_context.wrap_socket(sock, server_hostname=self.host, session=self.tls_session)
 
 
 class Imap(EmailClient):
@@ -20,21 +76,53 @@ class Imap(EmailClient):
 
     Keyword Args:
         ssl (bool): Set to True to use SSL/TLS. Default is False.
+        batch_size (int): Maximum number of messages requested by one FETCH command. Default is 100.
+        max_bytes (int): Maximum total RFC822 size requested by one FETCH command. Default is 20 MB.
+        rate_limiter (RateLimiter): Paces the SEARCH and FETCH commands and slows down when the
+            server throttles the session. Default is an unlimited RateLimiter of its own.
+        throttle_retries (int): Times a command refused by a throttling server is sent again,
+            after the rate limiter pause. Default is 5.
+        search_page (int): About how many UIDs one SEARCH answers when the server lacks
+            ESEARCH. Default is 100000.
 
     Raises:
         ConnectionError: If there's an error connecting to the IMAP server.
 
+    Note:
+        Messages are addressed by UID, so the IDs returned by `fetch_emails()` stay valid
+        for the whole session even if other clients expunge messages.
+
     Usage:
         imap = Imap(server, port, username, password, ssl=True)
         imap.connect()
         imap.check_connection()
         email_ids = imap.fetch_emails()
-        for email_id in email_ids:
-            email_obj = imap.fetch_email(email_id)
+        for email_obj in imap.fetch_batch(email_ids):
             # Process the email object
         imap.close()
     """
 
+    # FETCH response header, e.g. b'12 (UID 40 RFC822 {2048}'
+    _fetch_record = re.compile(rb'\s*\d+\s+\((?P<items>.*)\)\s*$', re.DOTALL)
+    _fetch_name = re.compile(rb'\s*(?P<name>[A-Za-z0-9.]+(?:\[[^\]]*\])?(?:<\d+>)?)\s*')
+    _fetch_atom = re.compile(rb'[^\s()]+')
+    # LIST response, e.g. b'(\\HasNoChildren) "/" "Archive/2023"'
+    _list_record = re.compile(rb'\((?P<flags>[^)]*)\)\s+(?P<delimiter>"(?:[^"\\]|\\.)*"|NIL)\s*(?P<name>.*)$',
+                              re.DOTALL)
+    # STATUS response, e.g. b'"INBOX" (MESSAGES 12 UIDNEXT 40 UIDVALIDITY 3)'
+    _status_items = re.compile(rb'\(([^()]*)\)\s*$')
+    # ALL result of an ESEARCH response, e.g. b'(TAG "A4") UID ALL 1:3,5'
+    _esearch_all = re.compile(rb'\bALL\s+([\d:,]+)', re.IGNORECASE)
+
+    # TLS context and last TLS session of each (server, port), shared by all the sessions of
+    # the process so that new connections resume the TLS session instead of a full handshake
+    _tls_contexts = {}
+    _tls_sessions = {}
+    _tls_lock = threading.Lock()
+
+    # size assumed for a message of unknown size before any message was downloaded
+    _default_size = 64 * 1024
+
     def __init__(self, server, port, username, password, **opt):
         super().__init__(server, port, username, password, **opt)
 
@@ -43,7 +131,33 @@ class Imap(EmailClient):
         else:
             self._is_ssl = False
 
+        if "batch_size" in opt:
+            self._batch_size = opt['batch_size']
+        else:
+            # default number of messages per FETCH command
+            self._batch_size = 100
+
+        if "max_bytes" in opt:
+            self._max_bytes = opt['max_bytes']
+        else:
+            # default byte budget per FETCH command
+            self._max_bytes = 20 * 1024 * 1024
+
+        # an unlimited limiter still backs off when the server throttles the session
+        self._rate_limiter = opt.get('rate_limiter') or RateLimiter()
+        self._throttle_retries = opt.get('throttle_retries', 5)
+        self._search_page = max(1, opt.get('search_page', 100000))
+        # messages and bytes downloaded, for the size estimate of messages of unknown size
+        self._fetched_count = 0
+        self._fetched_bytes = 0
+
         self._connection = None
+        self._capabilities = set()
+        self._mailbox = None
+        self._uidvalidity = None
+        self._uidnext = None
+        self._exists = None
+        self._highestmodseq = None
 
     def connect(self, path="INBOX"):
         """
@@ -58,45 +172,419 @@ class Imap(EmailClient):
 
         try:
             if self._is_ssl:
+                context, session = self._tls_state()
+                self._connection = _StreamingIMAP4_SSL(self._server, self._port, ssl_context=context,
+                                                       tls_session=session)
+            else:
+                self._connection = _StreamingIMAP4(self._server, self._port)
+            # imaplib sends a literal and the end of its command in two writes; with Nagle's
+            # algorithm the second one waits for the delayed ACK of the first, 40 ms per APPEND
+            self._connection.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+            self._connection.login(self._username, self._password)
+            if self._is_ssl:
+                self._save_tls_session()
+            self._read_capabilities()
+            if self.condstore and "ENABLE" in self._capabilities:
+                self._connection.enable("CONDSTORE")
+            self.select(path)  # Select the desired mailbox after logging in
+
+        except imaplib.IMAP4.error as e:
+            raise ConnectionError(str(e))
+
+        except Exception as e:
+            raise ConnectionError(str(e))
+
+    def _tls_state(self):
+        """
+        Returns the shared TLS context of the server and its last session, if any.
+
+        Returns:
+            tuple: (SSLContext, SSLSession or None).
+        """
+        key = (self._server, self._port)
+        with Imap._tls_lock:
+            if key not in Imap._tls_contexts:
                 context = ssl.create_default_context()
                 context.check_hostname = False
                 context.verify_mode = ssl.CERT_NONE
-                self._connection = imaplib.IMAP4_SSL(self._server, self._port, ssl_context=context)
-            else:
-                self._connection = imaplib.IMAP4(self._server, self._port)
+                Imap._tls_contexts[key] = context
+            return Imap._tls_contexts[key], Imap._tls_sessions.get(key)
 
-            self._connection.login(self._username, self._password)
-            self._connection.select(path)  # Select the desired mailbox after logging in
+    def _save_tls_session(self):
+        """
+        Records the TLS session of the new connection for the next ones, and counts resumptions.
+
+        With TLS 1.3 the session ticket arrives after the handshake, so this is called once
+        the LOGIN answer has been read.
+        """
+        sock = self._connection.sock
+        if sock.session_reused:
+            Metrics.shared().inc("emailsafe_tls_resumed_total")
+        session = sock.session
+        if session is not None and session.has_ticket:
+            with Imap._tls_lock:
+                Imap._tls_sessions[(self._server, self._port)] = session
 
+    @property
+    def tls_resumed(self):
+        """
+        bool: True if the connection resumed a previous TLS session.
+        """
+        return bool(self._is_ssl and self._connection is not None and self._connection.sock.session_reused)
+
+    def noop(self):
+        """
+        Checks that the session is still alive with a NOOP command.
+
+        Returns:
+            bool: True if the server answered OK, False if the session is dead.
+        """
+        if self._connection is None:
+            return False
+        try:
+            status, _ = self._connection.noop()
+        except Exception:
+            return False
+        return status == "OK"
+
+    def _read_capabilities(self):
+        """
+        Refreshes the server capabilities after login.
+
+        Servers often advertise more capabilities once the client is authenticated,
+        so the list sent in the greeting is not enough to detect CONDSTORE.
+        """
+        status, data = self._connection.capability()
+        if status == "OK" and data and data[0]:
+            self._capabilities = set(data[0].decode("ascii", errors="ignore").upper().split())
+            self._connection.capabilities = tuple(self._capabilities)
+
+    def select(self, path):
+        """
+        Selects a mailbox and records its UIDVALIDITY, UIDNEXT and HIGHESTMODSEQ.
+
+        Args:
+            path (str): The mailbox path to select, as returned by `list_folders()`.
+
+        Raises:
+            ConnectionError: If the mailbox cannot be selected.
+        """
+        try:
+            status, data = self._connection.select(Imap.quote(path))
         except imaplib.IMAP4.error as e:
             raise ConnectionError(str(e))
+        if status != "OK":
+            raise ConnectionError(f"Cannot select mailbox {path}: {data}")
+        self._mailbox = path
+        self._uidvalidity = self._response_number("UIDVALIDITY")
+        self._uidnext = self._response_number("UIDNEXT")
+        self._exists = int(data[0]) if data and data[0] and data[0].isdigit() else None
+        self._highestmodseq = self._response_number("HIGHESTMODSEQ")
+
+    def list_folders(self):
+        """
+        Lists every folder of the account with `LIST "" "*"`.
+
+        Returns:
+            list: A list of `(name, delimiter, flags)` tuples. `name` is the folder name as
+            the server knows it (modified UTF-7), `delimiter` the hierarchy delimiter or None,
+            and `flags` a set of upper-case attributes such as "\\NOSELECT".
 
+        Raises:
+            ConnectionError: If the connection is not established or the command fails.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        try:
+            status, data = self._connection.list('""', "*")
         except Exception as e:
             raise ConnectionError(str(e))
+        if status != "OK":
+            raise ConnectionError(f"LIST failed: {data}")
 
-    def fetch_emails(self):
+        folders = []
+        for item in data:
+            literal = None
+            if isinstance(item, tuple):
+                item, literal = item
+            if not isinstance(item, bytes):
+                continue
+            match = Imap._list_record.match(item)
+            if match is None:
+                continue
+            flags = set(match.group("flags").decode("ascii", errors="ignore").upper().split())
+            delimiter = match.group("delimiter")
+            delimiter = None if delimiter == b"NIL" else Imap._unquote(delimiter)
+            if literal is not None:
+                name = literal.decode("utf-8", errors="replace")
+            else:
+                name = Imap._unquote(match.group("name").strip())
+            folders.append((name, delimiter, flags))
+        return folders
+
+    def status(self, path, items=("MESSAGES", "UIDNEXT", "UIDVALIDITY")):
         """
-        Fetches the list of email IDs.
+        Reads the status of a folder without selecting it.
+
+        Args:
+            path (str): The folder name, as returned by `list_folders()`.
+            items (tuple): The status items to request. Default is MESSAGES, UIDNEXT and UIDVALIDITY.
 
         Returns:
-            list: A list of email IDs.
+            dict: The status items, by upper-case name, as ints.
 
         Raises:
-            ConnectionError: If the connection to the IMAP server is not established.
+            ConnectionError: If the connection is not established or the command fails.
         """
         if self._connection is None:
             raise ConnectionError("Connection not established.")
+        try:
+            status, data = self._connection.status(Imap.quote(path), f"({' '.join(items)})")
+        except Exception as e:
+            raise ConnectionError(str(e))
+        if status != "OK":
+            raise ConnectionError(f"STATUS failed for {path}: {data}")
 
-        status, email_ids = self._connection.search(None, "ALL")
+        text = b"".join(part[0] if isinstance(part, tuple) else part for part in data if part)
+        match = Imap._status_items.search(text)
+        values = match.group(1).decode("ascii", errors="ignore").split() if match else []
+        return {name.upper(): int(value) for name, value in zip(values[::2], values[1::2])
+                if value.isdigit()}
 
-        return email_ids[0].split()
+    def _response_number(self, code):
+        """
+        Reads a numeric response code (e.g. UIDVALIDITY) from the last command.
+
+        Args:
+            code (str): The response code name.
+
+        Returns:
+            int: The value, or None if the server did not send it.
+        """
+        typ, data = self._connection.response(code)
+        try:
+            return int(data[-1])
+        except (TypeError, ValueError, IndexError):
+            return None
+
+    @property
+    def mailbox(self):
+        """
+        str: The selected mailbox, or None before `connect()`.
+        """
+        return self._mailbox
+
+    @property
+    def uidvalidity(self):
+        """
+        int: The UIDVALIDITY of the selected mailbox, or None if unknown.
+        """
+        return self._uidvalidity
+
+    @property
+    def uidnext(self):
+        """
+        int: The UIDNEXT of the selected mailbox when it was selected, or None if unknown.
+        """
+        return self._uidnext
+
+    @property
+    def highestmodseq(self):
+        """
+        int: The HIGHESTMODSEQ of the selected mailbox, or None if CONDSTORE is not available.
+        """
+        return self._highestmodseq
+
+    @property
+    def condstore(self):
+        """
+        bool: True if the server supports CONDSTORE (QRESYNC implies CONDSTORE).
+        """
+        return "CONDSTORE" in self._capabilities or "QRESYNC" in self._capabilities
+
+    def _uid(self, command, *args, size=0):
+        """
+        Sends a UID command through the rate limiter.
+
+        A BYE, a dropped connection or a throttling response ([THROTTLED], [UNAVAILABLE] ...)
+        is reported to the limiter, which slows down the next commands of every session
+        sharing it. A refused command is sent again once the limiter lets it, up to
+        `throttle_retries` times, since the session is still alive; a closed connection is
+        raised as a ConnectionError right away, for the caller to reconnect.
+
+        Args:
+            command (str): The UID command, e.g. "FETCH".
+            *args: The command arguments.
+            size (int): The bytes the command is expected to download. Default is 0.
+
+        Returns:
+            tuple: The status and data of the response.
+
+        Raises:
+            ConnectionError: If the server kept throttling the session or closed the connection.
+        """
+        for attempt in range(self._throttle_retries + 1):
+            self._rate_limiter.acquire(size)
+            start = time.monotonic()
+            try:
+                status, data = self._connection.uid(command, *args)
+            except imaplib.IMAP4.abort as e:
+                self._rate_limiter.throttled()
+                raise ConnectionError(f"Connection closed by the server: {e}")
+            if status == "OK" or not RateLimiter.is_throttled(data):
+                self._rate_limiter.record(size, time.monotonic() - start)
+                return status, data
+            self._rate_limiter.throttled()
+        raise ConnectionError(f"Server throttled the session: {data}")
+
+    def fetch_emails(self, criteria=None):
+        """
+        Fetches the list of email UIDs.
+
+        The server evaluates the criteria over its own index, so only the UIDs of the matching
+        messages are sent back, e.g. the criteria of a `SearchFilter`. Criteria with non-ASCII
+        text are sent with CHARSET UTF-8.
+
+        The UIDs are kept as ranges (see `UidSet`), so listing a mailbox takes the same memory
+        whatever its size. With ESEARCH, `UID SEARCH RETURN (ALL)` answers with one compact
+        sequence set. Otherwise the mailbox is searched in windows of UIDs, each expected to
+        hold about `search_page` messages, so no response is larger than one page.
+
+        Args:
+            criteria (str): IMAP SEARCH criteria, e.g. 'SINCE 1-Jan-2024 FROM "alice"'. Default is "ALL".
+
+        Returns:
+            UidSet: The email UIDs, iterated in ascending order as bytes.
+
+        Raises:
+            ConnectionError: If the connection to the IMAP server is not established, or the
+                server rejects the criteria.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        return self._search_uids(criteria or "ALL")
+
+    def _search_uids(self, criteria, first_uid=1):
+        """
+        Runs a UID SEARCH, by ESEARCH or page by page, into a UidSet.
+
+        Args:
+            criteria (str): The SEARCH criteria.
+            first_uid (int): The lowest UID wanted. Default is 1.
+
+        Returns:
+            UidSet: The matching UIDs from `first_uid` up.
+
+        Raises:
+            ConnectionError: If the server rejects the command.
+        """
+        charset = None
+        if not criteria.isascii():
+            charset, criteria = "CHARSET UTF-8", criteria.encode("utf-8")
+        uids = UidSet()
+        if "ESEARCH" in self._capabilities:
+            window = f"UID {first_uid}:*" if first_uid > 1 else None
+            status, data = self._search("RETURN (ALL)", charset, window, criteria)
+            _, results = self._connection.response("ESEARCH")
+            for result in results or ():
+                match = Imap._esearch_all.search(result or b"")
+                if match is not None:
+                    for first, last in UidSet.from_sequence_set(match.group(1)).ranges():
+                        if last >= first_uid:
+                            uids.add_range(max(first, first_uid), last)
+            return uids
+
+        if self._uidnext is None or (first_uid == 1 and self._uidnext <= self._search_page):
+            windows = [None if first_uid == 1 else f"UID {first_uid}:*"]
+        else:
+            # sparse mailboxes get wider windows, so that each page holds about search_page UIDs
+            span = self._search_page * max(1, (self._uidnext - 1) // max(1, self._exists or 1))
+            starts = range(first_uid, max(first_uid, self._uidnext - 1) + 1, span)
+            windows = [f"UID {start}:{start + span - 1}" for start in starts[:-1]] + [f"UID {starts[-1]}:*"]
+        for window in windows:
+            status, data = self._search(None, charset, window, criteria)
+            page = (data[0] or b"").split()
+            if first_uid > 1:
+                # "n:*" always matches the last message, even when its UID is lower than n
+                page = [uid for uid in page if int(uid) >= first_uid]
+            uids.update(page)
+        return uids
+
+    def _search(self, options, charset, window, criteria):
+        """
+        Sends one UID SEARCH command.
+
+        Args:
+            options (str): The ESEARCH return options, e.g. "RETURN (ALL)", or None.
+            charset (str): "CHARSET UTF-8", or None for ASCII criteria.
+            window (str): A UID range restricting the search, e.g. "UID 1:100000", or None.
+            criteria (str | bytes): The SEARCH criteria.
+
+        Returns:
+            tuple: The status and data of the response.
+
+        Raises:
+            ConnectionError: If the server rejects the command.
+        """
+        args = [arg for arg in (options, charset, window) if arg is not None]
+        if window is not None and criteria == "ALL":
+            criteria = None  # "UID 1:100" alone is the same search
+        if not args:
+            args = [None]  # imaplib.uid() expects the charset position
+        try:
+            status, data = self._uid("SEARCH", *args, criteria)
+        except imaplib.IMAP4.error as e:
+            raise ConnectionError(f"Search failed: {e}")
+        if status != "OK":
+            raise ConnectionError(f"Search failed: {data}")
+        return status, data
+
+    def fetch_new_emails(self, last_uid=0, highestmodseq=None):
+        """
+        Fetches the UIDs of the messages added since a previous run.
+
+        When the server supports CONDSTORE and the mailbox HIGHESTMODSEQ has not moved since
+        `highestmodseq`, nothing has changed and no command is sent at all. Otherwise the new
+        UIDs are found with `UID FETCH <last_uid+1>:* (UID) (CHANGEDSINCE <highestmodseq>)`,
+        or with `UID SEARCH UID <last_uid+1>:*` when CONDSTORE is not available.
+
+        Args:
+            last_uid (int): The highest UID already backed up. Default is 0.
+            highestmodseq (int): The HIGHESTMODSEQ seen at the end of the previous run. Default is None.
+
+        Returns:
+            UidSet: The email UIDs greater than `last_uid`.
+
+        Raises:
+            ConnectionError: If the connection is not established or the command fails.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+
+        use_modseq = highestmodseq is not None and self._highestmodseq is not None
+        if use_modseq and self._highestmodseq <= highestmodseq:
+            return UidSet()
+        if not use_modseq:
+            return self._search_uids("ALL", last_uid + 1)
+
+        try:
+            status, email_data = self._uid("FETCH", f"{last_uid + 1}:*", "(UID)", f"(CHANGEDSINCE {highestmodseq})")
+        except Exception as e:
+            raise ConnectionError(str(e))
+        if status != "OK":
+            raise ConnectionError(f"Cannot list new messages: {email_data}")
+
+        # "n:*" always matches the last message, even when its UID is lower than n
+        return UidSet(record["UID"] for record in Imap.parse_fetch(email_data)
+                      if "UID" in record and int(record["UID"]) > last_uid)
 
     def fetch_email(self, email_id):
         """
-        Fetches the email message with the specified ID.
+        Fetches the email message with the specified UID.
 
         Args:
-            email_id (bytes): The ID of the email message.
+            email_id (bytes): The UID of the email message.
 
         Returns:
             Email: An Email object representing the fetched email.
@@ -107,13 +595,594 @@ class Imap(EmailClient):
         if self._connection is None:
             raise ConnectionError("Connection not established.")
         try:
-            status, email_data = self._connection.fetch(email_id, "(RFC822)")
+            status, email_data = self._uid("FETCH", email_id, "(RFC822)")
             raw_email = email_data[0][1]  # Use index 1 to access email data
-            msg = email.message_from_bytes(raw_email)
-            return Email(msg)
+            if not isinstance(raw_email, bytes):
+                raise ConnectionError(f"Email {email_id!r} not found")
+            return Email(raw_email, uid=email_id)
         except Exception as e:
             raise ConnectionError(str(e))
 
+    def fetch_batch(self, email_ids, batch_size=None, max_bytes=None, sizes=None):
+        """
+        Fetches many email messages with as few FETCH commands as possible.
+
+        The UIDs are split into chunks of at most `batch_size` messages, and each chunk is cut
+        into batches whose total size stays within `max_bytes`. Each batch is downloaded with a
+        single `UID FETCH <set> (UID FLAGS INTERNALDATE RFC822.SIZE RFC822)` command, so the
+        flags and the internal date of each message are kept for a restore. A message larger
+        than the budget is fetched on its own. The sizes come from `sizes`; a message of unknown
+        size counts as the mean size of the messages downloaded so far, so no extra command is
+        spent on sizes.
+
+        Args:
+            email_ids (iterable): The UIDs of the email messages.
+            batch_size (int): Maximum number of messages per command. Defaults to the client option.
+            max_bytes (int): Maximum total size per command. Defaults to the client option.
+            sizes (dict): Known RFC822.SIZE per integer UID, e.g. from `fetch_sizes()`, so the
+                sizes do not have to be requested again. Default is None.
+
+        Yields:
+            Email: An Email object for each fetched message, in the order the server returns them.
+
+        Raises:
+            ConnectionError: If the connection is not established or a FETCH command fails.
+        """
+        for record in self._fetch_records(email_ids, batch_size, max_bytes, "RFC822", sizes=sizes):
+            yield Imap._with_state(Email(record["RFC822"], uid=record.get("UID")), record)
+
+    def fetch_batch_to_files(self, email_ids, spool_dir, batch_size=None, max_bytes=None, sizes=None):
+        """
+        Fetches many email messages straight to disk, without holding them in memory.
+
+        Works like `fetch_batch()`, but each message body is copied from the socket to a
+        temporary file in `spool_dir` in small chunks, and only its header block is parsed.
+        `BODY.PEEK[]` is used so the messages are not marked as seen. The temporary files are
+        meant to be renamed into place by the storage backend, so `spool_dir` should be on the
+        same filesystem as the backup.
+
+        Args:
+            email_ids (iterable): The UIDs of the email messages.
+            spool_dir (str): The directory for the temporary files.
+            batch_size (int): Maximum number of messages per command. Defaults to the client option.
+            max_bytes (int): Maximum total size per command. Defaults to the client option.
+            sizes (dict): Known RFC822.SIZE per integer UID. Default is None.
+
+        Yields:
+            Email: A file-backed Email object (see `Email.from_file`) for each fetched message.
+
+        Raises:
+            ConnectionError: If the connection is not established or a FETCH command fails.
+        """
+        for record in self._fetch_records(email_ids, batch_size, max_bytes, "BODY.PEEK[]", spool_dir, sizes):
+            yield Imap._with_state(Email.from_file(record["BODY[]"], uid=record.get("UID")), record)
+
+    def _fetch_records(self, email_ids, batch_size, max_bytes, item, spool_dir=None, sizes=None):
+        """
+        Runs the batched FETCH commands shared by `fetch_batch()` and `fetch_batch_to_files()`.
+
+        Args:
+            email_ids (iterable): The UIDs of the email messages.
+            batch_size (int): Maximum number of messages per command, or None for the client option.
+            max_bytes (int): Maximum total size per command, or None for the client option.
+            item (str): The FETCH data item holding the message, e.g. "RFC822".
+            spool_dir (str): Directory to stream literals to, or None to keep them in memory.
+            sizes (dict): Known RFC822.SIZE per integer UID, or None.
+
+        Yields:
+            dict: The parsed FETCH response of each message.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        batch_size = batch_size or self._batch_size
+        max_bytes = max_bytes or self._max_bytes
+
+        chunk = []
+        for email_id in email_ids:
+            chunk.append(email_id)
+            if len(chunk) >= batch_size:
+                yield from self._fetch_chunk(chunk, max_bytes, item, spool_dir, sizes)
+                chunk = []
+        if chunk:
+            yield from self._fetch_chunk(chunk, max_bytes, item, spool_dir, sizes)
+
+    def _fetch_chunk(self, email_ids, max_bytes, item, spool_dir, sizes=None):
+        """
+        Fetches one chunk of UIDs, split into byte-bounded batches.
+
+        Args:
+            email_ids (list): The UIDs of the chunk.
+            max_bytes (int): Maximum total size per FETCH command.
+            item (str): The FETCH data item holding the message.
+            spool_dir (str): Directory to stream literals to, or None.
+            sizes (dict): Known RFC822.SIZE per integer UID, or None.
+
+        Yields:
+            dict: The parsed FETCH response of each message.
+        """
+        sizes = sizes or {}
+        batch = []
+        batch_bytes = 0
+        for email_id in email_ids:
+            size = sizes.get(int(email_id))
+            if size is None:
+                size = self._fetched_bytes // self._fetched_count if self._fetched_count else Imap._default_size
+            if batch and batch_bytes + size > max_bytes:
+                yield from self._fetch_messages(batch, item, spool_dir, batch_bytes)
+                batch = []
+                batch_bytes = 0
+            batch.append(email_id)
+            batch_bytes += size
+        if batch:
+            yield from self._fetch_messages(batch, item, spool_dir, batch_bytes)
+
+    def _fetch_messages(self, email_ids, item, spool_dir, size=0):
+        """
+        Downloads a batch of messages with one UID FETCH command.
+
+        Args:
+            email_ids (list): The UIDs to download.
+            item (str): The FETCH data item holding the message.
+            spool_dir (str): Directory to stream literals to, or None.
+            size (int): The total RFC822.SIZE of the batch, charged to the rate limiter. Default is 0.
+
+        Yields:
+            dict: The parsed FETCH response of each message.
+
+        Raises:
+            ConnectionError: If the FETCH command fails.
+        """
+        # the server answers BODY.PEEK[] with BODY[]
+        key = item.replace(".PEEK", "")
+        metrics = Metrics.shared()
+        self._connection.spool_dir = spool_dir
+        self._connection.spooled = []
+        try:
+            with metrics.time("emailsafe_fetch_seconds"):
+                status, email_data = self._uid("FETCH", Imap.sequence_set(email_ids),
+                                                   f"(UID FLAGS INTERNALDATE RFC822.SIZE {item})", size=size)
+            if status != "OK":
+                raise ConnectionError(f"FETCH failed: {email_data}")
+        except Exception as e:
+            for temp_name in self._connection.spooled:
+                if os.path.exists(temp_name):
+                    os.remove(temp_name)
+            raise ConnectionError(str(e))
+        finally:
+            self._connection.spool_dir = None
+
+        for record in Imap.parse_fetch(email_data):
+            if key not in record:
+                continue  # unsolicited FETCH response, e.g. a flag update
+            message = record[key]
+            metrics.inc("emailsafe_fetch_messages_total")
+            metrics.inc("emailsafe_fetch_bytes_total",
+                        len(message) if isinstance(message, bytes) else os.path.getsize(message))
+            if "RFC822.SIZE" in record:
+                self._fetched_count += 1
+                self._fetched_bytes += int(record["RFC822.SIZE"])
+            yield record
+
+    def fetch_headers(self, email_ids, batch_size=None, fields=("FROM", "SUBJECT", "DATE", "MESSAGE-ID")):
+        """
+        Fetches the size and a few headers of many messages, without their bodies.
+
+        Each command is `UID FETCH <set> (UID RFC822.SIZE BODY.PEEK[HEADER.FIELDS (...)])`.
+        The answers are a few hundred bytes per message, so the batches are ten times larger
+        than for full downloads and a whole mailbox takes only a few commands.
+
+        Args:
+            email_ids (iterable): The UIDs of the email messages.
+            batch_size (int): Messages per command. Defaults to ten times the client option.
+            fields (tuple): The header fields to fetch. Default is From, Subject, Date and Message-ID.
+
+        Yields:
+            Email: A header-only Email object (see `Email.from_headers`) for each message.
+
+        Raises:
+            ConnectionError: If the connection is not established or a FETCH command fails.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        batch_size = batch_size or self._batch_size * 10
+        item = f"BODY.PEEK[HEADER.FIELDS ({' '.join(fields)})]"
+
+        chunk = []
+        for email_id in email_ids:
+            chunk.append(email_id)
+            if len(chunk) >= batch_size:
+                yield from self._fetch_header_chunk(chunk, item)
+                chunk = []
+        if chunk:
+            yield from self._fetch_header_chunk(chunk, item)
+
+    def _fetch_header_chunk(self, email_ids, item):
+        """
+        Fetches the headers of one chunk of UIDs with one command.
+
+        Args:
+            email_ids (list): The UIDs of the chunk.
+            item (str): The BODY.PEEK[HEADER.FIELDS (...)] data item.
+
+        Yields:
+            Email: A header-only Email object for each message.
+        """
+        try:
+            status, email_data = self._uid("FETCH", Imap.sequence_set(email_ids), f"(UID RFC822.SIZE {item})")
+        except Exception as e:
+            raise ConnectionError(str(e))
+        if status != "OK":
+            raise ConnectionError(f"FETCH failed: {email_data}")
+
+        for record in Imap.parse_fetch(email_data):
+            header_block = next((value for name, value in record.items()
+                                 if name.startswith("BODY[HEADER.FIELDS")), None)
+            if "UID" not in record or header_block is None:
+                continue
+            if not isinstance(header_block, bytes):
+                header_block = b""  # NIL
+            yield Email.from_headers(header_block, uid=record["UID"], size=record.get("RFC822.SIZE"))
+
+    def fetch_sizes(self, email_ids):
+        """
+        Fetches the RFC822.SIZE of several messages with one command.
+
+        Args:
+            email_ids (iterable): The UIDs of the email messages.
+
+        Returns:
+            dict: A mapping of integer UID to message size in bytes.
+
+        Raises:
+            ConnectionError: If the connection is not established or the FETCH command fails.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        try:
+            status, email_data = self._uid("FETCH", Imap.sequence_set(email_ids), "(UID RFC822.SIZE)")
+        except Exception as e:
+            raise ConnectionError(str(e))
+        if status != "OK":
+            raise ConnectionError(f"FETCH failed: {email_data}")
+
+        sizes = {}
+        for record in Imap.parse_fetch(email_data):
+            if "UID" in record and "RFC822.SIZE" in record:
+                sizes[int(record["UID"])] = int(record["RFC822.SIZE"])
+        return sizes
+
+    def create(self, path):
+        """
+        Creates a mailbox.
+
+        Args:
+            path (str): The mailbox name, e.g. as returned by `list_folders()`.
+
+        Raises:
+            ConnectionError: If the connection is not established or the mailbox cannot be created.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        try:
+            status, data = self._connection.create(Imap.quote(path))
+        except Exception as e:
+            raise ConnectionError(str(e))
+        if status != "OK" and "ALREADYEXISTS" not in str(data).upper():
+            raise ConnectionError(f"Cannot create mailbox {path}: {data}")
+
+    def append(self, emails, path, batch_size=None, max_bytes=None, pipeline=4):
+        """
+        Uploads messages to a mailbox, with their flags and internal dates.
+
+        With LITERAL+ (RFC 7888) the messages are sent as non-synchronizing literals, without
+        waiting for the "+" continuation of the server, and up to `pipeline` APPEND commands
+        are sent before the answer of the first one is read. With MULTIAPPEND (RFC 3502) as
+        well, one command carries up to `batch_size` messages and `max_bytes` bytes, stored by
+        the server all or none. Without LITERAL+ every message takes one synchronizing APPEND.
+
+        Each command goes through the rate limiter, and a command refused by a throttling
+        server is sent again once the limiter lets it, up to `throttle_retries` times. When a
+        command fails, the answers of the commands already sent are read before the error is
+        raised, so the session can still be used.
+
+        Args:
+            emails (list): The Email objects to upload; their `flags` and `internal_date` are kept.
+            path (str): The destination mailbox, which must exist.
+            batch_size (int): Maximum messages per MULTIAPPEND command. Defaults to the client option.
+            max_bytes (int): Maximum message bytes per MULTIAPPEND command. Defaults to the client option.
+            pipeline (int): Maximum APPEND commands in flight. Default is 4.
+
+        Returns:
+            int: The number of messages stored.
+
+        Raises:
+            ConnectionError: If the connection is not established, an APPEND command fails, or
+                the server kept throttling the session.
+        """
+        if self._connection is None:
+            raise ConnectionError("Connection not established.")
+        literal_plus = "LITERAL+" in self._capabilities
+        if literal_plus and "MULTIAPPEND" in self._capabilities:
+            batch_size = batch_size or self._batch_size
+            max_bytes = max_bytes or self._max_bytes
+        else:
+            batch_size = 1
+
+        # IMAP lines end with CRLF, also inside the messages
+        messages = [(imaplib.MapCRLF.sub(imaplib.CRLF, email_obj.raw_bytes), Imap._append_flags(email_obj.flags),
+                     email_obj.internal_date) for email_obj in emails]
+        pending = collections.deque()
+        group = []
+        group_bytes = 0
+        for message in messages:
+            if group and (len(group) >= batch_size or group_bytes + len(message[0]) > max_bytes):
+                pending.append((group, 0))
+                group = []
+                group_bytes = 0
+            group.append(message)
+            group_bytes += len(message[0])
+        if group:
+            pending.append((group, 0))
+
+        stored = 0
+        error = None
+        in_flight = collections.deque()
+        try:
+            while pending or in_flight:
+                while pending and len(in_flight) < (pipeline if literal_plus else 1):
+                    group, attempt = pending.popleft()
+                    size = sum(len(message[0]) for message in group)
+                    self._rate_limiter.acquire(size)
+                    start = time.monotonic()
+                    if literal_plus:
+                        reply = self._send_append(path, group)
+                    else:
+                        message, flags, date = group[0]
+                        reply = self._connection.append(Imap.quote(path), flags or None,
+                                                        f'"{date}"' if date else None, message)
+                    in_flight.append((reply, group, attempt, size, start))
+                reply, group, attempt, size, start = in_flight.popleft()
+                status, data = reply if isinstance(reply, tuple) else self._connection._command_complete("APPEND", reply)
+                if status == "OK":
+                    self._rate_limiter.record(size, time.monotonic() - start)
+                    stored += len(group)
+                elif RateLimiter.is_throttled(data) and attempt < self._throttle_retries and error is None:
+                    self._rate_limiter.throttled()
+                    pending.append((group, attempt + 1))
+                elif error is None:
+                    error = f"APPEND to {path} failed: {data}"
+                    pending.clear()  # read the answers in flight, send nothing more
+        except imaplib.IMAP4.abort as e:
+            self._rate_limiter.throttled()
+            raise ConnectionError(f"Connection closed by the server: {e}")
+        except imaplib.IMAP4.error as e:
+            raise ConnectionError(str(e))
+        if error is not None:
+            raise ConnectionError(error)
+        return stored
+
+    def _send_append(self, path, group):
+        """
+        Sends one APPEND command with non-synchronizing literals, without reading its answer.
+
+        Args:
+            path (str): The destination mailbox.
+            group (list): (message bytes, flags, internal date) of each message; several
+                messages make a MULTIAPPEND command.
+
+        Returns:
+            bytes: The tag of the command, to read its answer with `_command_complete()`.
+        """
+        tag = self._connection._new_tag()
+        parts = [tag, b" APPEND ", Imap.quote(path).encode("utf-8")]
+        for message, flags, date in group:
+            parts.append(f" ({flags})".encode("ascii"))
+            if date:
+                parts.append(f' "{date}"'.encode("ascii"))
+            parts.append(b" {%d+}\r\n" % len(message))
+            parts.append(message)
+        parts.append(b"\r\n")
+        self._connection.send(b"".join(parts))
+        return tag
+
+    @staticmethod
+    def _append_flags(flags):
+        """
+        Returns the flags of a message that an APPEND can set.
+
+        Args:
+            flags (str): The flags recorded at backup time, e.g. "\\Seen \\Recent", or None.
+
+        Returns:
+            str: The flags without \\Recent, which only the server sets, e.g. "\\Seen".
+        """
+        return " ".join(flag for flag in (flags or "").split() if flag.upper() != "\\RECENT")
+
+    @staticmethod
+    def sequence_set(email_ids):
+        """
+        Builds a compact IMAP sequence set from a list of IDs.
+
+        Consecutive IDs are collapsed into ranges, e.g. [1, 2, 3, 7, 9, 10] becomes "1:3,7,9:10".
+
+        Args:
+            email_ids (iterable): The IDs, as bytes, str or int.
+
+        Returns:
+            str: The sequence set.
+        """
+        numbers = sorted(set(int(email_id) for email_id in email_ids))
+        ranges = []
+        start = previous = None
+        for number in numbers:
+            if previous is not None and number == previous + 1:
+                previous = number
+                continue
+            if start is not None:
+                ranges.append(str(start) if start == previous else f"{start}:{previous}")
+            start = previous = number
+        if start is not None:
+            ranges.append(str(start) if start == previous else f"{start}:{previous}")
+        return ",".join(ranges)
+
+    @staticmethod
+    def quote(text):
+        """
+        Quotes a mailbox name for an IMAP command.
+
+        Args:
+            text (str): The mailbox name.
+
+        Returns:
+            str: The name as an IMAP quoted string.
+        """
+        return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    @staticmethod
+    def _unquote(text):
+        """
+        Reads an IMAP quoted string or atom.
+
+        Args:
+            text (bytes): The quoted string or atom.
+
+        Returns:
+            str: The unquoted value.
+        """
+        text = text.decode("utf-8", errors="replace")
+        if len(text) >= 2 and text[0] == text[-1] == '"':
+            return re.sub(r'\\(.)', r'\1', text[1:-1])
+        return text
+
+    @staticmethod
+    def decode_folder(name):
+        """
+        Decodes a folder name from IMAP modified UTF-7 (RFC 3501), e.g. "Entw&APw-rfe" to "Entwürfe".
+
+        Args:
+            name (str): The folder name as sent by the server.
+
+        Returns:
+            str: The readable folder name; the name itself if it is not valid modified UTF-7.
+        """
+        def decode(match):
+            encoded = match.group(1)
+            if not encoded:
+                return "&"
+            encoded = encoded.replace(",", "/")
+            return base64.b64decode(encoded + "=" * (-len(encoded) % 4)).decode("utf-16-be")
+
+        try:
+            return re.sub(r"&([A-Za-z0-9+,]*)-", decode, name)
+        except (ValueError, UnicodeDecodeError):
+            return name
+
+    @staticmethod
+    def parse_fetch(email_data):
+        """
+        Parses the data returned by imaplib for a FETCH command.
+
+        imaplib returns each FETCH response as one or more `(header, literal)` tuples followed
+        by the closing bytes of the line, or as plain bytes when the response has no literal.
+
+        Args:
+            email_data (list): The data part of the `(status, data)` pair returned by imaplib.
+
+        Returns:
+            list: A list of dicts, one per message, mapping item names (e.g. "UID", "RFC822",
+            "RFC822.SIZE") to their values. Literal values are bytes, numbers and atoms are
+            str, and parenthesized lists are kept as their raw str form.
+        """
+        records = []
+        parts = None
+        for item in email_data:
+            if isinstance(item, tuple):
+                if parts is None:
+                    parts = []
+                parts.append(item)
+            elif isinstance(item, bytes):
+                if parts is None:
+                    records.append(Imap._parse_fetch_record(item, []))
+                else:
+                    text = b"".join(part[0] for part in parts) + item
+                    records.append(Imap._parse_fetch_record(text, [part[1] for part in parts]))
+                    parts = None
+        if parts is not None:
+            text = b"".join(part[0] for part in parts)
+            records.append(Imap._parse_fetch_record(text, [part[1] for part in parts]))
+        return [record for record in records if record is not None]
+
+    @staticmethod
+    def _with_state(email_obj, record):
+        """
+        Copies the FLAGS and INTERNALDATE of a FETCH response to an Email.
+
+        Args:
+            email_obj (Email): The fetched email.
+            record (dict): Its parsed FETCH response.
+
+        Returns:
+            Email: The same email.
+        """
+        if "FLAGS" in record:
+            email_obj.flags = record["FLAGS"].strip("()")
+        email_obj.internal_date = record.get("INTERNALDATE")
+        return email_obj
+
+    @staticmethod
+    def _parse_fetch_record(text, literals):
+        """
+        Parses one FETCH response into a dict of items.
+
+        Args:
+            text (bytes): The response text with literal bodies removed.
+            literals (list): The literal bodies, in order.
+
+        Returns:
+            dict: The parsed items, or None if the text is not a FETCH response.
+        """
+        match = Imap._fetch_record.match(text)
+        if match is None:
+            return None
+        items = match.group("items")
+        literals = iter(literals)
+        record = {}
+        pos = 0
+        while pos < len(items):
+            name_match = Imap._fetch_name.match(items, pos)
+            if name_match is None or not name_match.group("name"):
+                break
+            name = name_match.group("name").decode("ascii").upper()
+            pos = name_match.end()
+            if pos >= len(items):
+                break
+            char = items[pos:pos + 1]
+            if char == b"{":
+                end = items.index(b"}", pos) + 1
+                record[name] = next(literals, b"")
+            elif char == b'"':
+                end = items.index(b'"', pos + 1) + 1
+                record[name] = items[pos + 1:end - 1].decode("utf-8", errors="replace")
+            elif char == b"(":
+                depth = 0
+                end = pos
+                while end < len(items):
+                    if items[end:end + 1] == b"(":
+                        depth += 1
+                    elif items[end:end + 1] == b")":
+                        depth -= 1
+                        if depth == 0:
+                            break
+                    end += 1
+                end += 1
+                record[name] = items[pos:end].decode("utf-8", errors="replace")
+            else:
+                atom = Imap._fetch_atom.match(items, pos)
+                end = atom.end() if atom else pos + 1
+                record[name] = items[pos:end].decode("utf-8", errors="replace")
+            pos = end
+        return record
+
     def close(self):
         """
         Closes the connection to the IMAP server.
@@ -123,7 +1192,10 @@ class Imap(EmailClient):
         """
         if self._connection is None:
             raise ConnectionError("Connection not established.")
-        self._connection.logout()
+        try:
+            self._connection.logout()
+        finally:
+            self._connection = None
 
     def is_connected(self):
         """
@@ -0,0 +1,377 @@
+import copy
+import os
+import sqlite3
+import threading
+from email.utils import parsedate_to_datetime
+from EmlStorage import EmlStorage
+
+
+class MailIndex:
+    """
+    SQLite metadata index over the backup.
+
+    Every saved email gets one row with its Message-ID, sender, subject, date, size, mailbox,
+    UID and UIDVALIDITY, file path, IMAP flags, internal date and account, and the sender, subject and Message-ID are
+    also indexed in an FTS5 full-text table. Searching the archive then takes milliseconds
+    instead of a scan of every stored file. If the SQLite build has no FTS5, searches fall
+    back to LIKE queries.
+
+    The attachments extracted by `AttachmentStore` are recorded in a `parts` table (type,
+    size, file name and hash of each), joined to the emails by path, e.g. to find all the PDFs
+    from a sender with `attachments()`.
+
+    Rows are buffered and written in batches, one transaction per batch, so indexing does not
+    slow down the download. The index can be shared by several storage objects and threads,
+    and by several accounts: `for_account()` returns a view of the same database that records
+    the rows as coming from one account, so a restore uploads only the emails of that account.
+
+    Attributes:
+        _file_name (str): The SQLite database file.
+        _batch_size (int): Number of rows buffered before a transaction is committed.
+        _pending (list): The rows waiting for the next commit.
+        _fts (bool): True if the full-text table is available.
+        _account (str): The account recorded with the added rows, "" if unknown.
+
+    Usage:
+        index = MailIndex("mail/index.sqlite")
+        storage = EmlStorage(index=index)
+        ...
+        index.flush()
+        for row in index.search("invoice"):
+            print(row["date"], row["sender"], row["subject"], row["path"])
+    """
+
+    def __init__(self, file_name="mail/index.sqlite", batch_size=500):
+        """
+        Initializes a MailIndex object, creating the database if needed.
+
+        Args:
+            file_name (str): The SQLite database file. Default is "mail/index.sqlite".
+            batch_size (int): Number of rows buffered before a commit. Default is 500.
+        """
+        self._file_name = file_name
+        self._batch_size = batch_size
+        self._pending = []
+        self._lock = threading.Lock()
+        self._account = ""
+        directory = os.path.dirname(file_name)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = sqlite3.connect(file_name, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._fts = self._create_tables()
+
+    @property
+    def file_name(self):
+        """
+        str: The SQLite database file.
+        """
+        return self._file_name
+
+    def for_account(self, account):
+        """
+        Returns a view of the index that records the emails it adds as coming from an account.
+
+        The view shares the database, the buffered rows and the lock of this index.
+
+        Args:
+            account (str): The account, e.g. the IMAP user name, or None if unknown.
+
+        Returns:
+            MailIndex: The view.
+        """
+        view = copy.copy(self)
+        view._account = account or ""
+        return view
+
+    def _create_tables(self):
+        """
+        Creates the tables if they do not exist.
+
+        Returns:
+            bool: True if the FTS5 table is available.
+        """
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS messages ("
+                " id INTEGER PRIMARY KEY,"
+                " message_id TEXT, sender TEXT, subject TEXT, date TEXT, size INTEGER,"
+                " mailbox TEXT, uid INTEGER, path TEXT, flags TEXT, internal_date TEXT,"
+                " account TEXT NOT NULL DEFAULT '', uidvalidity INTEGER,"
+                " UNIQUE (account, mailbox, uid, path))")
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(messages)")}
+            for column in ("flags", "internal_date"):
+                if column not in columns:  # index created by an older version
+                    self._connection.execute(f"ALTER TABLE messages ADD COLUMN {column} TEXT")
+            if "account" not in columns:  # rows of an older version have no account
+                self._connection.execute("ALTER TABLE messages ADD COLUMN account TEXT NOT NULL DEFAULT ''")
+            if "uidvalidity" not in columns:
+                self._connection.execute("ALTER TABLE messages ADD COLUMN uidvalidity INTEGER")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS messages_message_id ON messages (message_id)")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS messages_path ON messages (path)")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS parts ("
+                " path TEXT, part INTEGER, content_type TEXT, filename TEXT, size INTEGER, sha256 TEXT,"
+                " PRIMARY KEY (path, part))")
+            self._connection.execute("CREATE INDEX IF NOT EXISTS parts_sha256 ON parts (sha256)")
+            self._connection.execute("CREATE TABLE IF NOT EXISTS extracted (path TEXT PRIMARY KEY)")
+        try:
+            with self._connection:
+                self._connection.execute(
+                    "CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5("
+                    " sender, subject, message_id, content='messages', content_rowid='id')")
+            return True
+        except sqlite3.OperationalError:
+            return False
+
+    def add(self, email, path, mailbox=None, uidvalidity=None):
+        """
+        Buffers the metadata of a saved email; commits when the batch is full.
+
+        Args:
+            email (Email): The saved email (full, file-backed or header-only).
+            path (str): The file the email is stored in.
+            mailbox (str): The mailbox the email comes from. Default is None.
+            uidvalidity (int): The UIDVALIDITY of the mailbox when the email was saved. Default is None.
+        """
+        row = (email.header('message-id'), MailIndex._decode(email.sender), MailIndex._decode(email.subject),
+               MailIndex._iso_date(email.header('date')), email.size, mailbox, email.uid, path, email.flags,
+               email.internal_date, self._account, uidvalidity)
+        with self._lock:
+            self._pending.append(row)
+            if len(self._pending) >= self._batch_size:
+                self._commit()
+
+    def flush(self):
+        """
+        Commits the buffered rows.
+        """
+        with self._lock:
+            self._commit()
+
+    def _commit(self):
+        """
+        Writes the buffered rows in one transaction. The caller holds the lock.
+        """
+        if not self._pending:
+            return
+        with self._connection:
+            for row in self._pending:
+                cursor = self._connection.execute(
+                    "INSERT OR IGNORE INTO messages (message_id, sender, subject, date, size, mailbox, uid, path,"
+                    " flags, internal_date, account, uidvalidity) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+                if self._fts and cursor.rowcount == 1:
+                    self._connection.execute(
+                        "INSERT INTO messages_fts (rowid, sender, subject, message_id) VALUES (?, ?, ?, ?)",
+                        (cursor.lastrowid, row[1], row[2], row[0]))
+        self._pending.clear()  # the list is shared with the views of for_account()
+
+    def search(self, query, limit=50):
+        """
+        Searches the sender, subject and Message-ID of the indexed emails.
+
+        Every word of the query must match; words match as prefixes, e.g. "inv" finds "invoice".
+
+        Args:
+            query (str): The words to search for.
+            limit (int): Maximum number of results. Default is 50.
+
+        Returns:
+            list: The matching rows (sqlite3.Row, with the column names as keys), newest first.
+        """
+        self.flush()
+        words = query.split()
+        if not words:
+            return []
+        if self._fts:
+            match = " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+            return self._connection.execute(
+                "SELECT messages.* FROM messages_fts JOIN messages ON messages.id = messages_fts.rowid"
+                " WHERE messages_fts MATCH ? ORDER BY messages.date DESC LIMIT ?", (match, limit)).fetchall()
+        conditions = " AND ".join("(sender LIKE ? OR subject LIKE ? OR message_id LIKE ?)" for _ in words)
+        parameters = [f"%{word}%" for word in words for _ in range(3)]
+        return self._connection.execute(
+            f"SELECT * FROM messages WHERE {conditions} ORDER BY date DESC LIMIT ?", parameters + [limit]).fetchall()
+
+    def entries(self, mailbox=None, account=None):
+        """
+        Lists where each indexed email is stored.
+
+        Args:
+            mailbox (str): Only list the emails of this mailbox, or None for all. Default is None.
+            account (str): Only list the emails of this account, "" for the emails of unknown
+                account, or None for all. Default is None.
+
+        Returns:
+            list: One row (sqlite3.Row) per email with "mailbox", "uid", "path", "size",
+            "message_id", "flags", "internal_date", "account" and "uidvalidity", in UID order.
+        """
+        self.flush()
+        conditions, parameters = [], []
+        if mailbox is not None:
+            conditions.append("mailbox = ?")
+            parameters.append(mailbox)
+        if account is not None:
+            conditions.append("account = ?")
+            parameters.append(account)
+        where = f" WHERE {' AND '.join(conditions)}" if conditions else ""
+        return self._connection.execute(
+            "SELECT mailbox, uid, path, size, message_id, flags, internal_date, account, uidvalidity FROM messages"
+            f"{where} ORDER BY mailbox, uid", parameters).fetchall()
+
+    def accounts(self):
+        """
+        Lists the accounts that have emails in the index.
+
+        Returns:
+            list: The account names, sorted, with "" for the emails of unknown account.
+        """
+        self.flush()
+        return [row[0] for row in self._connection.execute("SELECT DISTINCT account FROM messages ORDER BY account")]
+
+    def account_entries(self, account):
+        """
+        Lists the indexed emails of one account, as `entries()` does.
+
+        A single-account index may also hold emails of unknown account, indexed by an older
+        version; they are listed too. In an index of several accounts they cannot be told
+        apart, so it is refused rather than guessed.
+
+        Args:
+            account (str): The account, or None for every email.
+
+        Returns:
+            list: The rows of `entries()`.
+
+        Raises:
+            ValueError: If the index holds other accounts and the emails of `account` cannot be told apart.
+        """
+        if account is None:
+            return self.entries()
+        accounts = self.accounts()
+        others = [name for name in accounts if name not in ("", account)]
+        if not others:
+            return self.entries()
+        if "" in accounts:
+            raise ValueError("the index mixes several accounts with emails of unknown account, "
+                             "use the backup of each account on its own")
+        if account not in accounts:
+            raise ValueError(f"no email of {account} in the index, which holds {', '.join(others)}")
+        return self.entries(account=account)
+
+    def unextracted(self, account=None):
+        """
+        Lists the stored files whose attachments have not been extracted yet.
+
+        Args:
+            account (str): Only list the files of this account, or None for all. Default is None.
+
+        Returns:
+            list: The paths, each once even if the file holds the email of several mailboxes.
+        """
+        self.flush()
+        if account is None:
+            return [row[0] for row in self._connection.execute(
+                "SELECT DISTINCT path FROM messages WHERE path NOT IN (SELECT path FROM extracted)")]
+        return [row[0] for row in self._connection.execute(
+            "SELECT DISTINCT path FROM messages WHERE account = ? AND path NOT IN (SELECT path FROM extracted)",
+            (account,))]
+
+    def add_parts(self, results):
+        """
+        Records the attachments of extracted files, in one transaction.
+
+        A file is marked as extracted even without attachments, so it is not parsed again.
+
+        Args:
+            results (list): (path, parts) pairs, parts being (part number, content type,
+                filename, size, SHA-256) tuples.
+        """
+        with self._lock, self._connection:
+            for path, parts in results:
+                self._connection.executemany(
+                    "INSERT OR REPLACE INTO parts (path, part, content_type, filename, size, sha256)"
+                    " VALUES (?, ?, ?, ?, ?, ?)", [(path, *part) for part in parts])
+                self._connection.execute("INSERT OR IGNORE INTO extracted (path) VALUES (?)", (path,))
+
+    def attachments(self, sender=None, content_type=None, filename=None, limit=50):
+        """
+        Searches the extracted attachments by sender, type and file name.
+
+        Args:
+            sender (str): Part of the sender's name or address. Default is None.
+            content_type (str): A MIME type, e.g. "application/pdf", or a file extension, e.g.
+                "pdf", matching the subtype or the file name. Default is None.
+            filename (str): Part of the file name. Default is None.
+            limit (int): Maximum number of results. Default is 50.
+
+        Returns:
+            list: The matching rows (sqlite3.Row) with the "date", "sender", "subject" and
+            "path" of the email and the "content_type", "filename", "size" and "sha256" of the
+            attachment, newest first.
+        """
+        self.flush()
+        conditions = []
+        parameters = []
+        if sender:
+            conditions.append("messages.sender LIKE ?")
+            parameters.append(f"%{sender}%")
+        if content_type and "/" in content_type:
+            conditions.append("parts.content_type = ?")
+            parameters.append(content_type.lower())
+        elif content_type:
+            extension = content_type.lower().lstrip(".")
+            conditions.append("(parts.content_type LIKE ? OR lower(parts.filename) LIKE ?)")
+            parameters += [f"%/{extension}", f"%.{extension}"]
+        if filename:
+            conditions.append("parts.filename LIKE ?")
+            parameters.append(f"%{filename}%")
+        where = " WHERE " + " AND ".join(conditions) if conditions else ""
+        # an email stored once for several mailboxes is listed once
+        return self._connection.execute(
+            "SELECT DISTINCT messages.date, messages.sender, messages.subject, parts.path, parts.part,"
+            " parts.content_type, parts.filename, parts.size, parts.sha256"
+            f" FROM parts JOIN messages ON messages.path = parts.path{where}"
+            " ORDER BY messages.date DESC LIMIT ?", parameters + [limit]).fetchall()
+
+    def close(self):
+        """
+        Commits the buffered rows and closes the database.
+        """
+        self.flush()
+        self._connection.close()
+
+    @staticmethod
+    def _decode(value):
+        """
+        Decodes an RFC 2047 header value for indexing.
+
+        Args:
+            value (str): The raw header value, or None.
+
+        Returns:
+            str: The decoded value, or None.
+        """
+        if value is None:
+            return None
+        return EmlStorage.decode_str(str(value)).replace("\r\n", "")
+
+    @staticmethod
+    def _iso_date(value):
+        """
+        Converts a Date header to a sortable ISO 8601 string.
+
+        Args:
+            value (str): The raw Date header, or None.
+
+        Returns:
+            str: The ISO date, or None if it cannot be parsed.
+        """
+        if not value:
+            return None
+        try:
+            return parsedate_to_datetime(str(value)).isoformat()
+        except (TypeError, ValueError, IndexError):
+            return None
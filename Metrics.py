@@ -0,0 +1,231 @@
+import bisect
+import contextlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+
+class Metrics:
+    """
+    Thread-safe registry of counters and histograms, exported as JSON lines or Prometheus text.
+
+    The IMAP client, the email parser and the storage backends report into the shared registry
+    (`Metrics.shared()`), so one run shows where the time goes:
+
+    - emailsafe_fetch_seconds, emailsafe_fetch_bytes_total, emailsafe_fetch_messages_total:
+      network, per FETCH command;
+    - emailsafe_parse_seconds: header parsing, per email;
+    - emailsafe_write_seconds, emailsafe_write_bytes_total: disk writes, per email;
+    - emailsafe_sync_seconds: fsync, per batch;
+    - emailsafe_saved_total: emails saved and synced;
+    - emailsafe_throttled_total, emailsafe_rate_wait_seconds: server throttling, and the
+      waits of the rate limiter before a command.
+
+    A histogram counts its observations in cumulative buckets and keeps their sum and
+    maximum. Recording a value costs a lock and a bisect, so it can be done per email.
+
+    Attributes:
+        _counters (dict): The value of each counter, by name.
+        _histograms (dict): The bucket counts, sum, count and max of each histogram, by name.
+        _help (dict): The description of each metric, by name.
+
+    Usage:
+        metrics = Metrics.shared()
+        with metrics.time("emailsafe_write_seconds"):
+            storage.save_email(email_obj)
+        metrics.inc("emailsafe_saved_total")
+        metrics.write("metrics.prom", "prometheus")
+    """
+
+    formats = ("jsonl", "prometheus")
+
+    # descriptions of the metrics reported by the project modules
+    descriptions = {
+        "emailsafe_fetch_seconds": "Duration of each UID FETCH command downloading messages",
+        "emailsafe_fetch_bytes_total": "Message bytes downloaded",
+        "emailsafe_fetch_messages_total": "Messages downloaded",
+        "emailsafe_parse_seconds": "Time spent parsing the header block of an email",
+        "emailsafe_write_seconds": "Time spent writing one email to storage",
+        "emailsafe_write_bytes_total": "Message bytes written to storage",
+        "emailsafe_sync_seconds": "Duration of each grouped fsync of written files",
+        "emailsafe_saved_total": "Emails saved and synced to disk",
+        "emailsafe_sessions_opened_total": "IMAP sessions opened by the connection pool",
+        "emailsafe_tls_resumed_total": "TLS connections that resumed a previous session",
+        "emailsafe_throttled_total": "Commands refused or connections closed by a throttling server",
+        "emailsafe_rate_wait_seconds": "Time a command waited for the rate limiter",
+        "emailsafe_attachments_total": "Attachments found in the extracted emails",
+        "emailsafe_attachment_blobs_total": "Attachments written to the blob store, not yet stored by another email",
+    }
+
+    # seconds, from a cached header parse to a slow FETCH of a large batch
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self):
+        """
+        Initializes an empty Metrics registry.
+        """
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._help = dict(Metrics.descriptions)
+
+    @staticmethod
+    def shared():
+        """
+        Returns the registry shared by the whole process.
+
+        Returns:
+            Metrics: The shared registry.
+        """
+        if Metrics._shared is None:
+            with Metrics._shared_lock:
+                if Metrics._shared is None:
+                    Metrics._shared = Metrics()
+        return Metrics._shared
+
+    def describe(self, name, text):
+        """
+        Sets the description exported with a metric.
+
+        Args:
+            name (str): The metric name.
+            text (str): One line describing it.
+        """
+        self._help[name] = text
+
+    def inc(self, name, value=1):
+        """
+        Adds to a counter.
+
+        Args:
+            name (str): The counter name, ending in "_total".
+            value (float): The amount to add. Default is 1.
+        """
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Records one observation in a histogram.
+
+        Args:
+            name (str): The histogram name, e.g. "emailsafe_fetch_seconds".
+            value (float): The observed value.
+        """
+        with self._lock:
+            histogram = self._histograms.get(name)
+            if histogram is None:
+                histogram = {"buckets": [0] * len(Metrics.buckets), "count": 0, "sum": 0.0, "max": 0.0}
+                self._histograms[name] = histogram
+            position = bisect.bisect_left(Metrics.buckets, value)
+            if position < len(Metrics.buckets):
+                histogram["buckets"][position] += 1
+            histogram["count"] += 1
+            histogram["sum"] += value
+            histogram["max"] = max(histogram["max"], value)
+
+    @contextlib.contextmanager
+    def time(self, name):
+        """
+        Records the duration of a block in a histogram, also when it raises.
+
+        Args:
+            name (str): The histogram name.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def reset(self):
+        """
+        Drops every recorded value.
+        """
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    def snapshot(self):
+        """
+        Returns the current values.
+
+        Returns:
+            dict: "counters" (name to value) and "histograms" (name to "count", "sum", "max"
+            and the cumulative "buckets" by upper bound, as in Prometheus).
+        """
+        with self._lock:
+            histograms = {}
+            for name, histogram in self._histograms.items():
+                cumulative = 0
+                buckets = {}
+                for bound, count in zip(Metrics.buckets, histogram["buckets"]):
+                    cumulative += count
+                    buckets[str(bound)] = cumulative
+                buckets["+Inf"] = histogram["count"]
+                histograms[name] = {"count": histogram["count"], "sum": histogram["sum"],
+                                    "max": histogram["max"], "buckets": buckets}
+            return {"counters": dict(self._counters), "histograms": histograms}
+
+    def to_prometheus(self):
+        """
+        Formats the current values in the Prometheus text exposition format.
+
+        Returns:
+            str: The metrics, one sample per line.
+        """
+        snapshot = self.snapshot()
+        lines = []
+        for name, value in sorted(snapshot["counters"].items()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for name, histogram in sorted(snapshot["histograms"].items()):
+            if name in self._help:
+                lines.append(f"# HELP {name} {self._help[name]}")
+            lines.append(f"# TYPE {name} histogram")
+            for bound, count in histogram["buckets"].items():
+                lines.append(f'{name}_bucket{{le="{bound}"}} {count}')
+            lines.append(f"{name}_sum {histogram['sum']}")
+            lines.append(f"{name}_count {histogram['count']}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, file_name, export_format="jsonl"):
+        """
+        Exports the current values to a file.
+
+        "jsonl" appends one JSON object per call (with a "time" field), so a file collects the
+        progress of a run. "prometheus" replaces the file atomically, for the node_exporter
+        textfile collector.
+
+        Args:
+            file_name (str): The destination file.
+            export_format (str): "jsonl" or "prometheus". Default is "jsonl".
+
+        Raises:
+            ValueError: If the format is unknown.
+            OSError: If the file cannot be written.
+        """
+        if export_format == "jsonl":
+            with open(file_name, "a") as metrics_file:
+                metrics_file.write(json.dumps({"time": time.time(), **self.snapshot()}) + "\n")
+        elif export_format == "prometheus":
+            directory = os.path.dirname(file_name) or "."
+            fd, temp_name = tempfile.mkstemp(dir=directory, prefix=".", suffix=".part")
+            try:
+                with os.fdopen(fd, "w") as metrics_file:
+                    metrics_file.write(self.to_prometheus())
+                os.replace(temp_name, file_name)
+            except BaseException:
+                if os.path.exists(temp_name):
+                    os.remove(temp_name)
+                raise
+        else:
+            raise ValueError(f"unknown metrics format {export_format}")
+
@@ -0,0 +1,278 @@
+import queue
+import threading
+import time
+from EmlStorage import EmlStorage
+
+
+class Pipeline:
+    """
+    Three-stage save pipeline: fetch, parse/name, write.
+
+    Each stage runs on its own thread and the stages are connected by bounded queues, so the
+    network, the CPU and the disk are busy at the same time, and a slow stage makes the
+    faster ones wait instead of filling memory (backpressure).
+
+    - fetch: pulls emails from the client, e.g. `imap.fetch_batch(...)`.
+    - parse: parses the headers and lets the storage name or hash the email (`prepare()`).
+    - write: saves the emails with `save_email()`. Every `sync_batch` emails the storage is
+      flushed, so the files of a batch are synced to disk together, and only then are the
+      emails reported to `on_saved`, which therefore only sees durable emails.
+
+    Each stage counts its emails, bytes and busy time (time spent working, not waiting on a
+    queue). The stage with the lowest throughput is the bottleneck.
+
+    Attributes:
+        _storage (EmailStorage): The storage backend emails are saved to.
+        _queue_size (int): Maximum number of emails waiting between two stages.
+        _sync_batch (int): Number of emails written between two flushes.
+        _stats (dict): The counters of each stage, by stage name.
+
+    Usage:
+        pipeline = Pipeline(storage, sync_batch=100)
+        pipeline.run(imap.fetch_batch(email_ids), on_saved=lambda email_obj: state.commit(email_obj.uid))
+        print(pipeline.report())
+    """
+
+    stages = ("fetch", "parse", "write")
+
+    # marks the end of the emails on a queue
+    _done = object()
+
+    def __init__(self, storage=None, **opt):
+        """
+        Initializes a Pipeline object.
+
+        Args:
+            storage (EmailStorage): The storage backend. Default is a new EmlStorage.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            queue_size (int): Maximum number of emails waiting between two stages. Default is 100.
+            sync_batch (int): Number of emails written between two flushes. Default is 100.
+        """
+        self._storage = storage if storage is not None else EmlStorage()
+        self._queue_size = opt.get('queue_size', 100)
+        self._sync_batch = max(1, opt.get('sync_batch', 100))
+        self._stop = threading.Event()
+        self._errors = []
+        self._stats = {stage: {"emails": 0, "bytes": 0, "seconds": 0.0} for stage in Pipeline.stages}
+
+    def run(self, emails, on_saved=None):
+        """
+        Saves the emails produced by an iterable.
+
+        Args:
+            emails (iterable): The emails to save, e.g. the generator returned by `fetch_batch()`.
+            on_saved (callable): Called with each Email once it has been saved and flushed. Default is None.
+
+        Returns:
+            int: The number of emails saved.
+
+        Raises:
+            ConnectionError: If fetching fails.
+            OSError: If the storage backend fails to save an email.
+        """
+        fetched = queue.Queue(maxsize=self._queue_size)
+        parsed = queue.Queue(maxsize=self._queue_size)
+        threads = [threading.Thread(target=self._fetch, args=(emails, fetched), daemon=True),
+                   threading.Thread(target=self._parse, args=(fetched, parsed), daemon=True)]
+        for thread in threads:
+            thread.start()
+        try:
+            saved = self._write(parsed, on_saved)
+        except Exception as e:
+            self._errors.append(e)
+            saved = 0
+        finally:
+            self._stop.set()
+            for thread in threads:
+                thread.join()
+
+        if self._errors:
+            raise self._errors[0]
+        return saved
+
+    def _fetch(self, emails, out_queue):
+        """
+        Fetch stage: pulls the emails from the client.
+
+        Args:
+            emails (iterable): The emails to save.
+            out_queue (Queue): The queue to the parse stage.
+        """
+        try:
+            iterator = iter(emails)
+            while not self._stop.is_set():
+                start = time.monotonic()
+                email_obj = next(iterator, Pipeline._done)
+                if email_obj is Pipeline._done:
+                    break
+                self._count("fetch", email_obj, start)
+                self._put(out_queue, email_obj)
+        except Exception as e:
+            self._errors.append(e)
+        finally:
+            self._put(out_queue, Pipeline._done)
+            if hasattr(emails, "close"):
+                emails.close()
+
+    def _parse(self, in_queue, out_queue):
+        """
+        Parse stage: parses the headers and prepares the storage of each email.
+
+        Args:
+            in_queue (Queue): The queue from the fetch stage.
+            out_queue (Queue): The queue to the write stage.
+        """
+        try:
+            while True:
+                email_obj = self._get(in_queue)
+                if email_obj is Pipeline._done:
+                    break
+                start = time.monotonic()
+                email_obj.header("from")
+                self._storage.prepare(email_obj)
+                self._count("parse", email_obj, start)
+                self._put(out_queue, email_obj)
+        except Exception as e:
+            self._errors.append(e)
+            self._stop.set()
+        finally:
+            self._put(out_queue, Pipeline._done)
+
+    def _write(self, in_queue, on_saved):
+        """
+        Write stage: saves the emails and flushes the storage after each batch.
+
+        If the run is interrupted (Ctrl-C), the emails written so far are flushed and reported.
+
+        Args:
+            in_queue (Queue): The queue from the parse stage.
+            on_saved (callable): Called with each Email once its batch has been flushed.
+
+        Returns:
+            int: The number of emails saved.
+        """
+        saved = 0
+        batch = []
+        try:
+            while True:
+                email_obj = self._get(in_queue)
+                if email_obj is Pipeline._done:
+                    break
+                start = time.monotonic()
+                size = email_obj.size or 0
+                self._storage.save_email(email_obj)
+                self._count("write", email_obj, start, size)
+                batch.append(email_obj)
+                if len(batch) >= self._sync_batch:
+                    saved += self._sync(batch, on_saved)
+                    batch = []
+        except KeyboardInterrupt:
+            # the emails already written still count, so an interrupted run resumes after them
+            self._sync(batch, on_saved)
+            raise
+        saved += self._sync(batch, on_saved)
+        return saved
+
+    def _sync(self, batch, on_saved):
+        """
+        Flushes the storage once for a batch of written emails, then reports them.
+
+        Args:
+            batch (list): The emails written since the last flush.
+            on_saved (callable): Called with each Email of the batch.
+
+        Returns:
+            int: The number of emails in the batch.
+        """
+        if not batch:
+            return 0
+        start = time.monotonic()
+        self._storage.flush()
+        self._stats["write"]["seconds"] += time.monotonic() - start
+        if on_saved is not None:
+            for email_obj in batch:
+                on_saved(email_obj)
+        return len(batch)
+
+    def _put(self, out_queue, item):
+        """
+        Puts an item on a bounded queue, giving up if the run is stopping.
+
+        The end marker is always delivered, so the next stage can finish.
+
+        Args:
+            out_queue (Queue): The queue.
+            item (Email): The email, or the end marker.
+        """
+        while True:
+            if self._stop.is_set() and item is not Pipeline._done:
+                return
+            try:
+                out_queue.put(item, timeout=0.5)
+                return
+            except queue.Full:
+                if self._stop.is_set():
+                    return
+                continue
+
+    def _get(self, in_queue):
+        """
+        Takes the next item from a queue, or the end marker if the run is stopping.
+
+        Args:
+            in_queue (Queue): The queue.
+
+        Returns:
+            Email: The email, or the end marker.
+        """
+        while True:
+            try:
+                return in_queue.get(timeout=0.5)
+            except queue.Empty:
+                if self._stop.is_set():
+                    return Pipeline._done
+
+    def _count(self, stage, email_obj, start, size=None):
+        """
+        Adds one email to the counters of a stage.
+
+        Args:
+            stage (str): The stage name.
+            email_obj (Email): The email processed.
+            start (float): When the stage started working on it (`time.monotonic()`).
+            size (int): The email size, if it must be read before the email is processed. Default is None.
+        """
+        counters = self._stats[stage]
+        counters["seconds"] += time.monotonic() - start
+        counters["emails"] += 1
+        counters["bytes"] += size if size is not None else (email_obj.size or 0)
+
+    def stats(self):
+        """
+        Returns the counters of each stage.
+
+        Returns:
+            dict: For each stage name, its "emails", "bytes", "seconds" (busy time) and
+            "rate" (emails per busy second).
+        """
+        stats = {}
+        for stage, counters in self._stats.items():
+            stats[stage] = dict(counters)
+            stats[stage]["rate"] = counters["emails"] / counters["seconds"] if counters["seconds"] else 0.0
+        return stats
+
+    def report(self):
+        """
+        Formats the per-stage throughput, e.g. "fetch 120 emails/s 4.1 MB/s | parse ... | write ...".
+
+        Returns:
+            str: The report.
+        """
+        parts = []
+        for stage, counters in self.stats().items():
+            seconds = counters["seconds"] or 1e-9
+            parts.append(f"{stage} {counters['rate']:.0f} emails/s "
+                         f"{counters['bytes'] / seconds / (1024 * 1024):.1f} MB/s ({counters['seconds']:.2f}s busy)")
+        return " | ".join(parts)
@@ -0,0 +1,89 @@
+import cProfile
+import pstats
+import sys
+import threading
+
+
+class Profiler:
+    """
+    cProfile over every thread of a run.
+
+    `cProfile.Profile` only sees the thread that enables it, while a backup spends most of
+    its time in the pipeline and downloader threads. While the profiler is running, each new
+    thread starts its own profile (through `threading.setprofile`), and `stop()` merges them
+    with the main thread profile into one statistics file, readable with `pstats` or tools
+    such as snakeviz.
+
+    Attributes:
+        _main (Profile): The profile of the thread that started the profiler.
+        _threads (list): The profiles of the threads started since.
+
+    Usage:
+        profiler = Profiler()
+        profiler.start()
+        fetch_inbox(imap, state)
+        profiler.stop("backup.prof")
+    """
+
+    def __init__(self):
+        """
+        Initializes a Profiler object.
+        """
+        self._main = cProfile.Profile()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        """
+        Starts profiling the current thread and every thread started from now on.
+        """
+        threading.setprofile(self._start_thread)
+        self._main.enable()
+
+    def _start_thread(self, frame, event, arg):
+        """
+        Profile hook of a new thread: replaces itself with a cProfile profile of the thread.
+
+        Args:
+            frame (frame): The current frame.
+            event (str): The profile event.
+            arg (object): The event argument.
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Python 3.12+ profiles through sys.monitoring: the main profile already sees
+            # every thread, and a second profile cannot be enabled
+            sys.setprofile(None)
+            return
+        with self._lock:
+            self._threads.append(profile)
+
+    def stop(self, file_name=None):
+        """
+        Stops profiling and merges the profiles of all threads.
+
+        Threads still running at this point are included up to now.
+
+        Args:
+            file_name (str): Where to dump the statistics, or None. Default is None.
+
+        Returns:
+            Stats: The merged statistics.
+
+        Raises:
+            OSError: If the file cannot be written.
+        """
+        threading.setprofile(None)
+        self._main.disable()
+        stats = pstats.Stats(self._main)
+        with self._lock:
+            profiles = list(self._threads)
+        for profile in profiles:
+            profile.create_stats()
+            if profile.stats:
+                stats.add(profile)
+        if file_name is not None:
+            stats.dump_stats(file_name)
+        return stats
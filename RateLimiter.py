@@ -0,0 +1,306 @@
+import re
+import threading
+import time
+from ConnectionPool import ConnectionPool
+from Metrics import Metrics
+
+
+class RateLimiter:
+    """
+    Token buckets limiting the bytes and commands per second sent to a server, adapting to
+    how the server copes.
+
+    Each IMAP command takes one command token and the bytes it is expected to download (the
+    RFC822.SIZE of the messages) before it is sent. Byte tokens may go negative for a batch
+    larger than the bucket: the next command then waits until the debt is paid back, so the
+    average rate holds whatever the batch size. A limiter can have a `parent`, e.g. one
+    limiter per account below one global limiter, and a command then waits for both.
+
+    The rates adapt, as TCP congestion control does:
+
+    - when the server throttles the session (a [THROTTLED], [UNAVAILABLE] or [LIMIT]
+      response, or a BYE), the rates are halved and the next command waits with jittered
+      exponential backoff;
+    - when the latency of a command rises well above its running average, the rates are
+      lowered by a quarter;
+    - after `recovery` seconds without either, the rates grow by a quarter again, up to the
+      configured limits, or back to unlimited when no limit was set.
+
+    The rates are lowered at most once per second: the sessions sharing a limiter are often
+    throttled together, and one quota hit must not halve the rates once per session.
+
+    An unlimited limiter costs a lock per command, so every session has one: it only starts
+    slowing down once the server pushes back.
+
+    Attributes:
+        limits (dict): The configured "bytes" and "commands" per second, None for unlimited.
+        rates (dict): The current "bytes" and "commands" per second, None for unlimited.
+        parent (RateLimiter): The limiter shared with other sessions, or None.
+        throttles (int): Number of times the server throttled the session.
+
+    Usage:
+        shared = RateLimiter(bytes_per_sec=50 * 1024 * 1024)
+        imap = Imap(server, port, username, password, rate_limiter=RateLimiter(5 * 1024 * 1024, parent=shared))
+    """
+
+    # response codes and texts of servers asking clients to slow down
+    _throttle_text = re.compile(r"\[(THROTTLED|UNAVAILABLE|LIMIT)\]|\bthrottl|too many|rate limit", re.IGNORECASE)
+
+    # multipliers of the rate suffixes
+    _units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    # lowest rates reached by slowing down an unlimited session
+    _floor = {"bytes": 64 * 1024, "commands": 1}
+
+    # seconds after lowering the rates during which other signals do not lower them again
+    _hold = 1.0
+
+    def __init__(self, bytes_per_sec=None, commands_per_sec=None, **opt):
+        """
+        Initializes a RateLimiter object.
+
+        Args:
+            bytes_per_sec (float): Maximum download rate in bytes per second, or None. Default is None.
+            commands_per_sec (float): Maximum number of commands per second, or None. Default is None.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            parent (RateLimiter): A limiter to wait for as well. Default is None.
+            burst (float): Seconds of traffic a full bucket allows at once. Default is 1.
+            latency_factor (float): A command slower than this many times the average latency
+                lowers the rates. Default is 4.
+            recovery (float): Seconds without throttling before the rates grow again. Default is 2.
+        """
+        self.limits = {"bytes": bytes_per_sec, "commands": commands_per_sec}
+        self.rates = dict(self.limits)
+        self.parent = opt.get('parent')
+        self._burst = opt.get('burst', 1.0)
+        self._latency_factor = opt.get('latency_factor', 4)
+        self._recovery = opt.get('recovery', 2)
+        self._lock = threading.Lock()
+        self._tokens = {kind: self._capacity(kind) for kind in self.rates}
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._calm_since = time.monotonic()
+        self._slowed_at = None
+        self._latency = None
+        self._samples = 0
+        self._window = {"start": time.monotonic(), "bytes": 0, "commands": 0}
+        self._measured = {"bytes": None, "commands": None}
+        self._strikes = 0
+        self.throttles = 0
+
+    @staticmethod
+    def parse_rate(value):
+        """
+        Reads a rate in bytes per second, with an optional K, M or G suffix (powers of 1024).
+
+        Args:
+            value (str): The rate, e.g. "500K" or "5M"; a number or None is returned unchanged.
+
+        Returns:
+            float: The rate in bytes per second, or None.
+
+        Raises:
+            ValueError: If the value is not a positive rate.
+        """
+        if value is None or isinstance(value, (int, float)):
+            rate = value
+        else:
+            match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", str(value), re.IGNORECASE)
+            if match is None:
+                raise ValueError(f"invalid rate {value!r}, expected e.g. 500K or 5M")
+            rate = float(match.group(1)) * RateLimiter._units[match.group(2).upper()]
+        if rate is not None and rate <= 0:
+            raise ValueError(f"invalid rate {value!r}, must be positive")
+        return rate
+
+    @staticmethod
+    def is_throttled(response):
+        """
+        Tells whether a server response asks the client to slow down.
+
+        Args:
+            response (object): The response text or data of a failed command.
+
+        Returns:
+            bool: True for a throttling response.
+        """
+        return bool(RateLimiter._throttle_text.search(str(response)))
+
+    def _capacity(self, kind):
+        """
+        Returns the size of a bucket at the current rate.
+
+        Args:
+            kind (str): "bytes" or "commands".
+
+        Returns:
+            float: The maximum number of tokens, or None when unlimited.
+        """
+        rate = self.rates[kind]
+        if rate is None:
+            return None
+        return max(rate * self._burst, 1.0)
+
+    def _refill(self, now):
+        """
+        Adds the tokens earned since the last call. Called with the lock held.
+
+        Args:
+            now (float): The current monotonic time.
+        """
+        elapsed = now - self._updated
+        self._updated = now
+        for kind, rate in self.rates.items():
+            if rate is not None:
+                self._tokens[kind] = min(self._capacity(kind), self._tokens[kind] + elapsed * rate)
+
+    def _delay(self, now):
+        """
+        Returns how long a command must wait. Called with the lock held.
+
+        Args:
+            now (float): The current monotonic time.
+
+        Returns:
+            float: Seconds to wait, 0 if the command can be sent now.
+        """
+        delay = self._paused_until - now
+        if self.rates["commands"] is not None and self._tokens["commands"] < 1:
+            delay = max(delay, (1 - self._tokens["commands"]) / self.rates["commands"])
+        if self.rates["bytes"] is not None and self._tokens["bytes"] < 0:
+            delay = max(delay, -self._tokens["bytes"] / self.rates["bytes"])
+        return delay
+
+    def acquire(self, size=0):
+        """
+        Waits until a command may be sent, and takes its tokens.
+
+        Args:
+            size (int): The bytes the command is expected to download. Default is 0.
+        """
+        if self.parent is not None:
+            self.parent.acquire(size)
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refill(now)
+                delay = self._delay(now)
+                if delay <= 0:
+                    for kind, amount in (("commands", 1), ("bytes", size)):
+                        if self.rates[kind] is not None:
+                            self._tokens[kind] -= amount
+                    break
+            time.sleep(delay)
+            waited += delay
+        if waited:
+            Metrics.shared().observe("emailsafe_rate_wait_seconds", waited)
+
+    def record(self, size, seconds):
+        """
+        Reports a successful command, to measure the rates and watch the latency.
+
+        Args:
+            size (int): The bytes the command downloaded.
+            seconds (float): How long the command took.
+        """
+        if self.parent is not None:
+            self.parent.record(size, seconds)
+        with self._lock:
+            now = time.monotonic()
+            self._measure(now, size)
+            # a 1 MB download weighs as much as two empty commands
+            latency = seconds / (1 + size / (1024 * 1024))
+            if self._samples >= 5 and latency > self._latency_factor * self._latency:
+                self._slow_down(now, 0.75)
+                return  # a spike does not move the average
+            self._latency = latency if self._latency is None else 0.8 * self._latency + 0.2 * latency
+            self._samples += 1
+            if now - self._calm_since >= self._recovery:
+                self._speed_up(now)
+
+    def throttled(self):
+        """
+        Reports that the server throttled the session: halves the rates and pauses.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.throttles += 1
+            # every refusal waits, but only the first of a burst lowers the rates
+            self._paused_until = max(self._paused_until, now + ConnectionPool.backoff(self._strikes))
+            if self._slow_down(now, 0.5):
+                self._strikes += 1
+        Metrics.shared().inc("emailsafe_throttled_total")
+
+    def _measure(self, now, size):
+        """
+        Updates the rates achieved, over windows of one second. Called with the lock held.
+
+        Args:
+            now (float): The current monotonic time.
+            size (int): The bytes of the command.
+        """
+        window = self._window
+        window["bytes"] += size
+        window["commands"] += 1
+        elapsed = now - window["start"]
+        if elapsed >= 1:
+            for kind in ("bytes", "commands"):
+                rate = window[kind] / elapsed
+                previous = self._measured[kind]
+                self._measured[kind] = rate if previous is None else 0.5 * previous + 0.5 * rate
+            self._window = {"start": now, "bytes": 0, "commands": 0}
+
+    def _slow_down(self, now, factor):
+        """
+        Lowers the rates, unless they were lowered less than `_hold` seconds ago. Called with
+        the lock held.
+
+        An unlimited rate is first set to the rate measured so far.
+
+        Args:
+            now (float): The current monotonic time.
+            factor (float): The factor applied to the rates.
+
+        Returns:
+            bool: True if the rates were lowered.
+        """
+        if self._slowed_at is not None and now - self._slowed_at < RateLimiter._hold:
+            return False
+        self._slowed_at = now
+        for kind in self.rates:
+            rate = self.rates[kind] if self.rates[kind] is not None else self._measured[kind]
+            if rate is None:
+                continue  # nothing measured yet, the pause alone slows down
+            limit = self.limits[kind]
+            floor = limit / 20 if limit is not None else RateLimiter._floor[kind]
+            self.rates[kind] = max(floor, rate * factor)
+            if self._tokens[kind] is None:
+                self._tokens[kind] = 0.0
+            self._tokens[kind] = min(self._tokens[kind], self._capacity(kind))
+        self._calm_since = now
+        return True
+
+    def _speed_up(self, now):
+        """
+        Raises the rates back towards the limits. Called with the lock held.
+
+        Args:
+            now (float): The current monotonic time.
+        """
+        for kind, rate in self.rates.items():
+            if rate is None:
+                continue
+            limit = self.limits[kind]
+            if limit is not None:
+                self.rates[kind] = min(limit, rate * 1.25)
+            elif self._measured[kind] is not None and rate * 1.25 > 4 * self._measured[kind]:
+                # well above the demand: the session no longer needs a limit
+                self.rates[kind] = None
+                self._tokens[kind] = None
+            else:
+                self.rates[kind] = rate * 1.25
+        self._strikes = 0
+        self._calm_since = now
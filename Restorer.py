@@ -0,0 +1,259 @@
+import os
+import queue
+import threading
+from CompressedStorage import CompressedStorage
+from Email import Email  # my module
+
+
+class Restorer:
+    """
+    Uploads a backup to an IMAP server, e.g. after the loss of an account or to move it to
+    another provider.
+
+    The emails come from the search index, which records the mailbox, the stored path, the
+    Message-ID, the IMAP flags and the internal date of every saved email. For each mailbox:
+
+    1. the mailbox is created on the server if it is missing, under `prefix` if given;
+    2. the Message-IDs already in it are fetched, a few header bytes per message, and the
+       stored emails with one of them are skipped, so an interrupted restore can simply be
+       run again;
+    3. the other emails are cut into batches of at most `batch_size` emails and `batch_bytes`
+       bytes, uploaded with pipelined APPEND commands (see `Imap.append()`) by `workers`
+       threads, each with its own session of the pool.
+
+    The batches of all the mailboxes share one queue, so a small mailbox does not leave
+    sessions idle. A batch that fails is counted as failed, its session is replaced and the
+    other batches go on. Emails without a Message-ID are always uploaded.
+
+    The index of a multi-account backup (`--config`) holds the emails of every account; only
+    the emails recorded for `account` are restored. An index where such emails are mixed with
+    emails of unknown account, saved by an older version, is refused rather than guessed.
+
+    Attributes:
+        _index (MailIndex): The search index of the backup.
+        _pool (ConnectionPool): The sessions to the server.
+        _workers (int): Number of sessions uploading at once.
+        _batch_size (int): Maximum number of emails per batch.
+        _batch_bytes (int): Maximum number of bytes per batch, read into memory at once.
+        _prefix (str): Prepended to the mailbox names on the server.
+        _segments (SegmentStorage): Reads the emails of a segment backup, or None.
+        _account (str): The account whose emails are restored, or None for every email.
+        _reader (CompressedStorage): Reads the .eml, .eml.gz and .eml.zst files.
+
+    Usage:
+        restorer = Restorer(MailIndex("mail/index.sqlite"), pool, workers=4)
+        report = restorer.run()
+        print(Restorer.summary(report))
+    """
+
+    def __init__(self, index, pool, **opt):
+        """
+        Initializes a Restorer object.
+
+        Args:
+            index (MailIndex): The search index of the backup.
+            pool (ConnectionPool): The pool of sessions to the server.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            workers (int): Sessions uploading at once. Default is 4.
+            batch_size (int): Emails per batch. Default is 1000.
+            batch_bytes (int): Bytes per batch. Default is 64 MB.
+            prefix (str): Prepended to the mailbox names on the server, e.g. "Restored/". Default is "".
+            segments (SegmentStorage): The segment archive, to restore a segment backup. Default is None.
+            account (str): The account to restore from a multi-account index. Default is None (every email).
+            dictionary_dir (str): The zstd dictionaries of a compressed backup. Default is "mail/.dict".
+        """
+        self._index = index
+        self._pool = pool
+        self._workers = max(1, opt.get('workers', 4))
+        self._batch_size = max(1, opt.get('batch_size', 1000))
+        self._batch_bytes = opt.get('batch_bytes', 64 * 1024 * 1024)
+        self._prefix = opt.get('prefix', "")
+        self._segments = opt.get('segments')
+        self._account = opt.get('account')
+        dictionary_dir = opt.get('dictionary_dir') or os.path.join("mail", ".dict")
+        self._reader = CompressedStorage(os.path.dirname(dictionary_dir), dictionary_dir=dictionary_dir)
+        self._lock = threading.Lock()
+
+    def run(self, mailboxes=None):
+        """
+        Restores the mailboxes.
+
+        Args:
+            mailboxes (list): The mailboxes of the backup to restore. Default is every mailbox in the index.
+
+        Returns:
+            dict: The result of each mailbox, by name: "stored" (emails in the backup),
+            "skipped" (already on the server), "restored", "failed" and "error" (the first
+            error, or None).
+
+        Raises:
+            ConnectionError: If the server cannot be reached, or a mailbox cannot be created or read.
+            ValueError: If the index holds other accounts and the emails of `account` cannot be told apart.
+        """
+        entries = {}
+        for row in self._index.account_entries(self._account):
+            entries.setdefault(row["mailbox"], []).append(row)
+        if mailboxes is None:
+            mailboxes = sorted(entries)
+
+        report = {}
+        batches = queue.Queue()
+        with self._pool.session() as imap:
+            folders = {name for name, _, _ in imap.list_folders()}
+            for mailbox in mailboxes:
+                target = self._prefix + mailbox
+                rows = entries.get(mailbox, [])
+                result = {"stored": len(rows), "skipped": 0, "restored": 0, "failed": 0, "error": None}
+                report[mailbox] = result
+                existing = set()
+                if target not in folders:
+                    imap.create(target)
+                else:
+                    imap.select(target)
+                    existing = {Restorer._message_id(email_obj.header("message-id"))
+                                for email_obj in imap.fetch_headers(imap.fetch_emails(), fields=("MESSAGE-ID",))}
+                upload = []
+                for row in rows:
+                    message_id = Restorer._message_id(row["message_id"])
+                    if message_id is not None and message_id in existing:
+                        result["skipped"] += 1
+                        continue
+                    existing.add(message_id)  # an email indexed twice is uploaded once
+                    upload.append(row)
+                for batch in self._batches(upload):
+                    batches.put((mailbox, target, batch))
+
+        threads = [threading.Thread(target=self._worker, args=(batches, report), daemon=True)
+                   for _ in range(min(self._workers, batches.qsize()))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return report
+
+    def _batches(self, rows):
+        """
+        Cuts the emails of a mailbox into batches bounded by count and size.
+
+        Args:
+            rows (list): The index rows of the emails.
+
+        Yields:
+            list: The rows of each batch.
+        """
+        batch = []
+        batch_bytes = 0
+        for row in rows:
+            size = row["size"] or 0
+            if batch and (len(batch) >= self._batch_size or batch_bytes + size > self._batch_bytes):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(row)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _worker(self, batches, report):
+        """
+        Worker thread: uploads batches until the queue is empty.
+
+        Args:
+            batches (Queue): (mailbox, server mailbox, rows) of each batch.
+            report (dict): The results, updated under the lock.
+        """
+        while True:
+            try:
+                mailbox, target, batch = batches.get_nowait()
+            except queue.Empty:
+                return
+            result = report[mailbox]
+            emails = []
+            for row in batch:
+                try:
+                    emails.append(self._read(row))
+                except (OSError, KeyError, ValueError) as e:
+                    with self._lock:
+                        result["failed"] += 1
+                        result["error"] = result["error"] or f"{row['path']}: {e}"
+            if not emails:
+                continue
+            try:
+                with self._pool.session() as imap:
+                    restored = imap.append(emails, target)
+            except ConnectionError as e:
+                with self._lock:
+                    result["failed"] += len(emails)
+                    result["error"] = result["error"] or str(e)
+                continue
+            with self._lock:
+                result["restored"] += restored
+
+    def _read(self, row):
+        """
+        Reads a stored email with the flags and internal date recorded in the index.
+
+        Args:
+            row (sqlite3.Row): The index row of the email.
+
+        Returns:
+            Email: The email, held in memory.
+
+        Raises:
+            OSError: If the file cannot be read.
+            KeyError: If a segment record is missing.
+            ValueError: If the path is a segment record and no segment archive was given, or a
+                .zst file is found without the zstandard package.
+        """
+        path = row["path"]
+        if "#" in path:
+            if self._segments is None:
+                raise ValueError("restoring a segment backup needs the segment archive")
+            email_obj = Email(self._segments.read(path.rsplit("#", 1)[1]))
+        else:
+            email_obj = Email(self._reader.read(path))
+        email_obj.flags = row["flags"]
+        email_obj.internal_date = row["internal_date"]
+        return email_obj
+
+    @staticmethod
+    def _message_id(value):
+        """
+        Normalizes a Message-ID for comparison, e.g. unfolding a header split over two lines.
+
+        Args:
+            value (str): The raw Message-ID header, or None.
+
+        Returns:
+            str: The Message-ID, or None if the email has none.
+        """
+        if not value:
+            return None
+        return "".join(str(value).split()) or None
+
+    @staticmethod
+    def summary(report):
+        """
+        Formats a report, one line per mailbox and a total.
+
+        Args:
+            report (dict): The result of `run()`.
+
+        Returns:
+            str: The summary.
+        """
+        lines = []
+        totals = {"stored": 0, "skipped": 0, "restored": 0, "failed": 0}
+        for mailbox, result in sorted(report.items()):
+            for kind in totals:
+                totals[kind] += result[kind]
+            line = (f"{mailbox}: {result['restored']} restored, {result['skipped']} already on the server, "
+                    f"{result['failed']} failed")
+            if result["error"]:
+                line += f" ({result['error']})"
+            lines.append(line)
+        lines.append(f"{len(report)} mailboxes, {totals['stored']} emails in the backup: {totals['restored']} "
+                     f"restored, {totals['skipped']} already on the server, {totals['failed']} failed")
+        return "\n".join(lines)
@@ -0,0 +1,195 @@
+import datetime
+import fnmatch
+import re
+from EmlStorage import EmlStorage
+
+
+class SearchFilter:
+    """
+    Selects part of a mailbox, e.g. for a legal-hold export, without downloading the rest.
+
+    The filter is compiled to IMAP SEARCH criteria (`criteria()`), which the server evaluates
+    over its own index, so only the UIDs of the matching messages cross the network:
+
+    - `since` / `before`: SINCE and BEFORE, on the internal date (arrival date) of the messages;
+    - `larger_than`: LARGER, in bytes;
+    - `senders`: FROM, several senders being combined with OR;
+    - `unseen`: UNSEEN.
+
+    Servers differ in how they match FROM (a substring of the header, whole words, or the
+    address only), so the sender and the size are checked again on the header-only data of
+    the planning pass (`matches()`), before any body is downloaded. Many servers reject a
+    SEARCH with CHARSET UTF-8, so when a sender is not ASCII the FROM keys are left out of the
+    criteria altogether and the senders are only checked by `matches()`. Folders are excluded by
+    name with shell patterns (`excludes()`), e.g. "Spam" or "Archive/*".
+
+    Attributes:
+        since (date): Only messages received on or after this day, or None.
+        before (date): Only messages received before this day, or None.
+        larger_than (int): Only messages larger than this many bytes, or None.
+        senders (list): Only messages from one of these senders (part of the From header).
+        unseen (bool): Only messages without the \\Seen flag.
+        exclude_folders (list): Shell patterns of the folders to leave out.
+
+    Usage:
+        search_filter = SearchFilter(since=datetime.date(2023, 1, 1), senders=["alice@example.com"])
+        email_ids = imap.fetch_emails(search_filter.criteria())
+        plan = BackupPlan.build(imap, email_ids, storage, search_filter)
+    """
+
+    # month names of IMAP dates, which do not depend on the locale
+    _months = ("Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec")
+
+    # multipliers of the size suffixes
+    _units = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+    def __init__(self, **opt):
+        """
+        Initializes a SearchFilter object.
+
+        Args:
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            since (date): Only messages received on or after this day. Default is None.
+            before (date): Only messages received before this day. Default is None.
+            larger_than (int): Only messages larger than this many bytes. Default is None.
+            senders (list): Only messages from one of these senders. Default is None.
+            unseen (bool): Only unread messages. Default is False.
+            exclude_folders (list): Shell patterns of the folders to leave out. Default is None.
+
+        Raises:
+            ValueError: If `since` is not before `before`.
+        """
+        self.since = opt.get('since')
+        self.before = opt.get('before')
+        self.larger_than = opt.get('larger_than')
+        self.senders = list(opt.get('senders') or [])
+        self.unseen = opt.get('unseen', False)
+        self.exclude_folders = list(opt.get('exclude_folders') or [])
+        if self.since is not None and self.before is not None and self.since >= self.before:
+            raise ValueError(f"empty date range: since {self.since} is not before {self.before}")
+
+    @property
+    def selective(self):
+        """
+        bool: True if the filter leaves out some messages of the folders it keeps.
+        """
+        return bool(self.since or self.before or self.larger_than is not None or self.senders or self.unseen)
+
+    @staticmethod
+    def parse_date(value):
+        """
+        Reads a day in ISO format.
+
+        Args:
+            value (str): The day, e.g. "2024-01-31".
+
+        Returns:
+            date: The day.
+
+        Raises:
+            ValueError: If the value is not a valid day.
+        """
+        try:
+            return datetime.date.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f"invalid date {value!r}, expected e.g. 2024-01-31")
+
+    @staticmethod
+    def parse_size(value):
+        """
+        Reads a size in bytes, with an optional K, M or G suffix (powers of 1024).
+
+        Args:
+            value (str): The size, e.g. "500K" or "10M".
+
+        Returns:
+            int: The size in bytes.
+
+        Raises:
+            ValueError: If the value is not a size.
+        """
+        match = re.fullmatch(r"\s*(\d+(?:\.\d+)?)\s*([KMG]?)B?\s*", str(value), re.IGNORECASE)
+        if match is None:
+            raise ValueError(f"invalid size {value!r}, expected e.g. 500K or 10M")
+        return int(float(match.group(1)) * SearchFilter._units[match.group(2).upper()])
+
+    @staticmethod
+    def imap_date(day):
+        """
+        Formats a day as an IMAP date.
+
+        Args:
+            day (date): The day.
+
+        Returns:
+            str: The IMAP date, e.g. "31-Jan-2024".
+        """
+        return f"{day.day}-{SearchFilter._months[day.month - 1]}-{day.year}"
+
+    @staticmethod
+    def _quote(text):
+        """
+        Quotes a string for a SEARCH command.
+
+        Args:
+            text (str): The text.
+
+        Returns:
+            str: The IMAP quoted string.
+        """
+        return '"' + str(text).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+    def criteria(self):
+        """
+        Compiles the filter to IMAP SEARCH criteria, all ASCII.
+
+        Returns:
+            str: The criteria, e.g. 'SINCE 1-Jan-2023 OR FROM "alice" FROM "bob"', or "ALL".
+        """
+        keys = []
+        if self.since is not None:
+            keys.append(f"SINCE {SearchFilter.imap_date(self.since)}")
+        if self.before is not None:
+            keys.append(f"BEFORE {SearchFilter.imap_date(self.before)}")
+        if self.larger_than is not None:
+            keys.append(f"LARGER {self.larger_than}")
+        # a non-ASCII sender would need CHARSET UTF-8; matches() checks the senders anyway
+        if self.senders and all(sender.isascii() for sender in self.senders):
+            # OR takes two keys: OR a OR b c
+            senders = [f"FROM {SearchFilter._quote(sender)}" for sender in self.senders]
+            keys.append(" ".join(["OR"] * (len(senders) - 1) + senders) if len(senders) > 1 else senders[0])
+        if self.unseen:
+            keys.append("UNSEEN")
+        return " ".join(keys) or "ALL"
+
+    def matches(self, email_obj):
+        """
+        Checks a message against the sender and size of the filter, from its headers.
+
+        Args:
+            email_obj (Email): The email, header-only or full, with its size.
+
+        Returns:
+            bool: True if the message must be backed up.
+        """
+        if self.larger_than is not None and email_obj.size is not None and email_obj.size <= self.larger_than:
+            return False
+        if self.senders:
+            sender = EmlStorage.decode_str(str(email_obj.sender or "")).lower()
+            if not any(wanted.lower() in sender for wanted in self.senders):
+                return False
+        return True
+
+    def excludes(self, folder):
+        """
+        Checks whether a folder is left out.
+
+        Args:
+            folder (str): The folder name, as sent by the server or decoded.
+
+        Returns:
+            bool: True if the folder matches one of `exclude_folders`.
+        """
+        return any(fnmatch.fnmatchcase(folder, pattern) for pattern in self.exclude_folders)
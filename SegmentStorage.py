@@ -0,0 +1,381 @@
+from EmailStorage import EmailStorage
+from EmlStorage import EmlStorage
+from Email import Email
+from HashStorage import HashStorage
+from Imap import Imap
+import copy
+import mmap
+import os
+import threading
+from urllib.parse import quote, unquote
+
+
+class SegmentStorage(EmailStorage):
+    """
+    Append-only packed archive implementation of EmailStorage.
+
+    Instead of one file per email, emails are appended back to back to large segment files
+    (`segment-000001.seg`, ...). A new segment is started when the current one reaches the
+    size threshold. Millions of emails then use a few hundred files, which keeps inode usage,
+    directory listings and copies of the backup fast.
+
+    Each segment has an offset index (`segment-000001.idx`) with one line per email: content
+    hash, offset, length, mailbox, UIDVALIDITY and UID. A UID only names the same message
+    within one UIDVALIDITY, so an email is known as stored by all three: after the server
+    resets UIDVALIDITY, the new messages reusing old UIDs are downloaded again. Lines written
+    before UIDVALIDITY was recorded have none, and only match a storage without one. The indexes are loaded at start-up; an email is read
+    back by memory-mapping its segment and slicing it, and `export()` writes the emails out as
+    individual .eml files again. Identical emails are stored once.
+
+    Attributes:
+        path_backup (str): The directory holding the segments.
+        _segment_size (int): The size threshold at which a new segment is started.
+        _records (dict): Content hash to `(segment number, offset, length)`.
+        _uids (dict): `(mailbox, uidvalidity, uid)` to content hash, for the emails already stored.
+        _files (dict): The current segment number and its open data and index files.
+
+    Usage:
+        storage = SegmentStorage("segments", "INBOX")
+        storage.save_email(email_obj)
+        storage.flush()
+        raw = storage.read(storage.key_of("INBOX", email_obj.uid))
+        storage.export("mail")
+        sent = storage.for_mailbox("Sent", 7)  # appends to the same segments
+    """
+
+    def __init__(self, path_backup="segments", mailbox="INBOX", index=None, segment_size=1024 * 1024 * 1024,
+                 uidvalidity=None):
+        """
+        Initializes a SegmentStorage object and loads the segment indexes.
+
+        Args:
+            path_backup (str): The directory holding the segments. Default is "segments".
+            mailbox (str): The mailbox the saved emails come from. Default is "INBOX".
+            index (MailIndex): The metadata index to update for each saved email. Default is None.
+            segment_size (int): Size threshold for starting a new segment. Default is 1 GB.
+            uidvalidity (int): The UIDVALIDITY of the mailbox. Default is None.
+        """
+        self.path_backup = path_backup
+        self.mailbox = mailbox
+        self.uidvalidity = uidvalidity
+        self.index = index
+        self.file_name = None
+        self._prepared = {}
+        self._segment_size = segment_size
+        self._records = {}
+        self._uids = {}
+        self._maps = {}
+        self._lock = threading.Lock()
+        self._files = {"segment": 0, "data": None, "index": None}
+        os.makedirs(path_backup, exist_ok=True)
+        self._load()
+
+    def _segment_name(self, number, extension="seg"):
+        """
+        Returns the path of a segment or of its index.
+
+        Args:
+            number (int): The segment number.
+            extension (str): "seg" for the data, "idx" for the index. Default is "seg".
+
+        Returns:
+            str: The path.
+        """
+        return os.path.join(self.path_backup, f"segment-{number:06d}.{extension}")
+
+    def _load(self):
+        """
+        Loads every segment index and opens the last segment for appending.
+        """
+        numbers = sorted(int(name[8:14]) for name in os.listdir(self.path_backup)
+                         if name.startswith("segment-") and name.endswith(".seg"))
+        for number in numbers:
+            try:
+                with open(self._segment_name(number, "idx")) as index_file:
+                    for line in index_file:
+                        fields = line.rstrip("\n").split("\t")
+                        if not line.endswith("\n") or len(fields) not in (5, 6):
+                            continue  # torn line from an interrupted run
+                        if len(fields) == 5:
+                            fields.insert(4, "")  # written before UIDVALIDITY was recorded
+                        key, offset, length, mailbox, uidvalidity, uid = fields
+                        self._records.setdefault(key, (number, int(offset), int(length)))
+                        if uid:
+                            uidvalidity = int(uidvalidity) if uidvalidity else None
+                            self._uids[(unquote(mailbox), uidvalidity, int(uid))] = key
+            except OSError:
+                pass
+        self._files["segment"] = numbers[-1] if numbers else 1
+        self._open_segment()
+
+    def _open_segment(self):
+        """
+        Opens the current segment and its index for appending.
+        """
+        self._files["data"] = open(self._segment_name(self._files["segment"]), "ab")
+        self._files["index"] = open(self._segment_name(self._files["segment"], "idx"), "a")
+
+    def _roll(self, length):
+        """
+        Starts a new segment if appending `length` bytes would exceed the threshold.
+
+        Args:
+            length (int): The size of the record about to be appended.
+        """
+        position = self._files["data"].tell()
+        if position > 0 and position + length > self._segment_size:
+            self._files["data"].close()
+            self._files["index"].close()
+            self._files["segment"] += 1
+            self._open_segment()
+
+    def prepare(self, email):
+        """
+        Hashes the email ahead of `save_email()`.
+
+        Args:
+            email (Email): The email object about to be saved.
+        """
+        self._prepared[id(email)] = (email, HashStorage.hash_email(email))
+
+    def save_email(self, email):
+        """
+        Append the email to the current segment, unless identical content is already stored.
+
+        Args:
+            email (Email): The email object to be saved.
+
+        Raises:
+            OSError: If there's an error writing the segment or its index.
+        """
+        prepared, key = self._prepared.pop(id(email), (None, None))
+        if prepared is not email:
+            key = HashStorage.hash_email(email)
+        if email.path is not None:
+            length = os.path.getsize(email.path)
+        else:
+            length = len(email.raw_bytes)
+
+        with self._lock:
+            if key not in self._records:
+                self._roll(length)
+                segment_file = self._files["data"]
+                segment_file.flush()
+                offset = segment_file.tell()
+                if email.path is not None:
+                    with open(email.path, "rb") as eml_file:
+                        for chunk in iter(lambda: eml_file.read(1024 * 1024), b""):
+                            segment_file.write(chunk)
+                else:
+                    segment_file.write(email.raw_bytes)
+                self._records[key] = (self._files["segment"], offset, length)
+            else:
+                offset = self._records[key][1]
+            number = self._records[key][0]
+            uid = "" if email.uid is None else str(email.uid)
+            uidvalidity = "" if self.uidvalidity is None else str(self.uidvalidity)
+            self._files["index"].write(f"{key}\t{offset}\t{length}\t{quote(self.mailbox, safe='')}\t"
+                                       f"{uidvalidity}\t{uid}\n")
+            if email.uid is not None:
+                self._uids[(self.mailbox, self.uidvalidity, email.uid)] = key
+            self.file_name = f"{self._segment_name(number)}#{key}"
+
+        if self.index is not None:
+            self.index.add(email, self.file_name, self.mailbox, self.uidvalidity)
+        if email.path is not None:
+            os.remove(email.path)
+            email.path = None
+
+    def contains(self, email):
+        """
+        Checks whether the email's mailbox, UIDVALIDITY and UID are already stored.
+
+        Args:
+            email (Email): The email object, possibly header-only.
+
+        Returns:
+            bool: True if the email is already stored, False otherwise.
+        """
+        return email.uid is not None and (self.mailbox, self.uidvalidity, email.uid) in self._uids
+
+    def file_exists(self):
+        """
+        Checks if the last saved email is in the store.
+
+        Returns:
+           bool: True if the email is stored, False otherwise.
+        """
+        return self.file_name is not None and self.file_name.rsplit("#", 1)[-1] in self._records
+
+    def key_of(self, mailbox, uid, uidvalidity=None):
+        """
+        Returns the content hash stored for a mailbox, UIDVALIDITY and UID.
+
+        Args:
+            mailbox (str): The mailbox.
+            uid (int): The UID.
+            uidvalidity (int): The UIDVALIDITY of the mailbox. Default is None.
+
+        Returns:
+            str: The content hash, or None if the email is not stored.
+        """
+        return self._uids.get((mailbox, uidvalidity, int(uid)))
+
+    def location(self, key):
+        """
+        Returns where a stored email is, to read it without this object, e.g. from another process.
+
+        Args:
+            key (str): The content hash of the email.
+
+        Returns:
+            tuple: (segment file, offset, length), or None if no email with this hash is stored.
+        """
+        record = self._records.get(key)
+        if record is None:
+            return None
+        number, offset, length = record
+        return self._segment_name(number), offset, length
+
+    def keys(self):
+        """
+        Returns the content hashes of all stored emails.
+
+        Returns:
+            list: The content hashes.
+        """
+        return list(self._records)
+
+    def read(self, key):
+        """
+        Reads one stored email through a memory map of its segment.
+
+        Args:
+            key (str): The content hash of the email.
+
+        Returns:
+            bytes: The raw email.
+
+        Raises:
+            KeyError: If no email with this hash is stored.
+        """
+        number, offset, length = self._records[key]
+        with self._lock:
+            if number == self._files["segment"]:
+                self._files["data"].flush()
+            segment_map = self._maps.get(number)
+            if segment_map is None or len(segment_map) < offset + length:
+                if segment_map is not None:
+                    segment_map.close()
+                with open(self._segment_name(number), "rb") as segment_file:
+                    segment_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._maps[number] = segment_map
+            return segment_map[offset:offset + length]
+
+    def for_mailbox(self, mailbox, uidvalidity=None):
+        """
+        Returns a storage object for another mailbox that appends to the same segments.
+
+        The returned object shares the open segment, the indexes and the lock with this one, so
+        several mailboxes can be backed up into one archive at the same time, from several threads.
+
+        Args:
+            mailbox (str): The mailbox the emails saved through the new object come from.
+            uidvalidity (int): The UIDVALIDITY of the mailbox. Default is None.
+
+        Returns:
+            SegmentStorage: The storage object for the mailbox.
+        """
+        storage = copy.copy(self)
+        storage.mailbox = mailbox
+        storage.uidvalidity = uidvalidity
+        storage.file_name = None
+        storage._prepared = {}
+        return storage
+
+    def export(self, path_backup="mail"):
+        """
+        Writes every stored email out as an individual .eml file.
+
+        Each email goes to the directory of its mailbox (see `EmlStorage.folder_path`), with
+        its UID, so the folder hierarchy is kept and emails without a Message-ID still get
+        distinct names. An email stored in several mailboxes is written to each of them;
+        emails saved without a UID go to `path_backup` itself. Files that already exist are
+        left alone and not counted.
+
+        Args:
+            path_backup (str): The destination directory. Default is "mail".
+
+        Returns:
+            int: The number of files written.
+        """
+        storages = {}
+        exported = set()
+        count = 0
+        entries = sorted(self._uids.items(), key=lambda entry: (entry[0][0], entry[0][1] or 0, entry[0][2]))
+        for (mailbox, _, uid), key in entries:
+            exported.add(key)
+            count += self._export_one(storages, path_backup, mailbox, key, uid)
+        for key in self.keys():
+            if key not in exported:
+                count += self._export_one(storages, path_backup, None, key, None)
+        return count
+
+    def _export_one(self, storages, path_backup, mailbox, key, uid):
+        """
+        Writes one stored email out as an .eml file, unless the file exists.
+
+        Args:
+            storages (dict): The EmlStorage of each mailbox already used, by mailbox.
+            path_backup (str): The destination directory.
+            mailbox (str): The mailbox of the email, or None.
+            key (str): The content hash of the email.
+            uid (int): The UID of the email, or None.
+
+        Returns:
+            int: 1 if the file was written, 0 if it already existed.
+        """
+        if mailbox not in storages:
+            path = path_backup if mailbox is None else EmlStorage.folder_path(path_backup,
+                                                                             Imap.decode_folder(mailbox))
+            storages[mailbox] = EmlStorage(path, mailbox or "INBOX")
+        eml_storage = storages[mailbox]
+        email_obj = Email(self.read(key), uid=uid)
+        if eml_storage.contains(email_obj):
+            return 0
+        eml_storage.save_email(email_obj)
+        return 1
+
+    def flush(self):
+        """
+        Makes the appended emails and index lines durable, and commits the metadata index.
+        """
+        with self._lock:
+            for open_file in (self._files["data"], self._files["index"]):
+                open_file.flush()
+                os.fsync(open_file.fileno())
+        if self.index is not None:
+            self.index.flush()
+
+    def spool_dir(self):
+        """
+        Directory for emails streamed to disk before they are appended.
+
+        Returns:
+            str: The spool directory, created if needed.
+        """
+        path = os.path.join(self.path_backup, ".tmp")
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def close(self):
+        """
+        Flushes and closes the segment files and memory maps.
+        """
+        self.flush()
+        with self._lock:
+            for segment_map in self._maps.values():
+                segment_map.close()
+            self._maps.clear()
+            self._files["data"].close()
+            self._files["index"].close()
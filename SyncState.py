@@ -0,0 +1,194 @@
+import json
+import os
+from urllib.parse import quote
+
+
+class SyncState:
+    """
+    Persistent synchronisation checkpoint of one mailbox.
+
+    The state records the UIDVALIDITY of the mailbox, the highest UID already backed up and
+    the UIDNEXT and HIGHESTMODSEQ seen at the end of the last run. A rerun only needs to fetch
+    UIDs above `last_uid`, and can skip the mailbox entirely when HIGHESTMODSEQ has not changed,
+    or, without selecting it, when STATUS reports the same UIDVALIDITY and UIDNEXT.
+
+    If the server reports a different UIDVALIDITY, the stored UIDs are meaningless and the
+    state is reset so the mailbox is backed up again from the start.
+
+    Between two checkpoints (`save()`), every committed UID is appended to a journal file next
+    to the state. A run that is interrupted or crashes loses no progress: `load()` replays the
+    journal, so the next run resumes after the last email that was saved.
+
+    Attributes:
+        _file_name (str): The JSON file the state is stored in.
+        _journal_name (str): The journal of the UIDs committed since the last checkpoint.
+        uidvalidity (int): The UIDVALIDITY the UIDs belong to.
+        last_uid (int): The highest UID already backed up.
+        uidnext (int): The UIDNEXT of the mailbox at the last run, or None.
+        highestmodseq (int): The HIGHESTMODSEQ at the end of the last run, or None.
+
+    Usage:
+        state = SyncState("user@example.com", "INBOX")
+        state.check_uidvalidity(imap.uidvalidity)
+        email_ids = imap.fetch_new_emails(state.last_uid, state.highestmodseq)
+        ...
+        state.save()
+    """
+
+    def __init__(self, account, mailbox, path_backup="mail"):
+        """
+        Initializes a SyncState object and loads the stored checkpoint, if any.
+
+        Args:
+            account (str): The account the mailbox belongs to, e.g. the username.
+            mailbox (str): The mailbox name.
+            path_backup (str): The backup directory. Default is "mail".
+        """
+        directory = os.path.join(path_backup, ".sync", quote(account, safe="@."))
+        self._file_name = os.path.join(directory, quote(mailbox, safe="") + ".json")
+        self._journal_name = os.path.join(directory, quote(mailbox, safe="") + ".journal")
+        self._journal = None
+        self.uidvalidity = None
+        self.last_uid = 0
+        self.uidnext = None
+        self.highestmodseq = None
+        self.load()
+
+    def load(self):
+        """
+        Loads the checkpoint from disk and replays the journal. A missing or unreadable file
+        leaves an empty state.
+        """
+        try:
+            with open(self._file_name) as state_file:
+                data = json.load(state_file)
+        except (OSError, ValueError):
+            return
+        self.uidvalidity = data.get("uidvalidity")
+        self.last_uid = data.get("last_uid", 0)
+        self.uidnext = data.get("uidnext")
+        self.highestmodseq = data.get("highestmodseq")
+        try:
+            with open(self._journal_name) as journal_file:
+                for line in journal_file:
+                    if line.strip().isdigit():  # skips a line torn by a crash
+                        self.last_uid = max(self.last_uid, int(line))
+        except OSError:
+            pass
+
+    def save(self):
+        """
+        Writes the checkpoint to disk atomically, then clears the journal it includes.
+
+        Raises:
+            OSError: If the state file cannot be written.
+        """
+        os.makedirs(os.path.dirname(self._file_name), exist_ok=True)
+        temp_name = self._file_name + ".tmp"
+        with open(temp_name, "w") as state_file:
+            json.dump({"uidvalidity": self.uidvalidity,
+                       "last_uid": self.last_uid,
+                       "uidnext": self.uidnext,
+                       "highestmodseq": self.highestmodseq}, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(temp_name, self._file_name)
+        self._clear_journal()
+
+    def check_uidvalidity(self, uidvalidity):
+        """
+        Resets the state if the mailbox UIDVALIDITY changed since the last run.
+
+        Args:
+            uidvalidity (int): The UIDVALIDITY reported by the server.
+
+        Returns:
+            bool: True if the stored UIDs are still valid, False if the state was reset.
+        """
+        if uidvalidity is not None and self.uidvalidity == uidvalidity:
+            return True
+        self.reset(uidvalidity)
+        return False
+
+    def reset(self, uidvalidity=None):
+        """
+        Forgets the checkpoint so the next run fetches the whole mailbox.
+
+        Args:
+            uidvalidity (int): The UIDVALIDITY to keep. Default is None.
+        """
+        self.uidvalidity = uidvalidity
+        self.last_uid = 0
+        self.uidnext = None
+        self.highestmodseq = None
+        self._clear_journal()
+
+    def is_unchanged(self, status):
+        """
+        Checks a STATUS response against the checkpoint.
+
+        No message was added to the mailbox since the last run if its UIDVALIDITY and UIDNEXT
+        are the same, so it does not need to be selected at all.
+
+        Args:
+            status (dict): The STATUS items of the mailbox, e.g. from `Imap.status()`.
+
+        Returns:
+            bool: True if the mailbox has no new message since the last run.
+        """
+        return (self.uidnext is not None and self.uidvalidity is not None
+                and status.get("UIDVALIDITY") == self.uidvalidity and status.get("UIDNEXT") == self.uidnext)
+
+    def pending(self, status):
+        """
+        Estimates the number of messages to back up from a STATUS response.
+
+        Args:
+            status (dict): The STATUS items of the mailbox.
+
+        Returns:
+            int: The number of UIDs above `last_uid`, at most MESSAGES; MESSAGES if the
+            UIDVALIDITY changed or the mailbox was never backed up.
+        """
+        messages = status.get("MESSAGES", 0)
+        if status.get("UIDVALIDITY") != self.uidvalidity or not status.get("UIDNEXT"):
+            return messages
+        return max(0, min(messages, status["UIDNEXT"] - 1 - self.last_uid))
+
+    def commit(self, uid):
+        """
+        Records that a message was backed up, and appends its UID to the journal.
+
+        The journal line reaches the operating system before this returns, so it survives the
+        process being killed; `sync()` also makes it survive a power loss.
+
+        Args:
+            uid (int): The UID of the saved message.
+
+        Raises:
+            OSError: If the journal cannot be written.
+        """
+        if uid is not None and uid > self.last_uid:
+            self.last_uid = uid
+            if self._journal is None:
+                os.makedirs(os.path.dirname(self._journal_name), exist_ok=True)
+                self._journal = open(self._journal_name, "a")
+            self._journal.write(f"{uid}\n")
+            self._journal.flush()
+
+    def sync(self):
+        """
+        Makes the journal durable on disk.
+        """
+        if self._journal is not None:
+            os.fsync(self._journal.fileno())
+
+    def _clear_journal(self):
+        """
+        Closes and removes the journal, once a checkpoint includes it.
+        """
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self._journal_name):
+            os.remove(self._journal_name)
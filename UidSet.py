@@ -0,0 +1,187 @@
+import array
+import bisect
+import itertools
+
+
+class UidSet:
+    """
+    A set of message UIDs kept as sorted, non-overlapping ranges.
+
+    A mailbox of millions of messages listed by a plain SEARCH is one huge response line
+    split into millions of small bytes objects, held for the whole run. Most mailboxes are
+    long runs of consecutive UIDs with a few gaps where messages were deleted, so this set
+    stores only the first and last UID of each run, in two arrays of machine integers: a
+    mailbox without gaps takes the same few bytes whatever its size.
+
+    Iterating yields the UIDs in ascending order, one at a time, as bytes (b"42"), like the
+    lists `Imap.fetch_emails()` used to return, so the fetch loops consume it as a generator.
+    A set compares equal to a list of the same UIDs, as bytes, str or int.
+
+    Attributes:
+        _starts (array): The first UID of each range.
+        _ends (array): The last UID of each range.
+        _count (int): The number of UIDs.
+
+    Usage:
+        uids = UidSet.from_sequence_set("1:100000,100002:200000")
+        len(uids)  # 199999
+        for email_obj in imap.fetch_batch(uids):
+            ...
+    """
+
+    def __init__(self, uids=None):
+        """
+        Initializes a UidSet object.
+
+        Args:
+            uids (iterable): UIDs to add, as bytes, str or int. Default is None.
+        """
+        self._starts = array.array("L")
+        self._ends = array.array("L")
+        self._count = 0
+        if uids is not None:
+            self.update(uids)
+
+    @classmethod
+    def from_sequence_set(cls, sequence_set):
+        """
+        Builds a set from an IMAP sequence set without expanding it, e.g. the ALL result of ESEARCH.
+
+        Args:
+            sequence_set (str | bytes): The sequence set, e.g. "1:3,7,9:10", or empty.
+
+        Returns:
+            UidSet: The set.
+
+        Raises:
+            ValueError: If the sequence set is malformed, or uses "*".
+        """
+        if isinstance(sequence_set, bytes):
+            sequence_set = sequence_set.decode("ascii")
+        uids = cls()
+        for part in sequence_set.split(","):
+            if part.strip():
+                first, _, last = part.partition(":")
+                first, last = sorted((int(first), int(last or first)))
+                uids.add_range(first, last)
+        return uids
+
+    def add(self, uid):
+        """
+        Adds one UID.
+
+        Args:
+            uid (bytes | str | int): The UID.
+        """
+        uid = int(uid)
+        self.add_range(uid, uid)
+
+    def update(self, uids):
+        """
+        Adds many UIDs, e.g. one page of SEARCH results.
+
+        The runs of consecutive UIDs are found first and added as ranges, which is several
+        times faster than adding the UIDs one by one.
+
+        Args:
+            uids (iterable): The UIDs, as bytes, str or int.
+        """
+        first, last = None, -2
+        for uid in map(int, uids):
+            if uid == last + 1:
+                last = uid
+                continue
+            if first is not None:
+                self.add_range(first, last)
+            first = last = uid
+        if first is not None:
+            self.add_range(first, last)
+
+    def add_range(self, first, last):
+        """
+        Adds the UIDs from `first` to `last`, both included.
+
+        UIDs added in ascending order, as a SEARCH returns them, only extend the last range.
+
+        Args:
+            first (int): The first UID.
+            last (int): The last UID, at least `first`.
+        """
+        starts, ends = self._starts, self._ends
+        if not ends or first > ends[-1] + 1:
+            starts.append(first)
+            ends.append(last)
+            self._count += last - first + 1
+            return
+        if first >= starts[-1]:
+            if last > ends[-1]:
+                self._count += last - ends[-1]
+                ends[-1] = last
+            return
+        # out of order: merge with every range it overlaps or touches
+        low = bisect.bisect_left(ends, first - 1)
+        high = bisect.bisect_right(starts, last + 1)
+        if low < high:
+            first = min(first, starts[low])
+            last = max(last, ends[high - 1])
+            self._count -= sum(ends[i] - starts[i] + 1 for i in range(low, high))
+        starts[low:high] = array.array("L", [first])
+        ends[low:high] = array.array("L", [last])
+        self._count += last - first + 1
+
+    def ranges(self):
+        """
+        Iterates over the ranges of the set.
+
+        Yields:
+            tuple: (first UID, last UID) of each range, in ascending order.
+        """
+        return zip(self._starts, self._ends)
+
+    def ints(self):
+        """
+        Iterates over the UIDs as integers.
+
+        Yields:
+            int: Each UID, in ascending order.
+        """
+        for first, last in self.ranges():
+            yield from range(first, last + 1)
+
+    def sequence_set(self):
+        """
+        Formats the set as a compact IMAP sequence set.
+
+        Returns:
+            str: The sequence set, e.g. "1:3,7,9:10", or "" for an empty set.
+        """
+        return ",".join(str(first) if first == last else f"{first}:{last}" for first, last in self.ranges())
+
+    def __iter__(self):
+        return (b"%d" % uid for uid in self.ints())
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, uid):
+        try:
+            uid = int(uid)
+        except (TypeError, ValueError):
+            return False
+        index = bisect.bisect_right(self._starts, uid) - 1
+        return index >= 0 and uid <= self._ends[index]
+
+    def __eq__(self, other):
+        if isinstance(other, UidSet):
+            return self._starts == other._starts and self._ends == other._ends
+        if isinstance(other, (list, tuple)):
+            return len(other) == self._count and all(
+                int(uid) == expected for uid, expected in zip(other, self.ints()))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        shown = ",".join(str(first) if first == last else f"{first}:{last}"
+                         for first, last in itertools.islice(self.ranges(), 10))
+        return f"UidSet({shown}{',...' if len(self._starts) > 10 else ''}; {self._count} UIDs)"
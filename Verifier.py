@@ -0,0 +1,342 @@
+import concurrent.futures
+import hashlib
+import itertools
+import os
+import re
+import sqlite3
+from CompressedStorage import CompressedStorage
+
+
+class Verifier:
+    """
+    Audits a backup against the server without downloading the messages.
+
+    The server side costs two cheap commands per mailbox: `UID SEARCH ALL` for the UIDs and
+    `UID FETCH <set> (UID RFC822.SIZE)` for their sizes, a few dozen bytes per message. The
+    local side comes from the search index, which maps each (mailbox, UID) to the file (or
+    segment record) it is stored in. Every stored message is then read once to measure its
+    length and compute its SHA-256, over a pool of processes, so hashing uses every core.
+
+    The result of each file is cached in a small SQLite database, keyed by path, mtime and
+    size: an unchanged file is not read again, and a later audit of a multi-terabyte archive
+    only reads what changed since. With `rehash`, every file is read again and a digest that
+    differs from the cached one, for an unchanged mtime and size, reveals silent corruption.
+
+    Each mailbox is reported with:
+
+    - missing: on the server, but not stored or the file is gone;
+    - truncated: stored shorter than its RFC822.SIZE on the server;
+    - corrupt: stored longer than on the server, or not matching its content hash (the file
+      name of the hash store, the key of a segment record, or the cached digest);
+    - extra: stored, but no longer on the server.
+
+    IMAP has no standard command returning a content hash, so the server side is compared by
+    size only; the content is checked against the hashes recorded at backup time.
+
+    Only the emails of `account` are taken from the index, which a multi-account backup
+    shares (see `MailIndex.account_entries()`), and emails saved under another UIDVALIDITY
+    than the current one of their mailbox are left out, since their UIDs now name other
+    messages.
+
+    Attributes:
+        _index (MailIndex): The search index of the backup.
+        _jobs (int): Number of hashing processes; 1 hashes in the calling process.
+        _cache_file (str): The SQLite file caching the digests.
+        _rehash (bool): True to read every file again.
+        _segments (SegmentStorage): Resolves segment records, or None.
+        _dictionary_dir (str): Where the zstd dictionaries of compressed backups are kept.
+        _account (str): The account whose emails are verified, or None for every email.
+
+    Usage:
+        verifier = Verifier(MailIndex("mail/index.sqlite"), jobs=8)
+        report = verifier.run(imap)
+        print(Verifier.summary(report))
+    """
+
+    # a content hash at the end of a stored path: the hash store file name or a segment key
+    _hash_path = re.compile(r'(?:#|[\\/])([0-9a-f]{64})(?:\.eml)?$')
+
+    # folders that cannot hold messages
+    _not_selectable = {"\\NOSELECT", "\\NONEXISTENT"}
+
+    # UIDs per RFC822.SIZE command; consecutive UIDs collapse to ranges in the command
+    _size_batch = 10000
+
+    # compressed file readers of a hashing process, by dictionary directory and codec
+    _readers = {}
+
+    def __init__(self, index, **opt):
+        """
+        Initializes a Verifier object.
+
+        Args:
+            index (MailIndex): The search index of the backup.
+            **opt: Additional optional parameters.
+
+        Keyword Args:
+            jobs (int): Hashing processes. Default is the number of CPUs.
+            cache_file (str): The digest cache. Default is "verify-cache.sqlite" next to the index.
+            rehash (bool): Read every file again instead of trusting the cache. Default is False.
+            segments (SegmentStorage): The segment archive, to verify a segment backup. Default is None.
+            dictionary_dir (str): The zstd dictionaries of a compressed backup. Default is "mail/.dict".
+            account (str): The account to verify in a multi-account index. Default is None (every email).
+        """
+        self._index = index
+        self._jobs = max(1, opt.get('jobs') or os.cpu_count() or 1)
+        self._cache_file = opt.get('cache_file') or os.path.join(os.path.dirname(index.file_name),
+                                                                 "verify-cache.sqlite")
+        self._rehash = opt.get('rehash', False)
+        self._segments = opt.get('segments')
+        self._dictionary_dir = opt.get('dictionary_dir') or os.path.join("mail", ".dict")
+        self._account = opt.get('account')
+
+    def run(self, client, mailboxes=None, all_folders=False):
+        """
+        Compares the backup with the server, mailbox by mailbox.
+
+        A mailbox of the index that no longer exists on the server has all its messages
+        reported as extra.
+
+        Args:
+            client (EmailClient): A connected client providing `list_folders()`, `select()`,
+                `fetch_emails()` and `fetch_sizes()`.
+            mailboxes (list): The mailboxes to verify. Default is every mailbox in the index.
+            all_folders (bool): Also verify the server folders missing from the index, whose
+                messages are then all missing. Default is False.
+
+        Returns:
+            dict: The report of each mailbox, by name: "server" and "stored" (message counts),
+            and the sorted UID lists "missing", "truncated", "corrupt" and "extra".
+
+        Raises:
+            ConnectionError: If the server cannot be queried.
+            OSError: If the digest cache cannot be written.
+            ValueError: If the index holds other accounts and the emails of `account` cannot be told apart.
+        """
+        rows = {}
+        for row in self._index.account_entries(self._account):
+            rows.setdefault(row["mailbox"], []).append(row)
+        folders = {name for name, _, flags in client.list_folders() if not flags & Verifier._not_selectable}
+        if mailboxes is None:
+            mailboxes = sorted(set(rows) | folders) if all_folders else sorted(rows)
+
+        server, stored = {}, {}
+        for mailbox in mailboxes:
+            sizes = {}
+            uidvalidity = None
+            if mailbox in folders:
+                client.select(mailbox)
+                uidvalidity = client.uidvalidity
+                uids = (int(uid) for uid in client.fetch_emails())
+                for chunk in iter(lambda: list(itertools.islice(uids, Verifier._size_batch)), []):
+                    sizes.update(client.fetch_sizes(chunk))
+            server[mailbox] = sizes
+            stored[mailbox] = {}
+            for row in rows.get(mailbox, []):
+                if row["uidvalidity"] is not None and uidvalidity is not None and row["uidvalidity"] != uidvalidity:
+                    continue  # saved before the UIDs of the mailbox were reset
+                stored[mailbox].setdefault(int(row["uid"]), row["path"])
+        digests = self.digests({path for mailbox in mailboxes for path in stored[mailbox].values()})
+        return {mailbox: Verifier.compare(server[mailbox], stored[mailbox], digests) for mailbox in mailboxes}
+
+    def digests(self, paths):
+        """
+        Measures and hashes stored messages, from the cache when their file has not changed.
+
+        Args:
+            paths (iterable): The stored paths, as recorded in the index.
+
+        Returns:
+            dict: (length, SHA-256 hex digest, cached digest or None) by path, or None for a
+            path whose file is missing.
+
+        Raises:
+            OSError: If the cache cannot be written.
+            ValueError: If a segment path is found without `segments`, or a .zst file
+                without the zstandard package.
+        """
+        cache = sqlite3.connect(self._cache_file)
+        try:
+            with cache:
+                cache.execute("CREATE TABLE IF NOT EXISTS digests (path TEXT PRIMARY KEY, mtime INTEGER,"
+                              " size INTEGER, length INTEGER, sha256 TEXT)")
+            cached = {row[0]: row[1:]
+                      for row in cache.execute("SELECT path, mtime, size, length, sha256 FROM digests")}
+
+            results = {}
+            tasks = []
+            stats = {}
+            for path in paths:
+                task = self._task(path)
+                try:
+                    stat = os.stat(task[0])
+                except OSError:
+                    results[path] = None
+                    continue
+                stats[path] = (stat.st_mtime_ns, stat.st_size)
+                entry = cached.get(path)
+                if entry is not None and entry[:2] == stats[path] and not self._rehash:
+                    results[path] = (entry[2], entry[3], entry[3])
+                else:
+                    tasks.append((path, task))
+
+            if self._jobs > 1 and len(tasks) > 1:
+                with concurrent.futures.ProcessPoolExecutor(self._jobs) as executor:
+                    measured = list(executor.map(Verifier._digest, [task for _, task in tasks], chunksize=64))
+            else:
+                measured = [Verifier._digest(task) for _, task in tasks]
+
+            rows = []
+            for (path, _), result in zip(tasks, measured):
+                if result is None:
+                    results[path] = None
+                    continue
+                entry = cached.get(path)
+                # a digest is only comparable if the file was not legitimately rewritten since
+                previous = entry[3] if entry is not None and entry[:2] == stats[path] else None
+                results[path] = (result[0], result[1], previous)
+                if previous in (None, result[1]):
+                    rows.append((path, *stats[path], *result))  # a mismatch keeps the known good digest
+            with cache:
+                cache.executemany("INSERT OR REPLACE INTO digests (path, mtime, size, length, sha256)"
+                                  " VALUES (?, ?, ?, ?, ?)", rows)
+            return results
+        except sqlite3.Error as e:
+            raise OSError(f"digest cache {self._cache_file}: {e}")
+        finally:
+            cache.close()
+
+    def _task(self, path):
+        """
+        Describes how to read a stored message, for a hashing process.
+
+        Args:
+            path (str): The stored path, a file or "<segment>#<key>".
+
+        Returns:
+            tuple: (file name, offset, length or None, dictionary directory).
+
+        Raises:
+            ValueError: If the path is a segment record and no segment archive was given.
+        """
+        if "#" in path:
+            if self._segments is None:
+                raise ValueError("verifying a segment backup needs the segment archive")
+            location = self._segments.location(path.rsplit("#", 1)[1])
+            if location is None:
+                return path, 0, None, None  # unknown record, reported missing
+            return location + (None,)
+        return path, 0, None, self._dictionary_dir
+
+    @staticmethod
+    def _digest(task):
+        """
+        Reads a stored message and returns its length and SHA-256. Runs in a hashing process.
+
+        Args:
+            task (tuple): (file name, offset, length or None for the whole file, dictionary
+                directory), as built by `_task()`.
+
+        Returns:
+            tuple: (length, hex digest), or None if the file cannot be read.
+        """
+        file_name, offset, length, dictionary_dir = task
+        digest = hashlib.sha256()
+        try:
+            if file_name.endswith((".gz", ".zst")):
+                codec = "gzip" if file_name.endswith(".gz") else "zstd"
+                key = (dictionary_dir, codec)
+                if key not in Verifier._readers:
+                    Verifier._readers[key] = CompressedStorage(os.path.dirname(file_name), codec=codec,
+                                                               dictionary_dir=dictionary_dir)
+                data = Verifier._readers[key].read(file_name)
+                digest.update(data)
+                return len(data), digest.hexdigest()
+            total = 0
+            with open(file_name, "rb") as stored_file:
+                stored_file.seek(offset)
+                remaining = length
+                while remaining is None or remaining > 0:
+                    chunk = stored_file.read(1024 * 1024 if remaining is None else min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    total += len(chunk)
+                    if remaining is not None:
+                        remaining -= len(chunk)
+            return total, digest.hexdigest()
+        except OSError:
+            return None
+
+    @staticmethod
+    def compare(sizes, stored, digests):
+        """
+        Compares the messages of one mailbox on the server and in the backup.
+
+        Args:
+            sizes (dict): RFC822.SIZE by UID, on the server.
+            stored (dict): The stored path by UID.
+            digests (dict): The result of `digests()` by path.
+
+        Returns:
+            dict: "server", "stored", "missing", "truncated", "corrupt" and "extra".
+        """
+        report = {"server": len(sizes), "stored": len(stored), "missing": [], "truncated": [], "corrupt": [],
+                  "extra": []}
+        for uid, path in stored.items():
+            if uid not in sizes:
+                report["extra"].append(uid)
+        for uid, size in sizes.items():
+            path = stored.get(uid)
+            result = digests.get(path) if path is not None else None
+            if result is None:
+                report["missing"].append(uid)
+                continue
+            length, sha256, previous = result
+            expected = Verifier._hash_path.search(path)
+            if length < size:
+                report["truncated"].append(uid)
+            elif length > size or (expected and expected.group(1) != sha256) or previous not in (None, sha256):
+                report["corrupt"].append(uid)
+        for kind in ("missing", "truncated", "corrupt", "extra"):
+            report[kind].sort()
+        return report
+
+    @staticmethod
+    def summary(report):
+        """
+        Formats a report, one line per mailbox with a problem and a total.
+
+        Args:
+            report (dict): The result of `run()`.
+
+        Returns:
+            str: The summary.
+        """
+        lines = []
+        totals = {"server": 0, "stored": 0, "missing": 0, "truncated": 0, "corrupt": 0, "extra": 0}
+        for mailbox, result in sorted(report.items()):
+            counts = {kind: len(result[kind]) for kind in ("missing", "truncated", "corrupt", "extra")}
+            for kind in totals:
+                totals[kind] += result[kind] if kind in ("server", "stored") else counts[kind]
+            if any(counts.values()):
+                problems = ", ".join(f"{count} {kind}" for kind, count in counts.items() if count)
+                lines.append(f"{mailbox}: {problems} (UIDs {Verifier._sample(result)})")
+        lines.append(f"{len(report)} mailboxes, {totals['server']} messages on the server, "
+                     f"{totals['stored']} stored: {totals['missing']} missing, {totals['truncated']} truncated, "
+                     f"{totals['corrupt']} corrupt, {totals['extra']} extra")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _sample(result):
+        """
+        Lists the first UIDs with a problem in a mailbox, for the summary.
+
+        Args:
+            result (dict): The report of the mailbox.
+
+        Returns:
+            str: Up to 10 UIDs, e.g. "3, 7, 12 ...".
+        """
+        uids = sorted(set(result["missing"] + result["truncated"] + result["corrupt"] + result["extra"]))
+        return ", ".join(map(str, uids[:10])) + (" ..." if len(uids) > 10 else "")
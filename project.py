@@ -1,11 +1,35 @@
 from Imap import Imap
 from sys import exit
 from EmlStorage import EmlStorage
+from SyncState import SyncState
+from Downloader import Downloader
+from BackupPlan import BackupPlan
+from HashStorage import HashStorage
+from MailIndex import MailIndex
+from SegmentStorage import SegmentStorage
+from FolderScheduler import FolderScheduler
+from CompressedStorage import CompressedStorage
+from Pipeline import Pipeline
+from Benchmark import Benchmark
+from FakeImapServer import FakeImapServer
+from Metrics import Metrics
+from Profiler import Profiler
+from ConnectionPool import ConnectionPool
+from AccountRunner import AccountRunner
+from RateLimiter import RateLimiter
+from Verifier import Verifier
+from AttachmentStore import AttachmentStore
+from Restorer import Restorer
+from SearchFilter import SearchFilter
+from urllib.parse import quote
+import os
+import json
 import argparse
 import sys
+import time
 
 
-def parser_args(args=None):
+def parser_options(args=None):
     # parse args
     parser = argparse.ArgumentParser(description="EmailSafe, the ultimate email backup tool provide a seamless and "
                                                  "efficient solution to safeguard your valuable emails.")
@@ -13,13 +37,124 @@ def parser_args(args=None):
     parser.add_argument("--port", type=int, help="IMAP server port")
     parser.add_argument("--username", help="Username")
     parser.add_argument("--password", help="Password")
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per FETCH command (default 100)")
+    parser.add_argument("--batch-bytes", type=int, default=20 * 1024 * 1024,
+                        help="Byte budget per FETCH command (default 20 MB)")
+    parser.add_argument("--workers", type=int, default=1, help="Parallel IMAP sessions (default 1)")
+    parser.add_argument("--max-connections", type=int, default=10,
+                        help="Connection limit of the server, caps --workers (default 10)")
+    parser.add_argument("--sync-batch", type=int, default=100,
+                        help="Emails written between two syncs to disk (default 100)")
+    parser.add_argument("--stream", action="store_true",
+                        help="Stream emails straight to disk instead of holding them in memory")
+    parser.add_argument("--no-plan", action="store_true",
+                        help="Skip the header-only planning pass and download every candidate email")
+    parser.add_argument("--storage", choices=["eml", "hash", "segment"], default="eml",
+                        help="eml: one {sender}_{subject}.eml file per email in mail/ (default); "
+                             "hash: deduplicated content-addressed store in store/; "
+                             "segment: packed append-only segment files in segments/")
+    parser.add_argument("--compress", choices=["gzip", "zstd"],
+                        help="Save .eml.gz or .eml.zst files instead of .eml files (zstd needs the zstandard package)")
+    parser.add_argument("--compress-level", type=int,
+                        help="Compression level (default 6 for gzip, 3 for zstd)")
+    parser.add_argument("--full", action="store_true", help="Ignore the sync state and fetch every email again")
+    parser.add_argument("--no-index", action="store_true", help="Do not record saved emails in the search index")
+    parser.add_argument("--all-folders", action="store_true",
+                        help="Back up every folder of the account, --workers folders at a time, "
+                             "skipping the folders without new messages")
+
+    parser.add_argument("--metrics", help="Export counters and histograms to this file during and after the run")
+    parser.add_argument("--metrics-format", choices=Metrics.formats,
+                        help="jsonl (one snapshot per line) or prometheus (textfile collector); "
+                             "default prometheus for .prom files, jsonl otherwise")
+    parser.add_argument("--metrics-interval", type=float, default=10,
+                        help="Seconds between two metrics exports during a run (default 10)")
+    parser.add_argument("--profile", help="Profile the run with cProfile and write the statistics to this file")
+    parser.add_argument("--max-rate", type=RateLimiter.parse_rate,
+                        help="Maximum download rate per account in bytes/s, e.g. 500K or 5M (default unlimited)")
+    parser.add_argument("--max-commands", type=float,
+                        help="Maximum IMAP commands per second per account (default unlimited)")
+    parser.add_argument("--config", help="Back up every account of this TOML file, in one process")
+    parser.add_argument("--report", help="With --config, also write the summary of the accounts as JSON to this file")
+    parser.add_argument("--attachments", action="store_true",
+                        help="After the backup, extract the attachments of the new emails into a deduplicated store")
+    selection = parser.add_argument_group("selective backup", "Back up only the matching emails; the server "
+                                          "searches its own index, so the other emails are never downloaded")
+    selection.add_argument("--since", type=SearchFilter.parse_date,
+                           help="Only emails received on or after this day, e.g. 2023-01-01")
+    selection.add_argument("--before", type=SearchFilter.parse_date,
+                           help="Only emails received before this day, e.g. 2024-01-01")
+    selection.add_argument("--larger-than", type=SearchFilter.parse_size,
+                           help="Only emails larger than this size in bytes, e.g. 500K or 10M")
+    selection.add_argument("--from", dest="senders", action="append",
+                           help="Only emails from this sender (part of the name or address), can be repeated")
+    selection.add_argument("--unseen", action="store_true", help="Only unread emails")
+    selection.add_argument("--exclude-folder", dest="exclude_folders", action="append",
+                           help="With --all-folders, leave out the folders matching this pattern, "
+                                "e.g. Spam or 'Archive/*', can be repeated")
+    subparsers = parser.add_subparsers(dest="command")
+    search = subparsers.add_parser("search", help="Search the index of the backup by sender, subject or Message-ID")
+    search.add_argument("query", help="Words to search for")
+    search.add_argument("--index", default=os.path.join("mail", "index.sqlite"), help="Index database file")
+    search.add_argument("--limit", type=int, default=50, help="Maximum number of results (default 50)")
+    export = subparsers.add_parser("export", help="Write the emails of a segment archive out as .eml files")
+    export.add_argument("--segments", default="segments", help="Segment archive directory (default segments)")
+    export.add_argument("--output", default="mail", help="Destination directory (default mail)")
+    verify = subparsers.add_parser("verify", help="Compare the backup with the server without downloading it")
+    verify.add_argument("--jobs", type=int, help="Processes hashing the stored emails (default one per CPU)")
+    verify.add_argument("--rehash", action="store_true",
+                        help="Read every stored email again instead of trusting the digest cache")
+    verify.add_argument("--output", help="Also write the full report as JSON to this file")
+    restore = subparsers.add_parser("restore", help="Upload the backup to the server, skipping the emails already there")
+    restore.add_argument("--mailbox", action="append",
+                         help="Mailbox of the backup to restore, can be repeated (default all)")
+    restore.add_argument("--prefix", default="", help="Prepended to the mailbox names on the server, e.g. Restored/")
+    restore.add_argument("--account",
+                         help="Account of a multi-account backup to restore, if not --username (default --username)")
+    attachments = subparsers.add_parser("attachments", help="Search the extracted attachments by sender, type or name")
+    attachments.add_argument("--from", dest="sender", help="Part of the sender's name or address")
+    attachments.add_argument("--type", help="MIME type (application/pdf) or file extension (pdf)")
+    attachments.add_argument("--name", help="Part of the file name")
+    attachments.add_argument("--limit", type=int, default=50, help="Maximum number of results (default 50)")
+    attachments.add_argument("--extract", action="store_true",
+                             help="First extract the attachments of the emails not extracted yet")
+    attachments.add_argument("--jobs", type=int, help="Processes parsing the stored emails (default one per CPU)")
+    benchmark = subparsers.add_parser("benchmark", help="Measure a full backup against a local fake IMAP server")
+    benchmark.add_argument("--messages", type=int, default=1000, help="Messages in the mailbox (default 1000)")
+    benchmark.add_argument("--distribution", choices=FakeImapServer.distributions, default="lognormal",
+                           help="Message size distribution (default lognormal)")
+    benchmark.add_argument("--mean-size", type=int, default=20 * 1024, help="Mean message size in bytes (default 20480)")
+    benchmark.add_argument("--latency-ms", type=float, default=0.0,
+                           help="Simulated round trip per IMAP command in milliseconds (default 0)")
+    benchmark.add_argument("--workers", type=int, default=1, help="Parallel IMAP sessions (default 1)")
+    benchmark.add_argument("--storage", choices=Benchmark.storages, default="eml", help="Storage backend (default eml)")
+    benchmark.add_argument("--compress", choices=["gzip", "zstd"], help="Compress .eml files")
+    benchmark.add_argument("--sync-batch", type=int, default=100, help="Emails written per disk sync (default 100)")
+    benchmark.add_argument("--no-plan", action="store_true", help="Skip the header-only planning pass")
+    benchmark.add_argument("--server-quota", type=RateLimiter.parse_rate,
+                           help="Bandwidth quota of the fake server in bytes/s, e.g. 20M (default none)")
+    benchmark.add_argument("--max-rate", type=RateLimiter.parse_rate, help="Client rate limit in bytes/s")
+    benchmark.add_argument("--output", help="Also append the result as one JSON line to this file")
 
     args = parser.parse_args(args)
+    if args.metrics and args.metrics_format is None:
+        args.metrics_format = "prometheus" if args.metrics.endswith(".prom") else "jsonl"
 
-    if not all(vars(args).values()):
+    if args.since and args.before and args.since >= args.before:
+        parser.print_help()
+        raise ValueError(f"--since {args.since} must be before --before {args.before}")
+    if args.attachments and args.no_index:
+        parser.print_help()
+        raise ValueError("--attachments records the attachments in the index, it cannot be used with --no-index")
+    needs_server = args.command in ("verify", "restore") or (args.command is None and not args.config)
+    if needs_server and not all([args.server, args.port, args.username, args.password]):
         parser.print_help()
         raise ValueError("not complete argument")
+    return args
+
 
+def parser_args(args=None):
+    args = parser_options(args)
     server = args.server
     port = args.port
     username = args.username
@@ -27,41 +162,543 @@ def parser_args(args=None):
     return server, port, username, password
 
 
-def connection(config):
-    print("Connect to server ...")
-    imap = Imap(config[0], config[1], config[2], config[3], ssl=True)
-    imap.connect()
+def connection(config, pool=None, verbose=True, **opt):
+    if verbose:
+        print("Connect to server ...")
+    if pool is not None:
+        imap = pool.acquire()
+    else:
+        imap = Imap(config[0], config[1], config[2], config[3], ssl=True, **opt)
+        imap.connect()
     if imap.is_connected():
-        print("Server Connected")
+        if verbose:
+            print("Server Connected")
         return imap
     else:
         raise ConnectionError("Fail connect")
 
 
-def fetch_inbox(imap):
-    animation = '/|\\-'  # Animation characters
-    # fetch inbox
-    i = 1
-    try:
-        for email_id in imap.fetch_emails():
-            email_obj = imap.fetch_email(email_id)
-            EmlStorage.save_email(email_obj)
-            sys.stdout.write('\r')
-            sys.stdout.write('Processing: [{0}] => {1} Email'.format(animation[i % len(animation)], i))
+def session_factory(config, mailbox, **opt):
+    # build a callable that opens one more session on the same mailbox, for the worker pool
+    def factory():
+        imap = Imap(config[0], config[1], config[2], config[3], ssl=True, **opt)
+        imap.connect(mailbox)
+        return imap
+    return factory
+
+
+def search_filter(options):
+    # the selection of --since, --before, --larger-than, --from, --unseen and --exclude-folder,
+    # or None to back up everything
+    search = SearchFilter(since=options.since, before=options.before, larger_than=options.larger_than,
+                          senders=options.senders, unseen=options.unseen, exclude_folders=options.exclude_folders)
+    if not search.selective and not search.exclude_folders:
+        return None
+    return search
+
+
+def fetch_inbox(imap, state=None, workers=1, factory=None, max_connections=10, stream=False, plan=False,
+                storage=None, verbose=True, sync_batch=100, metrics_file=None, metrics_format="jsonl",
+                metrics_interval=10, release=None, search=None):
+    metrics = Metrics.shared()
+    if storage is None:
+        storage = EmlStorage()
+    if search is not None and search.selective:
+        # the server selects the emails; the sync state is neither used nor advanced, so a
+        # later unfiltered run still backs up the emails left out
+        state = None
+        plan = True  # the headers are checked again, servers match FROM differently
+        email_ids = imap.fetch_emails(search.criteria())
+        if verbose:
+            print(f"{len(email_ids)} emails match {search.criteria()}")
+    # fetch inbox, or only the emails added since the last run when a sync state is given
+    elif state is None:
+        email_ids = imap.fetch_emails()
+    else:
+        state.check_uidvalidity(imap.uidvalidity)
+        state.save()  # binds the journal of this run to the UIDVALIDITY
+        email_ids = imap.fetch_new_emails(state.last_uid, state.highestmodseq)
+
+    # header-only planning pass: skip stored emails and know the total size up front
+    total_bytes = None
+    if plan and email_ids:
+        backup_plan = BackupPlan.build(imap, email_ids, storage, search)
+        email_ids, total_bytes = backup_plan.missing, backup_plan.total_bytes
+        if verbose:
+            print(f"{len(email_ids)} emails to download ({format_bytes(total_bytes)}), "
+                  f"{backup_plan.stored} already stored"
+                  + (f", {backup_plan.filtered} left out by the filter" if backup_plan.filtered else ""))
+    progress = {'count': 0, 'bytes': 0, 'start': time.monotonic(), 'shown': 0.0, 'exported': time.monotonic()}
+
+    def saved(email_obj):
+        if state is not None:
+            state.commit(email_obj.uid)
+        progress['count'] += 1
+        progress['bytes'] += email_obj.size or 0
+        metrics.inc("emailsafe_saved_total")
+        now = time.monotonic()
+        if metrics_file and now - progress['exported'] >= metrics_interval:
+            metrics.write(metrics_file, metrics_format)
+            progress['exported'] = now
+        # redraw at most 10 times per second, printing is not free on large mailboxes
+        if verbose and now - progress['shown'] >= 0.1:
+            sys.stdout.write('\r' + progress_line(progress, total_bytes))
             sys.stdout.flush()
-            i += 1
+            progress['shown'] = now
+
+    spool_dir = storage.spool_dir() if stream else None
+    try:
+        if workers > 1 and factory is not None:
+            # the session used to list the UIDs stays open and counts against the limit
+            downloader = Downloader(factory, storage, workers=workers, max_connections=max_connections - 1,
+                                    spool_dir=spool_dir, sync_batch=sync_batch, release=release)
+            downloader.run(email_ids, on_saved=saved)
+            if verbose:
+                print('\r' + progress_line(progress, total_bytes))
+        else:
+            if stream:
+                emails = imap.fetch_batch_to_files(email_ids, spool_dir)
+            else:
+                emails = imap.fetch_batch(email_ids)
+            # fetch, parse/name and write overlap on three threads; each batch is synced once
+            pipeline = Pipeline(storage, sync_batch=sync_batch)
+            pipeline.run(emails, on_saved=saved)
+            if verbose:
+                print('\r' + progress_line(progress, total_bytes))
+                print(pipeline.report())
+        if state is not None:
+            state.uidnext = imap.uidnext
+            state.highestmodseq = imap.highestmodseq
+            state.save()
+        if verbose and format_stats(storage.stats()):
+            print("\n" + format_stats(storage.stats()))
     except OSError:
         raise
     except ConnectionError:
         raise
+    finally:
+        storage.flush()
+        if state is not None:
+            # checkpoint the emails saved so far, also when the run is interrupted
+            state.save()
+    return progress['count']
+
+
+def eml_storage(path, mailbox, index=None, compress=None, level=None, dictionary_dir=None, uidvalidity=None):
+    # one file per email: plain .eml, or .eml.gz / .eml.zst with --compress
+    if compress:
+        return CompressedStorage(path, mailbox, index=index, codec=compress, level=level,
+                                 dictionary_dir=dictionary_dir, uidvalidity=uidvalidity)
+    return EmlStorage(path, mailbox, index=index, uidvalidity=uidvalidity)
+
+
+def folder_storage(kind, root, job, index=None, archive=None, compress=None, level=None, account=None):
+    # storage backend of one folder; eml files keep the folder hierarchy as directories
+    if kind == "hash":
+        return HashStorage(root, job["name"], job["status"].get("UIDVALIDITY"), index=index, account=account)
+    if kind == "segment":
+        return archive.for_mailbox(job["name"], job["status"].get("UIDVALIDITY"))
+    return eml_storage(EmlStorage.folder_path(root, Imap.decode_folder(job["name"]), job["delimiter"]),
+                       job["name"], index, compress, level, os.path.join(root, ".dict"),
+                       job["status"].get("UIDVALIDITY"))
+
+
+def fetch_folders(imap, config, options, root, index=None, pool=None, account=None, verbose=True):
+    # back up every folder that changed since the last run, largest first, on parallel sessions
+    states = {}
+    stats = {}
+    search = search_filter(options)
+    exclude = None
+    if search is not None and search.exclude_folders:
+        def exclude(name):
+            return search.excludes(name) or search.excludes(Imap.decode_folder(name))
+
+    def state_for(name, delimiter):
+        path = root
+        if options.storage == "eml":
+            path = EmlStorage.folder_path(root, Imap.decode_folder(name), delimiter)
+        states[name] = SyncState(options.username, name, path)
+        if options.full:
+            states[name].reset()
+        return states[name]
+
+    archive = SegmentStorage(root, index=index) if options.storage == "segment" else None
+
+    def backup(client, job):
+        storage = folder_storage(options.storage, root, job, index, archive, options.compress,
+                                 options.compress_level, account)
+        count = fetch_inbox(client, states[job["name"]], stream=options.stream, plan=not options.no_plan,
+                            storage=storage, verbose=False, sync_batch=options.sync_batch, search=search)
+        stats[job["name"]] = storage.stats()
+        return count
+
+    if pool is not None:
+        # the session used to list the folders goes back to the pool for the first worker
+        scheduler = FolderScheduler(pool.acquire, workers=options.workers, max_connections=pool.max_size,
+                                    release=pool.release, exclude=exclude)
+    else:
+        factory = session_factory(config, imap.mailbox, batch_size=options.batch_size,
+                                  max_bytes=options.batch_bytes)
+        # the session used to list the folders stays open and counts against the limit
+        scheduler = FolderScheduler(factory, workers=options.workers, max_connections=options.max_connections - 1,
+                                    exclude=exclude)
+    jobs = scheduler.plan(imap, state_for)
+    if pool is not None:
+        pool.release(imap)
+    if verbose:
+        print(f"{len(jobs)} folders to back up, {len(scheduler.skipped)} unchanged"
+              + (f", {len(scheduler.excluded)} excluded" if scheduler.excluded else ""))
+    try:
+        results = scheduler.run(jobs, backup)
+    finally:
+        if archive is not None:
+            archive.close()
+    if verbose:
+        for job in jobs:
+            name = Imap.decode_folder(job["name"])
+            if job["name"] in scheduler.errors:
+                print(f"{name}: error : {scheduler.errors[job['name']]}")
+            else:
+                report = format_stats(stats.get(job["name"], {}))
+                print(f"{name}: {results.get(job['name'], 0)} emails" + (f", {report}" if report else ""))
+    if scheduler.errors:
+        raise ConnectionError(f"{len(scheduler.errors)} folders failed")
+    return results
+
+
+def account_root(root, kind, username, shared=None):
+    # the archive directory of an account: with --config (shared=True) every account gets its
+    # own eml or segment directory under root, while the hash store is shared; shared=None
+    # looks for that directory, for the commands that read an existing backup
+    if kind == "hash" or not username:
+        return root
+    account_dir = os.path.join(root, quote(username, safe="@."))
+    if shared is None:
+        shared = os.path.isdir(account_dir)
+    return account_dir if shared else root
+
+
+def backup_account(options, root, index=None, shared=False, verbose=True, limiter=None):
+    # back up INBOX, or every folder with --all-folders, of the account of the options;
+    # with shared=True several accounts use the same root: eml and segment archives get one
+    # directory per account, the hash store is shared and only its mailbox indexes are not
+    config = (options.server, options.port, options.username, options.password)
+    # the sessions of the account share one rate limiter, below the global one if any
+    rate_limiter = RateLimiter(options.max_rate, options.max_commands, parent=limiter)
+    account = options.username if shared else None
+    if index is not None:  # tag the indexed rows with the account, for restore and verify to filter on
+        index = index.for_account(options.username)
+    root = account_root(root, options.storage, options.username, shared)
+    # every session of the account comes from one pool, so sessions and TLS sessions are reused
+    pool = ConnectionPool(session_factory(config, "INBOX", batch_size=options.batch_size,
+                                          max_bytes=options.batch_bytes, rate_limiter=rate_limiter),
+                          max_size=options.max_connections)
+    storage = None
+    try:
+        imap = connection(config, pool=pool, verbose=verbose)
+        if options.all_folders:
+            results = fetch_folders(imap, config, options, root, index, pool, account, verbose)
+            return sum(results.values())
+        if options.storage == "hash":
+            storage = HashStorage(root, imap.mailbox, imap.uidvalidity, index=index, account=account)
+        elif options.storage == "segment":
+            storage = SegmentStorage(root, imap.mailbox, index=index, uidvalidity=imap.uidvalidity)
+        else:
+            storage = eml_storage(root, imap.mailbox, index, options.compress, options.compress_level,
+                                  uidvalidity=imap.uidvalidity)
+        state = SyncState(options.username, imap.mailbox, storage.path_backup)
+        if options.full:
+            state.reset()
+        mailbox = imap.mailbox
+        count = fetch_inbox(imap, state, options.workers, lambda: pool.acquire(mailbox), options.max_connections,
+                            options.stream, plan=not options.no_plan, storage=storage, verbose=verbose,
+                            sync_batch=options.sync_batch, metrics_file=options.metrics,
+                            metrics_format=options.metrics_format, metrics_interval=options.metrics_interval,
+                            release=pool.release, search=search_filter(options))
+        pool.release(imap)
+        return count
+    finally:
+        if shared and hasattr(storage, "close"):
+            storage.close()
+        pool.close()
+
+
+def account_options(options, account):
+    # the command line options, overridden by the settings of one account of --config
+    merged = argparse.Namespace(**vars(options))
+    for key, value in account.items():
+        setattr(merged, key, value)
+    return merged
+
+
+def run_accounts(options, root):
+    # back up every account of the --config file in this process, then print one summary
+    settings = AccountRunner.load(options.config)
+    index = None if options.no_index else MailIndex(os.path.join(root, "index.sqlite"))
+    limiter = None
+    if settings["max_rate"] or settings["max_commands"]:
+        limiter = RateLimiter(settings["max_rate"], settings["max_commands"])
+
+    def backup(account):
+        return backup_account(account_options(options, account), root, index, shared=True, verbose=False,
+                              limiter=limiter)
+
+    runner = AccountRunner(backup, concurrency=settings["concurrency"], per_server=settings["per_server"])
+    print(f"Backing up {len(settings['accounts'])} accounts, {settings['concurrency']} at a time, "
+          f"at most {settings['per_server']} per server")
+    try:
+        results = runner.run(settings["accounts"])
+        if options.attachments:
+            for account in settings["accounts"]:
+                extract_attachments(root, index, options.storage,
+                                    account=account_options(options, account).username)
+    finally:
+        if index is not None:
+            index.close()
+    print(AccountRunner.summary(results))
+    if options.report:
+        with open(options.report, "w") as report_file:
+            json.dump(results, report_file, indent=2)
+    failed = sum(1 for result in results if result["error"] is not None)
+    if failed:
+        raise ConnectionError(f"{failed} of {len(results)} accounts failed")
+    return results
+
+
+def clean_spool(root):
+    # remove the temporary files left by an interrupted run: streamed emails in .tmp
+    # directories and hidden .part files of writes in progress
+    removed = 0
+    for directory, subdirectories, files in os.walk(root):
+        spool = os.path.basename(directory) == ".tmp"
+        for file_name in files:
+            if file_name.endswith(".part") and (spool or file_name.startswith(".")):
+                os.remove(os.path.join(directory, file_name))
+                removed += 1
+    return removed
+
+
+def search_index(index_file, query, limit=50):
+    # print the indexed emails matching the query, newest first
+    if not os.path.isfile(index_file):
+        raise OSError(f"no index at {index_file}")
+    index = MailIndex(index_file)
+    rows = index.search(query, limit)
+    index.close()
+    for row in rows:
+        print(f"{row['date'] or '-':25} {row['mailbox'] or '-':10} {row['sender'] or '-'} | "
+              f"{row['subject'] or '-'}\n    {row['path']}")
+    return rows
+
+
+def extract_attachments(root, index, kind="eml", jobs=None, verbose=True, account=None):
+    # extract the attachments of the indexed emails not extracted yet into root/attachments;
+    # in a --config backup, only those of one account, read from its own archive directory
+    archive = account_root(root, kind, account)
+    paths = index.unextracted(account) if archive != root else None
+    segments = SegmentStorage(archive) if kind == "segment" else None
+    try:
+        totals = AttachmentStore(root, index, jobs=jobs, segments=segments,
+                                 dictionary_dir=os.path.join(archive, ".dict")).extract(paths)
+    finally:
+        if segments is not None:
+            segments.close()
+    if verbose:
+        print(f"Extracted {totals['attachments']} attachments ({format_bytes(totals['bytes'])}) from "
+              f"{totals['emails']} emails, {totals['stored']} new in {os.path.join(root, 'attachments')}"
+              + (f", {totals['failed']} emails unreadable" if totals['failed'] else ""))
+    return totals
+
+
+def search_attachments(options):
+    # print the extracted attachments matching --from, --type and --name, newest first
+    root = {"hash": "store", "segment": "segments"}.get(options.storage, "mail")
+    index_file = os.path.join(root, "index.sqlite")
+    if not os.path.isfile(index_file):
+        raise OSError(f"no index at {index_file}")
+    index = MailIndex(index_file)
+    try:
+        if options.extract:
+            extract_attachments(root, index, options.storage, options.jobs, account=options.username)
+        rows = index.attachments(options.sender, options.type, options.name, options.limit)
+    finally:
+        index.close()
+    store = AttachmentStore(root)
+    for row in rows:
+        print(f"{row['date'] or '-':25} {row['sender'] or '-'} | {row['filename'] or '-'} "
+              f"({row['content_type']}, {format_bytes(row['size'])})\n    {store.blob_path(row['sha256'])}")
+    return rows
+
+
+def run_verify(options):
+    # compare the backup with the server from UIDs and sizes, hashing the stored emails in parallel
+    root = {"hash": "store", "segment": "segments"}.get(options.storage, "mail")
+    index_file = os.path.join(root, "index.sqlite")
+    if not os.path.isfile(index_file):
+        raise OSError(f"no index at {index_file}, verify needs the index of the backup")
+    config = (options.server, options.port, options.username, options.password)
+    archive = account_root(root, options.storage, options.username)
+    index = MailIndex(index_file)
+    segments = SegmentStorage(archive) if options.storage == "segment" else None
+    imap = None
+    try:
+        imap = connection(config, batch_size=options.batch_size, max_bytes=options.batch_bytes)
+        verifier = Verifier(index, jobs=options.jobs, rehash=options.rehash, segments=segments,
+                            dictionary_dir=os.path.join(archive, ".dict"), account=options.username)
+        report = verifier.run(imap, all_folders=options.all_folders)
+    finally:
+        if imap is not None and imap.is_connected():
+            imap.close()
+        if segments is not None:
+            segments.close()
+        index.close()
+    print(Verifier.summary(report))
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2)
+    damaged = sum(len(result[kind]) for result in report.values() for kind in ("missing", "truncated", "corrupt"))
+    if damaged:
+        raise ValueError(f"{damaged} emails missing or damaged in the backup")
+    return report
+
+
+def run_restore(options):
+    # upload the indexed emails with their flags and dates, over --workers pooled sessions
+    root = {"hash": "store", "segment": "segments"}.get(options.storage, "mail")
+    index_file = os.path.join(root, "index.sqlite")
+    if not os.path.isfile(index_file):
+        raise OSError(f"no index at {index_file}, restore needs the index of the backup")
+    config = (options.server, options.port, options.username, options.password)
+    workers = max(1, min(options.workers, options.max_connections))
+    rate_limiter = RateLimiter(options.max_rate, options.max_commands)
+    pool = ConnectionPool(session_factory(config, "INBOX", batch_size=options.batch_size,
+                                          max_bytes=options.batch_bytes, rate_limiter=rate_limiter),
+                          max_size=workers)
+    account = options.account or options.username
+    archive = account_root(root, options.storage, account)
+    index = MailIndex(index_file)
+    segments = SegmentStorage(archive) if options.storage == "segment" else None
+    start = time.monotonic()
+    try:
+        restorer = Restorer(index, pool, workers=workers, prefix=options.prefix, segments=segments,
+                            dictionary_dir=os.path.join(archive, ".dict"), account=account)
+        report = restorer.run(options.mailbox)
+    finally:
+        pool.close()
+        if segments is not None:
+            segments.close()
+        index.close()
+    print(Restorer.summary(report))
+    restored = sum(result["restored"] for result in report.values())
+    print(f"{restored} emails restored in {time.monotonic() - start:.1f}s")
+    failed = sum(result["failed"] for result in report.values())
+    if failed:
+        raise ConnectionError(f"{failed} emails could not be restored")
+    return report
+
+
+def run_benchmark(options):
+    # one benchmark run, printed and optionally appended to a results file as a JSON line
+    benchmark = Benchmark(options.messages, distribution=options.distribution, mean_size=options.mean_size,
+                          latency=options.latency_ms / 1000, workers=options.workers, storage=options.storage,
+                          compress=options.compress, sync_batch=options.sync_batch, plan=not options.no_plan,
+                          quota=options.server_quota, max_rate=options.max_rate)
+    result = benchmark.run(fetch_inbox)
+    line = json.dumps(result)
+    print(line)
+    if options.output:
+        with open(options.output, "a") as output_file:
+            output_file.write(line + "\n")
+    return result
+
+
+def format_bytes(size):
+    # human readable size, e.g. 12.3 MB
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}" if unit != "B" else f"{size} B"
+        size /= 1024
+
+
+def format_stats(stats):
+    # compression report of a storage backend, e.g. 40.2 MB -> 9.8 MB (4.1x), 1.32s CPU
+    if not stats.get("raw_bytes"):
+        return ""
+    ratio = stats["raw_bytes"] / max(stats["stored_bytes"], 1)
+    return (f"{format_bytes(stats['raw_bytes'])} -> {format_bytes(stats['stored_bytes'])} ({ratio:.1f}x), "
+            f"{stats['cpu_seconds']:.2f}s CPU")
+
+
+def progress_line(progress, total_bytes=None):
+    # e.g. Saved 1200 emails, 24.1 MB/40.2 MB, 350 emails/s, 7.0 MB/s, ETA 0m12s
+    elapsed = max(time.monotonic() - progress['start'], 1e-9)
+    line = f"Saved {progress['count']} emails, {format_bytes(progress['bytes'])}"
+    if total_bytes:
+        line += f"/{format_bytes(total_bytes)}"
+    line += f", {progress['count'] / elapsed:.0f} emails/s, {format_bytes(int(progress['bytes'] / elapsed))}/s"
+    if total_bytes:
+        line += ", " + eta(progress['bytes'], total_bytes, progress['start'])
+    return line
+
+
+def finish_run(options, profiler=None):
+    # last metrics export and profile dump, also after an error or Ctrl-C
+    if options is None:
+        return
+    if options.metrics:
+        Metrics.shared().write(options.metrics, options.metrics_format)
+    if profiler is not None:
+        stats = profiler.stop(options.profile)
+        print(f"Profile written to {options.profile}, top functions by cumulative time:")
+        stats.sort_stats("cumulative").print_stats(15)
+
+
+def eta(done, total, start):
+    # remaining time from the average rate so far, e.g. ETA 3m20s
+    elapsed = time.monotonic() - start
+    if done <= 0 or elapsed <= 0:
+        return "ETA --"
+    remaining = int((total - done) * elapsed / done)
+    return f"ETA {remaining // 60}m{remaining % 60:02d}s"
 
 
 def main():
+    options = None
+    profiler = None
     try:
-        config = parser_args()
-        imap = connection(config)
-        fetch_inbox(imap)
-        imap.close()
+        options = parser_options()
+        if options.profile:
+            profiler = Profiler()
+            profiler.start()
+        if options.command == "search":
+            search_index(options.index, options.query, options.limit)
+            return
+        if options.command == "export":
+            segments = SegmentStorage(options.segments)
+            print(f"{segments.export(options.output)} emails exported to {options.output}")
+            segments.close()
+            return
+        if options.command == "benchmark":
+            run_benchmark(options)
+            return
+        if options.command == "verify":
+            run_verify(options)
+            return
+        if options.command == "restore":
+            run_restore(options)
+            return
+        if options.command == "attachments":
+            search_attachments(options)
+            return
+        root = {"hash": "store", "segment": "segments"}.get(options.storage, "mail")
+        clean_spool(root)
+        if options.config:
+            run_accounts(options, root)
+            return
+        index = None if options.no_index else MailIndex(os.path.join(root, "index.sqlite"))
+        backup_account(options, root, index)
+        if options.attachments:
+            extract_attachments(root, index, options.storage)
     except ConnectionError as e:
         exit("error : " + str(e))
     except OSError as e:
@@ -69,8 +706,10 @@ def main():
     except ValueError as e:
         exit("error : " + str(e))
     except KeyboardInterrupt:
-        print("\nTerminated by user")
+        print("\nTerminated by user, the next run resumes after the last saved email")
         sys.exit(0)
+    finally:
+        finish_run(options, profiler)
 
 
 if __name__ == "__main__":
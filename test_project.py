@@ -3,8 +3,43 @@ from Imap import Imap
 from EmlStorage import EmlStorage
 from Email import Email
 import email.message
-from project import parser_args, fetch_inbox, connection
-from unittest.mock import patch
+from SyncState import SyncState
+from Downloader import Downloader
+from AsyncImap import AsyncImap
+from BackupPlan import BackupPlan
+from HashStorage import HashStorage
+from MailIndex import MailIndex
+from SegmentStorage import SegmentStorage
+from FolderScheduler import FolderScheduler
+from CompressedStorage import CompressedStorage
+from Pipeline import Pipeline
+from FileNamer import FileNamer
+from Benchmark import Benchmark
+from FakeImapServer import FakeImapServer
+from Metrics import Metrics
+from Profiler import Profiler
+from ConnectionPool import ConnectionPool
+from AccountRunner import AccountRunner
+from RateLimiter import RateLimiter
+from Verifier import Verifier
+from AttachmentStore import AttachmentStore
+from Restorer import Restorer
+from SearchFilter import SearchFilter
+from UidSet import UidSet
+import datetime
+import asyncio
+import hashlib
+import imaplib
+import io
+import json
+import pstats
+import threading
+import time
+import os
+import Imap as imap_module
+from project import parser_args, parser_options, fetch_inbox, connection, search_index, clean_spool, search_filter
+from project import account_root, extract_attachments
+from unittest.mock import patch, MagicMock
 
 server = "imap.gmail.com"
 port = 993
@@ -92,10 +127,1111 @@ def test_parser_args_fail():
 # Test for fetch_inbox function
 @patch('EmlStorage.EmlStorage.save_email')
 @patch('Imap.Imap.fetch_emails', return_value=[b'1'])
-@patch('Imap.Imap.fetch_email')
-def test_fetch_inbox(mock_fetch_email, mock_fetch_emails, mock_save_email):
+@patch('Imap.Imap.fetch_batch', return_value=[Email(create_dummy_email(), uid=1)])
+def test_fetch_inbox(mock_fetch_batch, mock_fetch_emails, mock_save_email):
     imap = Imap(server, port, username, password, ssl=True)
     fetch_inbox(imap)
     assert mock_fetch_emails.called
-    assert mock_fetch_email.called
+    assert mock_fetch_batch.called
     assert mock_save_email.called
+
+
+# Test for batched FETCH helpers
+def test_sequence_set():
+    assert Imap.sequence_set([b"1", b"2", b"3", b"7", b"9", b"10"]) == "1:3,7,9:10"
+    assert Imap.sequence_set([5]) == "5"
+
+
+def test_parse_fetch():
+    data = [(b'1 (UID 11 RFC822 {5}', b'hello'), b')',
+            (b'2 (RFC822 {3}', b'abc'), b' UID 12)',
+            b'3 (UID 13 RFC822.SIZE 42 FLAGS (\\Seen))']
+    records = Imap.parse_fetch(data)
+    assert records[0] == {"UID": "11", "RFC822": b"hello"}
+    assert records[1] == {"RFC822": b"abc", "UID": "12"}
+    assert records[2]["RFC822.SIZE"] == "42"
+    assert records[2]["FLAGS"] == "(\\Seen)"
+
+
+def test_fetch_batch_respects_byte_budget():
+    imap = Imap(server, port, username, password, ssl=True, batch_size=10, max_bytes=100)
+    imap._connection = MagicMock()
+    raw = create_dummy_email().as_bytes()
+    imap._connection.uid.side_effect = [
+        ("OK", [(b'1 (UID 1 RFC822 {%d}' % len(raw), raw), b')']),
+        ("OK", [(b'2 (UID 2 RFC822 {%d}' % len(raw), raw), b')', (b'3 (UID 3 RFC822 {%d}' % len(raw), raw), b')']),
+    ]
+    emails = list(imap.fetch_batch([b"1", b"2", b"3"], sizes={1: 60, 2: 60, 3: 30}))
+    assert [email_obj.uid for email_obj in emails] == [1, 2, 3]
+    assert imap._connection.uid.call_args_list[0].args[1] == "1"
+    assert imap._connection.uid.call_args_list[1].args[1] == "2:3"
+
+
+def test_fetch_batch_estimates_unknown_sizes_without_extra_command():
+    imap = Imap(server, port, username, password, ssl=True, batch_size=10, max_bytes=100)
+    imap._connection = MagicMock()
+    raw = create_dummy_email().as_bytes()
+    imap._connection.uid.side_effect = [
+        ("OK", [(b'1 (UID 1 RFC822.SIZE 60 RFC822 {%d}' % len(raw), raw), b')']),
+        ("OK", [(b'2 (UID 2 RFC822.SIZE 60 RFC822 {%d}' % len(raw), raw), b')']),
+        ("OK", [(b'3 (UID 3 RFC822.SIZE 60 RFC822 {%d}' % len(raw), raw), b')']),
+    ]
+    assert len(list(imap.fetch_batch([b"1"]))) == 1
+    assert "RFC822.SIZE" in imap._connection.uid.call_args_list[0].args[2]
+    # the next messages count as the 60 byte mean: one per 100 byte command
+    assert len(list(imap.fetch_batch([b"2", b"3"]))) == 2
+    assert [call.args[1] for call in imap._connection.uid.call_args_list] == ["1", "2", "3"]
+
+
+# Test for incremental backup
+def test_fetch_new_emails_unchanged_mailbox():
+    imap = Imap(server, port, username, password, ssl=True)
+    imap._connection = MagicMock()
+    imap._highestmodseq = 500
+    assert imap.fetch_new_emails(last_uid=40, highestmodseq=500) == []
+    assert not imap._connection.uid.called
+
+
+def test_fetch_new_emails_changedsince():
+    imap = Imap(server, port, username, password, ssl=True)
+    imap._connection = MagicMock()
+    imap._highestmodseq = 510
+    imap._connection.uid.return_value = ("OK", [b'1 (UID 40 MODSEQ (505))', b'2 (UID 41 MODSEQ (510))'])
+    assert imap.fetch_new_emails(last_uid=40, highestmodseq=500) == [b"41"]
+    assert imap._connection.uid.call_args.args == ("FETCH", "41:*", "(UID)", "(CHANGEDSINCE 500)")
+
+
+def test_sync_state(tmp_path):
+    state = SyncState("user", "INBOX", path_backup=str(tmp_path))
+    state.check_uidvalidity(7)
+    state.commit(12)
+    state.highestmodseq = 99
+    state.save()
+    state = SyncState("user", "INBOX", path_backup=str(tmp_path))
+    assert state.check_uidvalidity(7)
+    assert (state.last_uid, state.highestmodseq) == (12, 99)
+    assert not state.check_uidvalidity(8)
+    assert state.last_uid == 0
+
+
+# Test for the parallel downloader
+class FakeSession:
+    failures = 1
+
+    def __init__(self):
+        self.connected = True
+
+    def fetch_batch(self, email_ids, sizes=None):
+        for email_id in email_ids:
+            if int(email_id) == 5 and FakeSession.failures:
+                FakeSession.failures -= 1
+                raise ConnectionError("connection reset")
+            yield Email(create_dummy_email(), uid=email_id)
+
+    def is_connected(self):
+        return self.connected
+
+    def close(self):
+        self.connected = False
+
+
+def test_downloader_keeps_order_and_reconnects():
+    saved = []
+    storage = MagicMock()
+    storage.save_email.side_effect = lambda email_obj: saved.append(email_obj.uid)
+    downloader = Downloader(FakeSession, storage, workers=4, chunk_size=3)
+    count = downloader.run([str(uid).encode() for uid in range(1, 21)])
+    assert count == 20
+    assert saved == list(range(1, 21))
+    assert FakeSession.failures == 0
+
+
+def test_downloader_connection_limit():
+    assert Downloader(FakeSession, workers=8, max_connections=3).workers == 3
+
+
+# Test for the asyncio IMAP client
+async def serve_async_imap(reader, writer):
+    raw = create_dummy_email().as_bytes()
+    writer.write(b"* OK ready\r\n")
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        tag, command, *args = line.decode().split()
+        if command == "UID" and args[0] == "SEARCH":
+            writer.write(b"* SEARCH 1 2 3\r\n")
+        elif command == "UID" and args[0] == "FETCH":
+            for uid in args[1].split(","):
+                writer.write(b"* %s FETCH (UID %s RFC822 {%d}\r\n%s)\r\n" % (uid.encode(), uid.encode(), len(raw), raw))
+        elif command == "SELECT":
+            writer.write(b"* 3 EXISTS\r\n* OK [UIDVALIDITY 42] UIDs valid\r\n")
+        writer.write(tag.encode() + b" OK done\r\n")
+        await writer.drain()
+
+
+def test_async_imap_pipelined_fetch():
+    async def run():
+        server = await asyncio.start_server(serve_async_imap, "127.0.0.1", 0)
+        imap = AsyncImap("127.0.0.1", server.sockets[0].getsockname()[1], username, password,
+                         batch_size=1, pipeline=3)
+        await imap.connect()
+        email_ids = await imap.fetch_emails()
+        emails = [email_obj async for email_obj in imap.fetch_batch(email_ids)]
+        await imap.close()
+        server.close()
+        return imap, emails
+
+    imap, emails = asyncio.run(run())
+    assert imap.uidvalidity == 42
+    assert [email_obj.uid for email_obj in emails] == [1, 2, 3]
+    assert emails[0].subject == "Dummy Email"
+    assert not imap.is_connected()
+
+
+async def serve_slow_async_imap(reader, writer):
+    # streams each FETCH response slowly, and never answers NOOP
+    raw = create_dummy_email().as_bytes()
+    writer.write(b"* OK ready\r\n")
+    while True:
+        line = await reader.readline()
+        if not line:
+            return
+        tag, command, *args = line.decode().split()
+        if command == "NOOP":
+            continue
+        if command == "UID" and args[0] == "FETCH":
+            for uid in args[1].split(","):
+                await asyncio.sleep(0.1)
+                writer.write(b"* %s FETCH (UID %s RFC822 {%d}\r\n%s)\r\n" % (uid.encode(), uid.encode(), len(raw), raw))
+                await writer.drain()
+        writer.write(tag.encode() + b" OK done\r\n")
+        await writer.drain()
+
+
+def test_async_imap_timeout_is_per_read():
+    async def run():
+        server = await asyncio.start_server(serve_slow_async_imap, "127.0.0.1", 0)
+        imap = AsyncImap("127.0.0.1", server.sockets[0].getsockname()[1], username, password,
+                         batch_size=5, timeout=0.3)
+        await imap.connect()
+        # the FETCH takes 0.5 s, but a response part arrives every 0.1 s
+        emails = [email_obj async for email_obj in imap.fetch_batch([b"1", b"3", b"5", b"7", b"9"])]
+        with pytest.raises(ConnectionError):
+            await imap.command("NOOP")
+        server.close()
+        return emails
+
+    assert [email_obj.uid for email_obj in asyncio.run(run())] == [1, 3, 5, 7, 9]
+
+
+def test_raw_email_round_trip_keeps_8bit_bytes():
+    raw = b"Subject: caf\xe9\r\nContent-Type: text/plain; charset=iso-8859-1\r\n\r\nd\xe9j\xe0 vu\r\n"
+    email_obj = Email(raw, uid=1)
+    email_obj.raw_email = email_obj.raw_email
+    assert email_obj.raw_bytes == raw
+
+
+def test_raw_email_setter_resets_the_server_size():
+    email_obj = Email.from_headers(b"Subject: hi\r\n\r\n", uid=1, size=50000)
+    email_obj.raw_email = b"Subject: hi\r\n\r\nbody\r\n"
+    assert email_obj.size == len(b"Subject: hi\r\n\r\nbody\r\n")
+
+
+# Test for the streaming fetch-to-disk path
+def test_literal_spool_streams_to_file(tmp_path):
+    raw = create_dummy_email().as_bytes()
+    connection = imap_module._StreamingIMAP4.__new__(imap_module._StreamingIMAP4)
+    connection.file = io.BytesIO(raw + b")\r\n")
+    connection.spool_chunk = 7
+    connection.spool_dir = str(tmp_path)
+    connection.spooled = []
+    temp_name = connection.read(len(raw))
+    assert connection.spooled == [temp_name]
+    with open(temp_name, "rb") as temp_file:
+        assert temp_file.read() == raw
+
+
+def test_save_streamed_email(tmp_path):
+    temp_name = tmp_path / "message.part"
+    temp_name.write_bytes(create_dummy_email().as_bytes())
+    email_obj = Email.from_file(str(temp_name), uid=3)
+    assert (email_obj.sender, email_obj.subject, email_obj.uid) == ("dummy@example.com", "Dummy Email", 3)
+    eml_storage = EmlStorage(str(tmp_path / "mail"))
+    eml_storage.save_email(email_obj)
+    assert eml_storage.file_exists()
+    assert not temp_name.exists()
+    assert email_obj.path == eml_storage.file_name
+    assert "This is a dummy email body." in email_obj.raw_email
+
+
+# Test for lazy Email objects
+def test_email_parses_headers_lazily():
+    raw = b"From: a@example.com\r\nSubject: Lazy\r\nMessage-ID: <1@x>\r\n\r\n" + b"x" * 1000
+    email_obj = Email(raw, uid=b"4")
+    assert email_obj._headers is None
+    assert email_obj.subject == "Lazy"
+    assert email_obj.header("Message-ID") == "<1@x>"
+    assert email_obj.raw_bytes is raw
+    assert not hasattr(email_obj, "__dict__")
+    email_obj.sender = "b@example.com"
+    assert email_obj.sender == "b@example.com"
+
+
+# Test for the header-only planning pass
+def test_backup_plan_skips_stored_emails():
+    imap = Imap(server, port, username, password, ssl=True)
+    imap._connection = MagicMock()
+    imap._connection.uid.return_value = ("OK", [
+        (b'1 (UID 7 RFC822.SIZE 1200 BODY[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)] {44}',
+         b'From: a@example.com\r\nSubject: stored\r\n\r\n'), b')',
+        (b'2 (UID 8 RFC822.SIZE 3400 BODY[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)] {41}',
+         b'From: a@example.com\r\nSubject: new\r\n\r\n'), b')'])
+    storage = MagicMock()
+    storage.contains.side_effect = lambda email_obj: email_obj.subject == "stored"
+    plan = BackupPlan.build(imap, [b"7", b"8"], storage)
+    assert "BODY.PEEK[HEADER.FIELDS (FROM SUBJECT DATE MESSAGE-ID)]" in imap._connection.uid.call_args.args[2]
+    assert (plan.missing, plan.total_bytes, plan.stored) == ([8], 3400, 1)
+
+
+# Test for the content-addressed store
+def test_hash_storage_deduplicates(tmp_path):
+    raw = create_dummy_email().as_bytes()
+    inbox = HashStorage(str(tmp_path), "INBOX", uidvalidity=1)
+    inbox.save_email(Email(raw, uid=10))
+    all_mail = HashStorage(str(tmp_path), "[Gmail]/All Mail", uidvalidity=2)
+    all_mail.save_email(Email(raw, uid=99))
+    objects = [name for _, _, names in os.walk(tmp_path / "objects") for name in names]
+    assert len(objects) == 1
+    assert inbox.hash_of(10) == all_mail.hash_of(99)
+    assert HashStorage(str(tmp_path), "INBOX", uidvalidity=1).contains(Email(None, uid=10))
+    assert not HashStorage(str(tmp_path), "INBOX", uidvalidity=1).contains(Email(None, uid=11))
+
+
+# Test for the metadata index and the search subcommand
+def test_index_search(tmp_path):
+    index = MailIndex(str(tmp_path / "index.sqlite"), batch_size=2)
+    eml_storage = EmlStorage(str(tmp_path), "INBOX", index=index)
+    for uid, subject in enumerate(["Invoice March", "Lunch", "Invoice April"], start=1):
+        msg = create_dummy_email()
+        msg.replace_header("Subject", subject)
+        eml_storage.save_email(Email(msg, uid=uid))
+    eml_storage.flush()
+    rows = search_index(str(tmp_path / "index.sqlite"), "invoice")
+    assert sorted(row["uid"] for row in rows) == [1, 3]
+    assert rows[0]["path"].endswith(".eml") and rows[0]["mailbox"] == "INBOX"
+    assert index.search("dummy lunch")[0]["subject"] == "Lunch"
+
+
+def test_parser_search_command():
+    options = parser_options(["search", "invoice march"])
+    assert (options.command, options.query) == ("search", "invoice march")
+
+
+# Test for the packed segment archive
+def test_segment_storage_roll_read_export(tmp_path):
+    segments = SegmentStorage(str(tmp_path / "segments"), "INBOX", segment_size=300)
+    raws = []
+    for uid in range(1, 5):
+        msg = create_dummy_email()
+        msg.replace_header("Subject", f"Message {uid}")
+        raws.append(msg.as_bytes())
+        segments.save_email(Email(raws[-1], uid=uid))
+    segments.save_email(Email(raws[0], uid=9))  # same content, stored once
+    segments.close()
+
+    segments = SegmentStorage(str(tmp_path / "segments"), "INBOX", segment_size=300)
+    assert len([name for name in os.listdir(tmp_path / "segments") if name.endswith(".seg")]) > 1
+    assert len(segments.keys()) == 4
+    assert segments.read(segments.key_of("INBOX", 3)) == raws[2]
+    assert segments.key_of("INBOX", 9) == segments.key_of("INBOX", 1)
+    assert segments.contains(Email(None, uid=4))
+    segments.close()
+
+
+def test_segment_export_keeps_folders_and_counts_written_files(tmp_path):
+    segments = SegmentStorage(str(tmp_path / "segments"), "INBOX")
+    raw = b"From: a@example.com\r\nSubject: no id\r\n\r\nbody\r\n"
+    segments.save_email(Email(raw, uid=1))
+    segments.save_email(Email(raw, uid=2))  # same bytes, no Message-ID: still two files
+    segments.for_mailbox("Archive/2023").save_email(Email(raw, uid=1))
+    assert segments.export(str(tmp_path / "mail")) == 3
+    assert len(os.listdir(tmp_path / "mail" / "INBOX")) == 2
+    assert len(os.listdir(tmp_path / "mail" / "Archive" / "2023")) == 1
+    assert segments.export(str(tmp_path / "mail")) == 0
+    segments.close()
+
+
+def test_segment_storage_reads_records_appended_after_a_read(tmp_path):
+    segments = SegmentStorage(str(tmp_path / "segments"), "INBOX")
+    first = b"From: a@example.com\r\nSubject: first\r\n\r\nbody\r\n"
+    second = b"From: a@example.com\r\nSubject: second\r\n\r\nbody\r\n"
+    segments.save_email(Email(first, uid=1))
+    assert segments.read(segments.key_of("INBOX", 1)) == first
+    segments.save_email(Email(second, uid=2))  # the segment grows past the open map
+    assert segments.read(segments.key_of("INBOX", 2)) == second
+    assert segments.read(segments.key_of("INBOX", 1)) == first
+    segments.close()
+
+
+def test_account_root_finds_the_archive_of_a_config_backup(tmp_path):
+    root = str(tmp_path / "segments")
+    assert account_root(root, "segment", "alice@example.com", shared=True) == os.path.join(root, "alice@example.com")
+    assert account_root(root, "segment", "alice@example.com") == root
+    os.makedirs(os.path.join(root, "alice@example.com"))
+    assert account_root(root, "segment", "alice@example.com") == os.path.join(root, "alice@example.com")
+    assert account_root(root, "hash", "alice@example.com", shared=True) == root
+
+
+def test_extract_attachments_reads_the_segments_of_one_account(tmp_path):
+    root = str(tmp_path / "segments")
+    index = MailIndex(os.path.join(root, "index.sqlite"))
+    for account in ("alice@example.com", "bob@example.com"):
+        archive = account_root(root, "segment", account, shared=True)
+        segments = SegmentStorage(archive, "INBOX", index=index.for_account(account))
+        segments.save_email(Email(f"From: {account}\r\nSubject: hi\r\n\r\nbody\r\n".encode(), uid=1))
+        segments.close()
+    totals = extract_attachments(root, index, "segment", jobs=1, verbose=False, account="bob@example.com")
+    assert (totals["emails"], totals["failed"]) == (1, 0)
+    assert len(index.unextracted("alice@example.com")) == 1
+    index.close()
+
+
+def test_segment_storage_uidvalidity_reset_downloads_reused_uids(tmp_path):
+    segments = SegmentStorage(str(tmp_path / "segments"), "INBOX", uidvalidity=1)
+    segments.save_email(Email(create_dummy_email().as_bytes(), uid=1))
+    segments.close()
+
+    segments = SegmentStorage(str(tmp_path / "segments"), "INBOX", uidvalidity=2)
+    assert not segments.contains(Email(None, uid=1))
+    assert segments.for_mailbox("INBOX", 1).contains(Email(None, uid=1))
+    segments.close()
+
+
+# Test for the multi-folder backup
+def test_list_folders_and_status():
+    imap = Imap("imap.example.com", 993, "user", "password")
+    imap._connection = MagicMock()
+    imap._connection.list.return_value = ("OK", [
+        b'(\\HasNoChildren) "/" "INBOX"',
+        b'(\\Noselect \\HasChildren) "/" "Archive"',
+        (b'(\\HasNoChildren) "/" {12}', b'Archive/2023'),
+        b'(\\HasNoChildren) "/" "Entw&APw-rfe"'])
+    imap._connection.status.return_value = ("OK", [b'"Sent Items" (MESSAGES 12 UIDNEXT 40 UIDVALIDITY 3)'])
+    folders = imap.list_folders()
+    assert [name for name, delimiter, flags in folders] == ["INBOX", "Archive", "Archive/2023", "Entw&APw-rfe"]
+    assert "\\NOSELECT" in folders[1][2]
+    assert Imap.decode_folder(folders[3][0]) == "Entwürfe"
+    assert imap.status("Sent Items") == {"MESSAGES": 12, "UIDNEXT": 40, "UIDVALIDITY": 3}
+    imap._connection.status.assert_called_with('"Sent Items"', "(MESSAGES UIDNEXT UIDVALIDITY)")
+
+
+class FakeFolderSession(FakeSession):
+    folders = {"INBOX": 5, "Archive/2023": 50, "Sent": 20, "Trash": 0}
+
+    def list_folders(self):
+        return [("Archive", "/", {"\\NOSELECT"})] + [(name, "/", set()) for name in FakeFolderSession.folders]
+
+    def status(self, name):
+        return {"MESSAGES": FakeFolderSession.folders[name], "UIDNEXT": FakeFolderSession.folders[name] + 1,
+                "UIDVALIDITY": 1}
+
+    def select(self, name):
+        self.mailbox = name
+
+
+def test_folder_scheduler_skips_unchanged_folders(tmp_path):
+    states = {}
+
+    def state_for(name, delimiter):
+        states[name] = SyncState("user", name, str(tmp_path))
+        return states[name]
+
+    unchanged = SyncState("user", "Sent", str(tmp_path))
+    unchanged.uidvalidity, unchanged.last_uid, unchanged.uidnext = 1, 20, 21
+    unchanged.save()
+
+    scheduler = FolderScheduler(FakeFolderSession, workers=2)
+    jobs = scheduler.plan(FakeFolderSession(), state_for)
+    assert [job["name"] for job in jobs] == ["Archive/2023", "INBOX"]
+    assert sorted(scheduler.skipped) == ["Sent", "Trash"]
+
+    results = scheduler.run(jobs, lambda client, job: (client.mailbox, job["pending"]))
+    assert results == {"Archive/2023": ("Archive/2023", 50), "INBOX": ("INBOX", 5)}
+    assert scheduler.errors == {}
+    assert EmlStorage.folder_path("mail", "Archive/../2023", "/") == os.path.join("mail", "Archive", "_", "2023")
+
+
+def test_folder_scheduler_records_unexpected_errors_and_goes_on():
+    def backup(client, job):
+        if job["name"] == "Archive/2023":
+            raise ValueError("unparsable FETCH response")
+        return job["pending"]
+
+    scheduler = FolderScheduler(FakeFolderSession, workers=1)
+    jobs = [{"name": name, "pending": 1} for name in ("Archive/2023", "INBOX", "Sent")]
+    assert scheduler.run(jobs, backup) == {"INBOX": 1, "Sent": 1}
+    assert isinstance(scheduler.errors["Archive/2023"], ValueError)
+
+
+# Test for the compressed storage
+def test_compressed_storage_gzip(tmp_path):
+    storage = CompressedStorage(str(tmp_path), codec="gzip", level=9)
+    raw = create_dummy_email().as_bytes() + b"base64 line\r\n" * 1000
+    storage.save_email(Email(raw, uid=1))
+    assert storage.file_name.endswith(".eml.gz")
+    assert storage.read(storage.file_name) == raw
+    assert storage.read_email(storage.file_name).subject == "Dummy Email"
+    assert storage.contains(Email(raw, uid=1))
+
+
+def test_compressed_storage_reports_stats(tmp_path):
+    storage = CompressedStorage(str(tmp_path), codec="gzip", level=9)
+    raw = create_dummy_email().as_bytes() + b"base64 line\r\n" * 1000
+    storage.save_email(Email(raw, uid=1))
+    stats = storage.stats()
+    assert stats["emails"] == 1 and stats["raw_bytes"] == len(raw)
+    assert stats["stored_bytes"] * 3 < stats["raw_bytes"]
+    assert stats["cpu_seconds"] >= 0
+
+
+def test_compressed_storage_rejects_unknown_codec(tmp_path):
+    with pytest.raises(ValueError):
+        CompressedStorage(str(tmp_path), codec="lz4")
+
+
+def test_compressed_storage_zstd_dictionary(tmp_path):
+    pytest.importorskip("zstandard")
+    storage = CompressedStorage(str(tmp_path), codec="zstd", train_samples=200)
+    raws = [b"From: user%d@example.com\r\nSubject: Report %d\r\nX-Mailer: EmailSafe\r\n\r\nWeekly report number %d\r\n"
+            % (number, number, number) for number in range(300)]
+    for number, raw in enumerate(raws):
+        storage.save_email(Email(raw, uid=number + 1))
+    assert storage.file_name.endswith(".eml.zst")
+    assert os.listdir(os.path.join(str(tmp_path), ".dict"))
+    reader = CompressedStorage(str(tmp_path), codec="zstd")
+    assert reader.read(storage.file_name) == raws[-1]
+
+
+# Test for the fetch/parse/write pipeline
+def test_pipeline_groups_syncs_and_reports_stages():
+    calls = []
+    storage = MagicMock()
+    storage.prepare.side_effect = lambda email_obj: calls.append(("prepare", email_obj.uid))
+    storage.save_email.side_effect = lambda email_obj: calls.append(("save", email_obj.uid))
+    storage.flush.side_effect = lambda: calls.append(("flush", None))
+    saved = []
+    pipeline = Pipeline(storage, queue_size=2, sync_batch=4)
+    emails = (Email(create_dummy_email(), uid=uid) for uid in range(1, 11))
+    assert pipeline.run(emails, on_saved=lambda email_obj: saved.append((email_obj.uid, len(calls)))) == 10
+
+    assert [uid for name, uid in calls if name == "save"] == list(range(1, 11))
+    assert [name for name, uid in calls].count("flush") == 3
+    for uid, call_count in saved:
+        # an email is only reported once the flush after it has run
+        assert ("flush", None) in calls[calls.index(("save", uid)):call_count]
+    assert all(pipeline.stats()[stage]["emails"] == 10 for stage in Pipeline.stages)
+    assert "write" in pipeline.report()
+
+
+def test_pipeline_reraises_fetch_errors():
+    def emails():
+        yield Email(create_dummy_email(), uid=1)
+        raise ConnectionError("connection reset")
+
+    storage = MagicMock()
+    with pytest.raises(ConnectionError):
+        Pipeline(storage).run(emails())
+    assert storage.save_email.call_count == 1 and storage.flush.called
+
+
+# Test for crash-safe resumable runs
+def test_sync_state_journal_resumes_interrupted_run(tmp_path):
+    state = SyncState("user", "INBOX", str(tmp_path))
+    state.check_uidvalidity(7)
+    state.save()
+    for uid in (3, 4, 5):
+        state.commit(uid)
+    # the process dies here, without a checkpoint
+    resumed = SyncState("user", "INBOX", str(tmp_path))
+    assert resumed.check_uidvalidity(7)
+    assert resumed.last_uid == 5
+
+    resumed.commit(6)
+    resumed.save()
+    assert not [name for name in os.listdir(tmp_path / ".sync" / "user") if name.endswith(".journal")]
+    assert SyncState("user", "INBOX", str(tmp_path)).last_uid == 6
+
+
+def test_interrupted_write_leaves_no_eml(tmp_path):
+    storage = EmlStorage(str(tmp_path))
+    email_obj = Email(create_dummy_email(), uid=1)
+    with patch('os.replace', side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            storage.save_email(email_obj)
+    assert not storage.contains(email_obj)
+    assert clean_spool(str(tmp_path)) == 1
+    assert os.listdir(tmp_path) == []
+
+
+namer_headers = (b"From: =?utf-8?q?Ren=C3=A9?= <rene@example.com>\r\n"
+                 b"Subject: =?utf-8?b?w6nDqMOg?= a/b:c?\r\n\tfolded " + "é".encode() * 40 + b"\r\n"
+                 b"Message-ID: <1@example.com>\r\n\r\n")
+
+
+def test_file_namer_sanitizes_and_truncates():
+    name = FileNamer(max_bytes=60).name(Email.from_headers(namer_headers, uid=1))
+    assert name.startswith("René rene@example.com_éèà a_b_c_ folded é")
+    assert len(name.encode("utf-8")) <= 60
+    assert not set('<>:"/\\|?*\r\n\t') & set(name)
+
+
+def test_file_namer_disambiguates_with_a_stable_tag():
+    first = Email.from_headers(namer_headers, uid=1)
+    second = Email.from_headers(namer_headers.replace(b"<1@", b"<2@"), uid=2)
+    name = FileNamer(max_bytes=60).name(first)
+    assert name.endswith("_" + FileNamer.tag(first) + ".eml")
+    assert name != FileNamer(max_bytes=60).name(second)
+    assert name == FileNamer(max_bytes=60).name(first)
+
+
+def test_file_namer_decodes_encoded_words():
+    assert FileNamer.decode("=?iso-8859-1?q?Andr=E9?= =?utf-8?q?_Pirard?=") == "André Pirard"
+
+
+def test_file_namer_avoids_windows_device_names():
+    headers = b"From: nul.example.com\r\nSubject: hi\r\nMessage-ID: <1@example.com>\r\n\r\n"
+    assert FileNamer().name(Email.from_headers(headers)).startswith("_nul.example.com_hi_")
+    assert FileNamer.safe("COM1.tar.gz") == "_COM1.tar.gz" and FileNamer.safe("CONTACTS.eml") == "CONTACTS.eml"
+    assert EmlStorage.folder_path("mail", "Archive/Con") == os.path.join("mail", "Archive", "_Con")
+
+
+def test_eml_storage_recognizes_files_named_without_tag(tmp_path):
+    email_obj = Email(create_dummy_email(), uid=1)
+    with open(tmp_path / "dummy@example.com_Dummy Email.eml", "wb") as eml_file:
+        eml_file.write(email_obj.raw_bytes)
+    storage = EmlStorage(str(tmp_path))
+    assert storage.contains(email_obj)
+
+
+def test_eml_storage_legacy_file_does_not_hide_other_emails_with_same_name(tmp_path):
+    old = b"From: news@example.com\r\nSubject: Weekly news\r\nMessage-ID: <1@example.com>\r\n\r\nweek 1\r\n"
+    new = b"From: news@example.com\r\nSubject: Weekly news\r\nMessage-ID: <2@example.com>\r\n\r\nweek 2\r\n"
+    with open(tmp_path / "news@example.com_Weekly news.eml", "wb") as eml_file:
+        eml_file.write(old)
+    storage = EmlStorage(str(tmp_path))
+    assert storage.contains(Email.from_headers(old, uid=1, size=len(old)))
+    assert not storage.contains(Email.from_headers(new, uid=2, size=len(new)))
+
+
+def test_fake_server_parses_sequence_sets():
+    assert FakeImapServer.parse_set("1:3,9:*", 5) == [1, 2, 3, 5]
+
+
+def test_benchmark_against_fake_server(tmp_path):
+    result = Benchmark(40, mean_size=4096, sync_batch=10, path=str(tmp_path)).run(fetch_inbox)
+    assert result["messages"] == 40
+    assert result["bytes"] >= 40 * 512
+    assert 0 < result["latency_p50_ms"] <= result["latency_p99_ms"]
+    assert result["messages_per_sec"] > 0 and result["mb_per_sec"] > 0
+    assert len([name for name in os.listdir(tmp_path / "mail") if name.endswith(".eml")]) == 40
+    assert json.loads(json.dumps(result))["storage"] == "eml"
+
+
+def sample_metrics():
+    metrics = Metrics()
+    metrics.inc("emailsafe_saved_total", 3)
+    metrics.observe("emailsafe_write_seconds", 0.002)
+    with metrics.time("emailsafe_write_seconds"):
+        pass
+    return metrics
+
+
+def test_metrics_snapshot_counts_and_buckets():
+    snapshot = sample_metrics().snapshot()
+    assert snapshot["counters"] == {"emailsafe_saved_total": 3}
+    assert snapshot["histograms"]["emailsafe_write_seconds"]["count"] == 2
+    assert snapshot["histograms"]["emailsafe_write_seconds"]["buckets"]["0.0025"] == 2
+
+
+def test_metrics_appends_json_lines(tmp_path):
+    metrics = sample_metrics()
+    metrics.write(str(tmp_path / "metrics.jsonl"))
+    metrics.write(str(tmp_path / "metrics.jsonl"))
+    lines = (tmp_path / "metrics.jsonl").read_text().splitlines()
+    assert len(lines) == 2 and json.loads(lines[1])["counters"]["emailsafe_saved_total"] == 3
+
+
+def test_metrics_writes_prometheus_text(tmp_path):
+    sample_metrics().write(str(tmp_path / "metrics.prom"), "prometheus")
+    text = (tmp_path / "metrics.prom").read_text()
+    assert "# TYPE emailsafe_write_seconds histogram" in text
+    assert 'emailsafe_write_seconds_bucket{le="+Inf"} 2' in text
+    assert "emailsafe_saved_total 3" in text
+
+
+def test_profiler_merges_threads(tmp_path):
+    def busy_worker():
+        sum(range(10000))
+
+    profiler = Profiler()
+    profiler.start()
+    thread = threading.Thread(target=busy_worker)
+    thread.start()
+    thread.join()
+    profiler.stop(str(tmp_path / "run.prof"))
+    functions = {name for _, _, name in pstats.Stats(str(tmp_path / "run.prof")).stats}
+    assert "busy_worker" in functions
+
+
+class FakePooledSession:
+    def __init__(self):
+        self.mailbox = "INBOX"
+        self.alive = True
+        self.closed = False
+        self.noops = 0
+
+    def select(self, mailbox):
+        if not self.alive:
+            raise ConnectionError("dropped")
+        self.mailbox = mailbox
+
+    def noop(self):
+        self.noops += 1
+        return self.alive
+
+    def is_connected(self):
+        return not self.closed
+
+    def close(self):
+        self.closed = True
+
+
+def test_connection_pool_reuses_and_replaces_sessions():
+    sessions = []
+
+    def factory():
+        sessions.append(FakePooledSession())
+        return sessions[-1]
+
+    pool = ConnectionPool(factory, max_size=2, idle_timeout=0)
+    first = pool.acquire("INBOX")
+    pool.release(first)
+    assert pool.acquire("Sent") is first
+    assert first.mailbox == "Sent" and first.noops == 1
+
+    first.alive = False  # dropped by the server while idle
+    pool.release(first)
+    second = pool.acquire("INBOX")
+    assert second is not first and first.closed and len(sessions) == 2
+
+    third = pool.acquire()
+    with pytest.raises(ConnectionError):
+        pool.acquire(timeout=0)
+    pool.release(third, broken=True)
+    pool.release(third)  # a second release is ignored
+    assert third.closed
+    assert pool.acquire() is not third and len(sessions) == 4
+
+
+@patch('time.sleep')
+def test_connection_pool_retries_with_jittered_backoff(mock_sleep):
+    attempts = []
+
+    def factory():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise ConnectionError("handshake failed")
+        return FakePooledSession()
+
+    pool = ConnectionPool(factory, retries=3, backoff=1, max_backoff=30)
+    assert pool.acquire() is not None
+    delays = [call.args[0] for call in mock_sleep.call_args_list]
+    assert len(delays) == 2 and 0 <= delays[0] <= 1 and 0 <= delays[1] <= 2
+    assert all(0 <= ConnectionPool.backoff(10, 1, 30) <= 30 for _ in range(100))
+
+
+def test_account_runner_loads_config(tmp_path, monkeypatch):
+    config = tmp_path / "accounts.toml"
+    config.write_text('concurrency = 3\n[defaults]\nall_folders = true\n'
+                      '[[accounts]]\nserver = "imap.a.com"\nusername = "alice"\npassword_env = "ALICE_PW"\n'
+                      '[[accounts]]\nserver = "imap.b.com"\nport = 143\nusername = "bob"\npassword = "pw"\n')
+    monkeypatch.setenv("ALICE_PW", "secret")
+    settings = AccountRunner.load(str(config))
+    assert settings["concurrency"] == 3 and settings["per_server"] == 2
+    assert settings["accounts"][0] == {"server": "imap.a.com", "port": 993, "username": "alice",
+                                       "password": "secret", "all_folders": True}
+    assert settings["accounts"][1]["port"] == 143
+
+    config.write_text('[[accounts]]\nserver = "imap.a.com"\nusername = "alice"\npassword = "pw"\nspeed = 1\n')
+    with pytest.raises(ValueError, match="unknown setting speed"):
+        AccountRunner.load(str(config))
+    config.write_text('[[accounts]]\nserver = "imap.a.com"\nusername = "alice"\n')
+    with pytest.raises(ValueError, match="missing password"):
+        AccountRunner.load(str(config))
+
+
+def test_account_runner_limits_concurrency_per_server():
+    lock = threading.Lock()
+    running = {"total": 0, "max_total": 0}
+
+    def backup(account):
+        with lock:
+            running[account["server"]] = running.get(account["server"], 0) + 1
+            running["total"] += 1
+            running["max_total"] = max(running["max_total"], running["total"])
+            running["max_" + account["server"]] = max(running.get("max_" + account["server"], 0),
+                                                      running[account["server"]])
+        time.sleep(0.02)
+        with lock:
+            running[account["server"]] -= 1
+            running["total"] -= 1
+        if account["username"] == "broken":
+            raise ConnectionError("login failed")
+        return 5
+
+    accounts = [{"server": "a", "port": 993, "username": f"user{number}"} for number in range(6)]
+    accounts += [{"server": "b", "port": 993, "username": "b1"}, {"server": "b", "port": 993, "username": "broken"}]
+    results = AccountRunner(backup, concurrency=3, per_server=2).run(accounts)
+    assert running["max_a"] == 2 and running["max_total"] == 3
+    assert [result["emails"] for result in results] == [5] * 7 + [0]
+    assert results[-1]["error"] == "login failed"
+    summary = AccountRunner.summary(results)
+    assert "broken" in summary and "8 accounts, 7 ok, 1 failed, 35 emails" in summary
+
+
+def test_account_runner_records_unexpected_errors_and_goes_on():
+    def backup(account):
+        if account["username"] == "broken":
+            raise KeyError("UIDVALIDITY")
+        return 5
+
+    accounts = [{"server": "a", "port": 993, "username": name} for name in ("broken", "user1", "user2")]
+    results = AccountRunner(backup, concurrency=1, per_server=1).run(accounts)
+    assert results[0]["error"] == "KeyError: 'UIDVALIDITY'"
+    assert [result["emails"] for result in results[1:]] == [5, 5]
+
+
+def test_rate_limiter_parses_rates():
+    assert RateLimiter.parse_rate("5M") == 5 * 1024 * 1024 and RateLimiter.parse_rate("500k") == 500 * 1024
+    with pytest.raises(ValueError):
+        RateLimiter.parse_rate("fast")
+
+
+def test_rate_limiter_recognizes_throttling_responses():
+    assert RateLimiter.is_throttled([b"[THROTTLED] Too many simultaneous connections"])
+    assert not RateLimiter.is_throttled([b"Invalid messageset"])
+
+
+def test_rate_limiter_paces_commands():
+    commands = RateLimiter(commands_per_sec=50, burst=0.02)
+    start = time.monotonic()
+    for _ in range(6):
+        commands.acquire()
+    assert time.monotonic() - start >= 0.08  # one at once, then one every 20 ms
+
+
+def test_rate_limiter_charges_large_commands_to_the_next_one():
+    limiter = RateLimiter(1024 * 1024, burst=0.1, recovery=0)
+    limiter.acquire(200 * 1024)  # larger than the bucket: the next command pays the debt
+    start = time.monotonic()
+    limiter.acquire()
+    assert time.monotonic() - start >= 0.08
+
+
+@patch.object(ConnectionPool, 'backoff', return_value=0)
+def test_rate_limiter_adapts_to_throttling(mock_backoff):
+    limiter = RateLimiter(1024 * 1024, burst=0.1, recovery=0)
+    limiter.throttled()
+    limiter.throttled()  # the same burst of refusals lowers the rates once
+    assert limiter.rates["bytes"] == 512 * 1024 and limiter.throttles == 2
+    limiter.record(1024, 0.01)
+    assert limiter.rates["bytes"] == 640 * 1024
+
+
+@patch.object(ConnectionPool, 'backoff', return_value=0)
+def test_imap_retries_throttled_commands(mock_backoff):
+    limiter = RateLimiter()
+    imap = Imap("imap.example.com", 993, "user", "password", rate_limiter=limiter, throttle_retries=2)
+    imap._connection = MagicMock()
+    imap._connection.uid.side_effect = [("NO", [b"[THROTTLED] slow down"]), ("OK", [b"1 2"])]
+    assert imap.fetch_emails() == [b"1", b"2"]
+    assert limiter.throttles == 1
+
+    imap._connection.uid.side_effect = [("NO", [b"[THROTTLED] slow down"])] * 3
+    with pytest.raises(ConnectionError, match="throttled"):
+        imap.fetch_emails()
+    imap._connection.uid.side_effect = imaplib.IMAP4.abort("[UNAVAILABLE] try again later")
+    with pytest.raises(ConnectionError, match="closed by the server"):
+        imap.fetch_emails()
+
+
+def test_verifier_reports_missing_truncated_corrupt_and_extra(tmp_path):
+    index = MailIndex(str(tmp_path / "index.sqlite"))
+    os.makedirs(tmp_path / "INBOX")
+    for uid in (1, 2, 3, 5):
+        path = str(tmp_path / "INBOX" / f"{uid}.eml")
+        with open(path, "wb") as eml_file:
+            eml_file.write(b"Subject: test\r\n\r\n" + b"x" * 83)
+        index.add(Email(None, uid=uid), path, "INBOX")
+    content = b"Subject: stored by hash\r\n\r\nbody"
+    object_path = str(tmp_path / f"{hashlib.sha256(content).hexdigest()}.eml")
+    with open(object_path, "wb") as object_file:
+        object_file.write(content.replace(b"body", b"bodY"))  # same size, damaged content
+    index.add(Email(None, uid=6), object_path, "INBOX")
+    with open(tmp_path / "INBOX" / "2.eml", "r+b") as eml_file:
+        eml_file.truncate(50)
+    os.remove(tmp_path / "INBOX" / "3.eml")
+
+    client = MagicMock()
+    client.list_folders.return_value = [("INBOX", "/", set())]
+    client.fetch_emails.return_value = [b"1", b"2", b"3", b"4", b"6"]
+    client.fetch_sizes.side_effect = lambda uids: {int(uid): 100 if uid != 6 else len(content) for uid in uids}
+
+    verifier = Verifier(index, jobs=1)
+    report = verifier.run(client)["INBOX"]
+    assert (report["server"], report["stored"]) == (5, 5)
+    assert report["missing"] == [3, 4] and report["truncated"] == [2]
+    assert report["corrupt"] == [6] and report["extra"] == [5]
+    assert "1 truncated, 1 corrupt, 1 extra" in Verifier.summary({"INBOX": report})
+
+    # unchanged files come from the digest cache
+    with patch.object(Verifier, "_digest", side_effect=AssertionError("file read again")):
+        assert verifier.run(client)["INBOX"] == report
+    index.close()
+
+
+def test_verifier_checks_one_account_and_the_current_uidvalidity(tmp_path):
+    index = MailIndex(str(tmp_path / "index.sqlite"))
+    content = b"Subject: test\r\n\r\nbody"
+    for account, uid, uidvalidity in (("alice@example.com", 1, 7), ("bob@example.com", 1, 7),
+                                      ("bob@example.com", 2, 6)):
+        path = str(tmp_path / f"{account}-{uid}.eml")
+        if account == "bob@example.com":
+            with open(path, "wb") as eml_file:
+                eml_file.write(content)
+        index.for_account(account).add(Email(None, uid=uid), path, "INBOX", uidvalidity)
+
+    client = MagicMock()
+    client.list_folders.return_value = [("INBOX", "/", set())]
+    client.uidvalidity = 7
+    client.fetch_emails.return_value = [b"1"]
+    client.fetch_sizes.side_effect = lambda uids: {int(uid): len(content) for uid in uids}
+    report = Verifier(index, jobs=1, account="bob@example.com").run(client)["INBOX"]
+    # alice's UID 1 is not bob's, and bob's UID 2 was saved under the old UIDVALIDITY 6
+    assert (report["stored"], report["missing"], report["extra"]) == (1, [], [])
+    index.close()
+
+
+def test_attachment_store_extracts_deduplicates_and_indexes(tmp_path):
+    index = MailIndex(str(tmp_path / "index.sqlite"))
+    report = b"%PDF-1.4 quarterly report"
+    for uid, sender in ((1, "alice@example.com"), (2, "bob@example.com")):
+        message = email.message.EmailMessage()
+        message["From"] = sender
+        message["Subject"] = f"report {uid}"
+        message.set_content("see attached")
+        message.add_attachment(report, maintype="application", subtype="pdf", filename="report.pdf")
+        message.add_attachment(f"photo {uid}".encode(), maintype="image", subtype="png", filename="photo.png")
+        path = str(tmp_path / f"{uid}.eml")
+        with open(path, "wb") as eml_file:
+            eml_file.write(message.as_bytes())
+        index.add(Email(message.as_bytes(), uid=uid), path, "INBOX")
+
+    store = AttachmentStore(str(tmp_path), index, jobs=2)
+    totals = store.extract()
+    assert (totals["emails"], totals["attachments"], totals["stored"]) == (2, 4, 3)
+    with open(store.blob_path(hashlib.sha256(report).hexdigest()), "rb") as blob_file:
+        assert blob_file.read() == report
+
+    rows = index.attachments(sender="alice", content_type="pdf")
+    assert [(row["filename"], row["content_type"], row["size"]) for row in rows] == \
+        [("report.pdf", "application/pdf", len(report))]
+    assert len(index.attachments(content_type="image/png")) == 2
+    # the emails already extracted are not parsed again
+    assert store.extract()["emails"] == 0
+    index.close()
+
+
+def test_imap_append_pipelines_multiappend_and_keeps_flags():
+    emails = []
+    for number in range(5):
+        email_obj = Email(f"Message-ID: <{number}@example.com>\nSubject: {number}\n\nbody\n".encode())
+        email_obj.flags = "\\Seen \\Recent" if number % 2 else ""
+        email_obj.internal_date = f"0{number + 1}-Feb-2023 10:00:00 +0100"
+        emails.append(email_obj)
+    for capabilities, commands in ((FakeImapServer.capabilities, 1), ("IMAP4rev1 UIDPLUS", 5)):
+        with FakeImapServer({"INBOX": 0}, capabilities=capabilities) as server:
+            imap = Imap(*server.address, username, password)
+            imap.connect()
+            before = server.commands
+            assert imap.append(emails, "INBOX") == 5
+            assert server.commands - before == commands
+            flags, date, raw = server.appended[("INBOX", 2)]
+            assert (flags, date) == ("\\Seen", "02-Feb-2023 10:00:00 +0100")
+            assert raw == b"Message-ID: <1@example.com>\r\nSubject: 1\r\n\r\nbody\r\n"
+            imap.close()
+
+
+def test_restorer_skips_messages_already_on_the_server(tmp_path):
+    index = MailIndex(str(tmp_path / "index.sqlite"))
+    for mailbox, uid in (("INBOX", 1), ("INBOX", 2), ("INBOX", 3), ("Archive", 1)):
+        path = str(tmp_path / f"{mailbox}-{uid}.eml")
+        with open(path, "wb") as eml_file:
+            eml_file.write(f"Message-ID: <{mailbox}.{uid}@example.com>\r\n\r\nbody\r\n".encode())
+        email_obj = Email.from_file(path, uid=uid)
+        email_obj.flags = "\\Flagged"
+        index.add(email_obj, path, mailbox)
+
+    with FakeImapServer({"INBOX": 0}) as server:
+        def factory():
+            imap = Imap(*server.address, username, password)
+            imap.connect()
+            return imap
+
+        pool = ConnectionPool(factory, max_size=2)
+        with pool.session() as imap:
+            imap.append([Email(b"Message-ID: <INBOX.2@example.com>\r\n\r\nbody\r\n")], "INBOX")
+        report = Restorer(index, pool, workers=2, batch_size=1).run()
+        assert (report["INBOX"]["restored"], report["INBOX"]["skipped"]) == (2, 1)
+        assert report["Archive"]["restored"] == 1 and server.mailboxes["Archive"] == 1
+        assert server.appended[("Archive", 1)][0] == "\\Flagged"
+        # a second run finds every email on the server
+        report = Restorer(index, pool, workers=2).run()
+        assert sum(result["restored"] for result in report.values()) == 0
+        assert "0 restored, 4 already on the server, 0 failed" in Restorer.summary(report)
+        pool.close()
+    index.close()
+
+
+def test_restorer_uploads_only_the_emails_of_its_account(tmp_path):
+    shared = MailIndex(str(tmp_path / "index.sqlite"))
+    for account in ("alice@example.com", "bob@example.com"):
+        path = str(tmp_path / f"{account}.eml")
+        with open(path, "wb") as eml_file:
+            eml_file.write(f"Message-ID: <{account}>\r\n\r\nbody\r\n".encode())
+        # both accounts have an INBOX email with UID 1
+        shared.for_account(account).add(Email.from_file(path, uid=1), path, "INBOX")
+    assert shared.accounts() == ["alice@example.com", "bob@example.com"]
+
+    with FakeImapServer({"INBOX": 0}) as server:
+        def factory():
+            imap = Imap(*server.address, username, password)
+            imap.connect()
+            return imap
+
+        pool = ConnectionPool(factory, max_size=1)
+        report = Restorer(shared, pool, account="bob@example.com").run()
+        assert report["INBOX"]["restored"] == 1 and server.mailboxes["INBOX"] == 1
+        assert server.appended[("INBOX", 1)][2] == b"Message-ID: <bob@example.com>\r\n\r\nbody\r\n"
+        with pytest.raises(ValueError):
+            Restorer(shared, pool, account="carol@example.com").run()
+        # emails of unknown account, indexed by an older version, cannot be attributed
+        shared.add(Email.from_file(path, uid=2), path, "INBOX")
+        with pytest.raises(ValueError):
+            Restorer(shared, pool, account="bob@example.com").run()
+        pool.close()
+    shared.close()
+
+
+def test_search_filter_compiles_options_to_criteria():
+    options = parser_options(["--server", server, "--port", "993", "--username", username, "--password", password,
+                              "--since", "2024-01-05", "--before", "2024-03-01", "--larger-than", "20K",
+                              "--from", "alice", "--from", 'b"ob', "--from", "carol", "--unseen"])
+    assert search_filter(options).criteria() == ('SINCE 5-Jan-2024 BEFORE 1-Mar-2024 LARGER 20480 '
+                                                 'OR OR FROM "alice" FROM "b\\"ob" FROM "carol" UNSEEN')
+
+
+def test_search_filter_is_none_without_filter_options():
+    assert search_filter(parser_options(["--server", server, "--port", "993", "--username", username,
+                                         "--password", password])) is None
+
+
+def test_search_filter_rejects_empty_date_range():
+    with pytest.raises(ValueError):
+        SearchFilter(since=datetime.date(2024, 2, 1), before=datetime.date(2024, 1, 1))
+
+
+def test_search_filter_parses_size_suffixes():
+    assert SearchFilter.parse_size("1.5M") == 1572864
+
+
+def test_search_filter_checks_sender_and_size_on_headers():
+    # the headers are checked again: servers may match FROM on words or on the address only
+    alice = Email.from_headers(b"From: =?utf-8?q?Alice_M=C3=BCller?= <a.m@example.com>\r\n\r\n", size=30000)
+    dave = Email.from_headers(b"From: Dave <dave@example.com>\r\n\r\n", size=30000)
+    search = SearchFilter(senders=["alice", "carol"], larger_than=20 * 1024)
+    assert search.matches(alice) and not search.matches(dave)
+    assert not SearchFilter(senders=["alice"], larger_than=40000).matches(alice)
+
+
+def test_search_filter_excludes_folders_by_pattern():
+    search = SearchFilter(exclude_folders=["Spam", "Archive/*"])
+    assert search.excludes("Archive/2023") and search.excludes("Spam") and not search.excludes("Spam2")
+
+
+def test_folder_scheduler_leaves_out_excluded_folders():
+    scheduler = FolderScheduler(FakeFolderSession, exclude=SearchFilter(exclude_folders=["Archive*"]).excludes)
+    jobs = scheduler.plan(FakeFolderSession(), lambda name, delimiter: SyncState("user", name, "unused"))
+    assert scheduler.excluded == ["Archive/2023"] and "Archive/2023" not in [job["name"] for job in jobs]
+
+
+def test_search_filter_leaves_non_ascii_senders_to_the_header_check():
+    search = SearchFilter(senders=["müller", "bob"], unseen=True)
+    assert search.criteria() == "UNSEEN"
+    assert search.matches(Email.from_headers(b"From: =?utf-8?q?M=C3=BCller?= <m@example.com>\r\n\r\n"))
+
+
+def test_selective_backup_downloads_only_matching_emails(tmp_path):
+    with FakeImapServer({"INBOX": 600}, distribution="uniform") as fake:
+        imap = Imap(*fake.address, username, password)
+        imap.connect()
+        search = SearchFilter(since=datetime.date(2024, 1, 5), larger_than=20 * 1024,
+                              senders=["sender3@example.com"], unseen=True)
+        # message n arrives n - 1 hours after 01-Jan-2024 12:00, the even UIDs are \Seen
+        expected = [uid for uid in range(1, 601) if uid % 97 == 3 and uid % 2 and uid >= 85
+                    and fake.size("INBOX", uid) > 20 * 1024]
+        assert [int(uid) for uid in imap.fetch_emails(search.criteria())] == expected
+        state = SyncState("user", "INBOX", str(tmp_path))
+        count = fetch_inbox(imap, state, plan=False, storage=EmlStorage(str(tmp_path)), verbose=False,
+                            search=search)
+        assert count == len(expected) and sorted(uid for _, uid in fake.sent) == expected
+        # a later full run is not skipped by the filtered one
+        assert state.last_uid == 0 and not os.path.exists(state._file_name)
+        imap.close()
+
+
+def test_uid_set_keeps_ranges():
+    uids = UidSet([b"1", b"2", b"3", b"7", b"9"])
+    uids.update([10, 11, 5])
+    uids.add_range(20, 1000000)
+    assert uids.sequence_set() == "1:3,5,7,9:11,20:1000000"
+    assert len(uids) == 8 + 999981 and 500000 in uids and b"4" not in uids
+    uids.add_range(4, 8)  # bridges three ranges
+    assert list(uids.ranges()) == [(1, 11), (20, 1000000)] and len(uids) == 11 + 999981
+    small = UidSet.from_sequence_set(b"3:1,8")
+    assert list(small) == [b"1", b"2", b"3", b"8"] and small == [1, "2", b"3", 8] and small != [1, 2]
+    assert len(UidSet.from_sequence_set("")) == 0 and not UidSet()
+
+
+def test_fetch_emails_uses_esearch_or_pages_uid_windows():
+    with FakeImapServer({"INBOX": 2500}) as fake:
+        imap = Imap(*fake.address, username, password)
+        imap.connect()
+        before = fake.commands
+        uids = imap.fetch_emails()
+        assert fake.commands - before == 1 and list(uids.ranges()) == [(1, 2500)]
+        unseen = imap.fetch_emails("UNSEEN")
+        assert len(unseen) == 1250 and unseen.sequence_set().startswith("1,3,5")
+        assert imap.fetch_new_emails(last_uid=2490) == [str(uid) for uid in range(2491, 2501)]
+        imap.close()
+    with FakeImapServer({"INBOX": 2500}, capabilities="IMAP4rev1") as fake:
+        imap = Imap(*fake.address, username, password, search_page=1000)
+        imap.connect()
+        before = fake.commands
+        assert list(imap.fetch_emails().ranges()) == [(1, 2500)]
+        assert fake.commands - before == 3  # UID 1:1000, UID 1001:2000, UID 2001:*
+        assert len(imap.fetch_emails("LARGER 20000")) == len(
+            [uid for uid in range(1, 2501) if fake.size("INBOX", uid) > 20000])
+        assert list(imap.fetch_new_emails(last_uid=2500)) == []
+        imap.close()